@@ -22,12 +22,17 @@ from api.user import (
 import api.achievement
 import api.bundles
 import api.cache
+import api.coalescing
 import api.common
+import api.compression
 import api.config
 import api.db
 import api.email
+import api.events
 import api.group
+import api.json_encoder
 import api.logger
+import api.metrics
 import api.problem
 import api.problem_feedback
 import api.scoreboards
@@ -77,6 +82,9 @@ def create_app(config=None):
     for k, v in config.items():
         app.config[k] = v
 
+    if app.config["JSON_FAST_ENCODER"]:
+        app.json_encoder = api.json_encoder.FastJSONEncoder
+
     # Add any new runtime settings to DB
     with app.app_context():
         api.config.merge_new_settings()
@@ -114,6 +122,10 @@ def create_app(config=None):
     with app.app_context():
         api.logger.setup_logs({"verbose": 2})
 
+    @app.before_request
+    def before_request():
+        api.metrics.start_request()
+
     # Register a post-request function
     @app.after_request
     def after_request(response):
@@ -122,8 +134,10 @@ def create_app(config=None):
         )
         response.headers.add("Access-Control-Allow-Credentials", "true")
         response.headers.add("Access-Control-Allow-Headers", "Content-Type, *")
-        response.headers.add("Cache-Control", "no-cache")
-        response.headers.add("Cache-Control", "no-store")
+        # Endpoints without their own cache policy must not be stored
+        if "Cache-Control" not in response.headers:
+            response.headers.add("Cache-Control", "no-cache")
+            response.headers.add("Cache-Control", "no-store")
         with app.app_context():
             if app.debug:
                 response.headers.add("Access-Control-Allow-Origin", "*")
@@ -140,6 +154,8 @@ def create_app(config=None):
                 session["token"] = csrf_token
             response.set_cookie("token", session["token"], domain=domain)
 
-        return response
+        api.user.set_rate_limit_headers(response)
+        response = api.compression.compress_response(response)
+        return api.metrics.finish_request(response)
 
     return app
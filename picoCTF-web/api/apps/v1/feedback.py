@@ -95,6 +95,6 @@ class FeedbackList(Resource):
 
         return jsonify(
             api.problem_feedback.get_problem_feedback(
-                pid=req["pid"], tid=req["tid"], uid=req["uid"]
+                pid=req["pid"], tid=req["tid"], uid=req["uid"], analytics=True
             )
         )
@@ -3,6 +3,7 @@ import base64
 import csv
 import io
 import string
+from functools import wraps
 
 import api
 from api import (
@@ -10,9 +11,11 @@ from api import (
     check_csrf,
     PicoException,
     rate_limit,
+    require_admin,
     require_login,
     require_teacher,
 )
+from api.cache import conditional, get_scoreboard_cache
 from bs4 import UnicodeDammit
 from flask import jsonify
 from flask_restplus import Namespace, Resource
@@ -33,13 +36,43 @@ from .schemas import (
     group_modify_team_req,
     group_patch_req,
     group_req,
+    historical_scoreboard_req,
     score_progressions_req,
     scoreboard_page_req,
 )
+from .scoreboards import snapshot_response
 
 ns = Namespace("groups", description="Group management")
 
 
+def require_group_member(f):
+    """
+    Wrap group routing functions that require membership of the group.
+
+    Admins may access any group. Placed before conditional, so that cached
+    responses are not served to anyone else.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        group = api.group.get_group(gid=kwargs["group_id"])
+        if not group:
+            raise PicoException("Classroom not found", 404)
+        group_members = [group["owner"]] + group["members"] + group["teachers"]
+
+        curr_user = api.user.get_user()
+        if not curr_user or (
+            curr_user["tid"] not in group_members and not curr_user["admin"]
+        ):
+            raise PicoException(
+                "You do not have permission to " + "view this classroom's scoreboard.",
+                403,
+            )
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
 @ns.route("")
 class GroupList(Resource):
     """Get the list of your groups, or create a new group."""
@@ -471,52 +504,103 @@ class BatchRegistrationResponse(Resource):
 
         # Batch-register accounts
         curr_teacher = api.user.get_user()
+        if req["background"]:
+            job_id = api.group.start_batch_registration(
+                students, curr_teacher, group_id
+            )
+            res = jsonify({"success": True, "job_id": job_id})
+            res.status_code = 202
+            return res
+
         created_accounts = api.group.batch_register(students, curr_teacher, group_id)
+        return _batch_registration_response(students, created_accounts)
 
-        if len(created_accounts) != len(students):
-            raise PicoException(
-                "An error occurred while adding student accounts. "
-                + f"The first {len(created_accounts)} were created. "
-                + "Please contact an administrator."
-            )
 
-        output = []
-        for i in range(len(students)):
-            output.append(
+@ns.route("/<string:group_id>/batch_registration/<string:job_id>")
+class BatchRegistrationProgress(Resource):
+    """Get the progress of a background batch registration."""
+
+    @require_login
+    @ns.response(200, "Success")
+    @ns.response(401, "Not logged in")
+    @ns.response(404, "Batch registration not found")
+    @ns.response(409, "Batch registration failed")
+    def get(self, group_id, job_id):
+        """
+        Get the progress of a background batch registration.
+
+        Once it has finished, returns the created accounts in the same format
+        as a synchronous batch registration. The account credentials are only
+        returned once.
+        """
+        curr_user = api.user.get_user()
+        job = api.group.get_batch_registration(job_id)
+        if (
+            job is None
+            or job["gid"] != group_id
+            or (job["uid"] != curr_user["uid"] and not curr_user["admin"])
+        ):
+            raise PicoException("Batch registration not found", 404)
+
+        if job["status"] == "running":
+            return jsonify(
                 {
-                    "Grade (1-12)": students[i]["current_year"],
-                    "Age (13-17 or 18+)": students[i]["age"],
-                    "Gender": students[i]["gender"],
-                    "Parent Email (if under 18)": students[i]["parent_email"],
-                    "Username": created_accounts[i]["username"],
-                    "Password": created_accounts[i]["password"],
+                    "success": True,
+                    "status": "running",
+                    "total": job["total"],
+                    "completed": job["completed"],
                 }
             )
 
-        buffer = io.StringIO()
-        csv_writer = csv.DictWriter(
-            buffer,
-            [
-                "Grade (1-12)",
-                "Age (13-17 or 18+)",
-                "Gender",
-                "Parent Email (if under 18)",
-                "Username",
-                "Password",
-            ],
-        )
-        csv_writer.writeheader()
-        csv_writer.writerows(output)
-        output_csv_bytes = buffer.getvalue().encode("utf-8")
+        job = api.group.get_batch_registration(job_id, pop_result=True)
+        if job is None or job["status"] == "failed":
+            raise PicoException(
+                job["error"] if job else "Batch registration not found",
+                409 if job else 404,
+            )
+        return _batch_registration_response(job["students"], job["accounts"])
 
-        return jsonify(
+
+def _batch_registration_response(students, created_accounts):
+    """Return the created accounts, also as the uploaded CSV with credentials."""
+    output = []
+    for i in range(len(students)):
+        output.append(
             {
-                "success": True,
-                "accounts": created_accounts,
-                "as_csv": base64.b64encode(output_csv_bytes).decode("utf-8"),
+                "Grade (1-12)": students[i]["current_year"],
+                "Age (13-17 or 18+)": students[i]["age"],
+                "Gender": students[i]["gender"],
+                "Parent Email (if under 18)": students[i]["parent_email"],
+                "Username": created_accounts[i]["username"],
+                "Password": created_accounts[i]["password"],
             }
         )
 
+    buffer = io.StringIO()
+    csv_writer = csv.DictWriter(
+        buffer,
+        [
+            "Grade (1-12)",
+            "Age (13-17 or 18+)",
+            "Gender",
+            "Parent Email (if under 18)",
+            "Username",
+            "Password",
+        ],
+    )
+    csv_writer.writeheader()
+    csv_writer.writerows(output)
+    output_csv_bytes = buffer.getvalue().encode("utf-8")
+
+    return jsonify(
+        {
+            "success": True,
+            "status": "done",
+            "accounts": created_accounts,
+            "as_csv": base64.b64encode(output_csv_bytes).decode("utf-8"),
+        }
+    )
+
 
 @ns.route("/<string:group_id>/scoreboard")
 class ScoreboardPage(Resource):
@@ -531,28 +615,26 @@ class ScoreboardPage(Resource):
     @ns.response(200, "Success")
     @ns.response(403, "Permission denied")
     @ns.response(404, "Classroom not found")
-    @ns.response(422, "Competition has not started")
+    @ns.response(422, "Competition has not started or search is too short")
     @ns.expect(scoreboard_page_req)
+    @require_group_member
+    @conditional(lambda group_id: [get_scoreboard_cache(group_id=group_id).key])
     def get(self, group_id):
         """Retrieve a scoreboard page for a group."""
-        group = api.group.get_group(gid=group_id)
-        if not group:
-            raise PicoException("Classroom not found", 404)
-        group_members = [group["owner"]] + group["members"] + group["teachers"]
-
-        curr_user = api.user.get_user()
-        if not curr_user or (
-            curr_user["tid"] not in group_members and not curr_user["admin"]
-        ):
-            raise PicoException(
-                "You do not have permission to " + "view this classroom's scoreboard.",
-                403,
-            )
-
         req = scoreboard_page_req.parse_args(strict=True)
-        if req["search"] is not None:
+        # An empty search is unfiltered
+        search = req["search"] or None
+        if search is None:
+            snapshot = api.stats.get_scoreboard_snapshot_page(
+                {"group_id": group_id},
+                req["page"],
+                encoding=api.compression.negotiate_encoding(),
+            )
+            if snapshot is not None:
+                return snapshot_response(*snapshot)
+        if search is not None:
             page = api.stats.get_filtered_scoreboard_page(
-                {"group_id": group_id}, req["search"], req["page"] or 1
+                {"group_id": group_id}, search, req["page"] or 1
             )
         else:
             page = api.stats.get_scoreboard_page({"group_id": group_id}, req["page"])
@@ -561,12 +643,43 @@ class ScoreboardPage(Resource):
         )
 
 
+@ns.route("/<string:group_id>/history")
+class HistoricalScoreboardPage(Resource):
+    """Get a scoreboard page for a group as it stood at a given time."""
+
+    @require_admin
+    @ns.response(200, "Success")
+    @ns.response(400, "Error parsing request")
+    @ns.response(401, "Not logged in")
+    @ns.response(403, "Not authorized")
+    @ns.response(404, "Classroom not found")
+    @ns.expect(historical_scoreboard_req)
+    def get(self, group_id):
+        """Retrieve a group scoreboard page as of the specified time."""
+        req = historical_scoreboard_req.parse_args(strict=True)
+        group = api.group.get_group(gid=group_id)
+        if not group:
+            raise PicoException("Classroom not found", 404)
+        page = api.stats.get_historical_scoreboard_page(
+            req["time"], req["page"], group_id=group_id
+        )
+        return jsonify(
+            {
+                "scoreboard": page[0],
+                "current_page": page[1],
+                "total_pages": page[2],
+                "time": req["time"],
+            }
+        )
+
+
 @ns.route("/<string:group_id>/score_progressions")
 class ScoreProgressionsResult(Resource):
     """Get a list of score progressions for the top n teams in a group."""
 
     @block_before_competition
     @ns.response(200, "Success")
+    @ns.response(400, "align requires max_points")
     @ns.response(403, "Permission denied")
     @ns.response(404, "Classroom not found")
     @ns.response(422, "Competition has not started")
@@ -574,6 +687,8 @@ class ScoreProgressionsResult(Resource):
     def get(self, group_id):
         """Get a list of teams' score progressions."""
         req = score_progressions_req.parse_args(strict=True)
+        if req["align"] and not req["max_points"]:
+            raise PicoException("align requires max_points", 400)
         group = api.group.get_group(gid=group_id)
         if not group:
             raise PicoException("Classroom not found", 404)
@@ -592,8 +707,11 @@ class ScoreProgressionsResult(Resource):
             not api.user.is_logged_in() or not api.user.get_user()["admin"]
         ):
             raise PicoException("Must be admin to specify limit", 403)
-        return jsonify(
-            api.stats.get_top_teams_score_progressions(
-                limit=(req["limit"] or 5), group_id=group_id
-            )
+        progressions = api.stats.get_top_teams_score_progressions(
+            limit=(req["limit"] or 5), group_id=group_id
         )
+        if req["max_points"]:
+            progressions = api.stats.resample_top_teams_score_progressions(
+                progressions, req["max_points"], align=req["align"]
+            )
+        return jsonify(progressions)
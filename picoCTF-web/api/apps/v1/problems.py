@@ -24,12 +24,29 @@ from flask_restplus import Namespace, Resource
 
 import api
 from api import block_before_competition, PicoException, require_admin, require_login
+from api.cache import conditional
 
 from .schemas import problem_patch_req, problems_req, shell_server_out
 
 ns = Namespace("problems", description="Problem management")
 
 
+def _problem_list_versions():
+    """Get the versions that the current user's problem list derives from."""
+    curr_user = api.user.get_user()
+    versions = [
+        "problems",
+        "settings",
+        "shell_servers",
+        "team:{}".format(curr_user["tid"]),
+        "user:{}".format(curr_user["uid"]),
+    ]
+    # Only admins' problem lists include feedback counts
+    if curr_user.get("admin", False):
+        versions.append("problem_feedback")
+    return versions
+
+
 @ns.response(400, "Error parsing request")
 @ns.response(401, "Not logged in")
 @ns.response(403, "Not authorized")
@@ -44,6 +61,7 @@ class ProblemList(Resource):
     @ns.response(403, "Unauthorized")
     @ns.response(422, "Competition has not started")
     @ns.expect(problems_req)
+    @conditional(_problem_list_versions)
     def get(self):
         """
         Get the list of problems, with optional filtering.
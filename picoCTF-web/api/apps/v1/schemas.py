@@ -801,6 +801,26 @@ scoreboard_page_req.add_argument(
     error="Search pattern must be a string",
 )
 
+# Historical scoreboard page request
+historical_scoreboard_req = reqparse.RequestParser()
+historical_scoreboard_req.add_argument(
+    "time",
+    required=True,
+    type=inputs.natural,
+    location="args",
+    help="Unix timestamp at which to calculate the scoreboard",
+    error="time must be a unix timestamp",
+)
+historical_scoreboard_req.add_argument(
+    "page",
+    required=False,
+    default=1,
+    type=inputs.positive,
+    location="args",
+    help="Scoreboard page to return",
+    error="page must be a positive integer",
+)
+
 # Score progressions request
 score_progressions_req = reqparse.RequestParser()
 score_progressions_req.add_argument(
@@ -811,6 +831,25 @@ score_progressions_req.add_argument(
     help="The number of top teams' score progressions to return. "
     + "Must be an admin to use this argument.",
 )
+score_progressions_req.add_argument(
+    "max_points",
+    required=False,
+    type=inputs.positive,
+    location="args",
+    help="Downsample each score progression to at most this many points.",
+    error="max_points must be a positive integer",
+)
+score_progressions_req.add_argument(
+    "align",
+    required=False,
+    type=inputs.boolean,
+    default=False,
+    location="args",
+    help="Sample every score progression on a shared time grid of "
+    + "max_points points, rather than downsampling each independently. "
+    + "Requires max_points.",
+    error="align must be a boolean value",
+)
 
 # Group request
 group_req = reqparse.RequestParser()
@@ -915,6 +954,15 @@ batch_registration_req.add_argument(
     help="Modified copy of the provided batch import CSV",
     error="A valid CSV file is required",
 )
+batch_registration_req.add_argument(
+    "background",
+    type=inputs.boolean,
+    location="form",
+    required=False,
+    default=False,
+    help="Register the accounts in the background, reporting progress at "
+    + "the returned job's URL",
+)
 
 # User search schema
 user_search_req = reqparse.RequestParser()
@@ -993,3 +1041,37 @@ user_delete_req.add_argument(
     help="Deletion reason",
     error="The reason must be a string!",
 )
+
+# Streaming export schema
+export_req = reqparse.RequestParser()
+export_req.add_argument(
+    "format",
+    required=False,
+    type=str,
+    choices=["ndjson", "csv"],
+    default="ndjson",
+    location="args",
+    help="Output format of the export",
+    error='Export format must be one of: "ndjson", "csv"',
+)
+
+# Performance metrics request
+performance_req = reqparse.RequestParser()
+performance_req.add_argument(
+    "minutes",
+    required=False,
+    type=inputs.int_range(1, 60),
+    default=5,
+    location="args",
+    help="Number of recent minutes to report on",
+)
+
+slow_queries_req = reqparse.RequestParser()
+slow_queries_req.add_argument(
+    "limit",
+    required=False,
+    type=inputs.int_range(1, 500),
+    default=50,
+    location="args",
+    help="Maximum number of query shapes to return",
+)
@@ -2,19 +2,51 @@
 
 import api
 from api import block_before_competition, PicoException, require_admin
-from flask import jsonify
+from api.cache import conditional, get_scoreboard_cache
+from api.coalescing import coalesce
+from flask import jsonify, request, Response, stream_with_context
 from flask_restplus import Namespace, Resource
 
-from .schemas import score_progressions_req, scoreboard_page_req, scoreboard_req
+from .schemas import (
+    historical_scoreboard_req,
+    score_progressions_req,
+    scoreboard_page_req,
+    scoreboard_req,
+)
 
 ns = Namespace("scoreboards", description="Scoreboard management")
 
 
+def snapshot_response(body, encoding=None):
+    """
+    Serve a pre-rendered scoreboard page.
+
+    Its ETag is set by conditional, from the scoreboard's version and the
+    negotiated encoding.
+    """
+    response = Response(body, mimetype="application/json")
+    # Other clients may be sent the page with another encoding
+    response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def event_stream_response(events):
+    """Serve a generator of Server-Sent Events without buffering."""
+    response = Response(stream_with_context(events), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Disable nginx proxy buffering for this response
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @ns.route("")
 class ScoreboardList(Resource):
     """Get the list of all scoreboards, or add a new scoreboard."""
 
     @ns.response(200, "Success")
+    @conditional(lambda: ["scoreboards"], private=False)
     def get(self):
         """Get the list of all scoreboards."""
         return jsonify(api.scoreboards.get_all_scoreboards())
@@ -46,6 +78,7 @@ class Scoreboard(Resource):
 
     @ns.response(200, "Success")
     @ns.response(404, "Scoreboard not found")
+    @conditional(lambda scoreboard_id: ["scoreboards"], private=False)
     def get(self, scoreboard_id):
         """Get a specific scoreboard."""
         scoreboard = api.scoreboards.get_scoreboard(scoreboard_id)
@@ -65,17 +98,31 @@ class ScoreboardPage(Resource):
 
     @ns.response(200, "Success")
     @ns.response(404, "Scoreboard not found")
-    @ns.response(422, "Competition has not started")
+    @ns.response(422, "Competition has not started or search is too short")
     @ns.expect(scoreboard_page_req)
+    @conditional(
+        lambda scoreboard_id: [get_scoreboard_cache(scoreboard_id=scoreboard_id).key]
+    )
+    @coalesce(private=lambda scoreboard_id: not request.args.get("page"))
     def get(self, scoreboard_id):
         """Retrieve a scoreboard page for a scoreboard."""
         req = scoreboard_page_req.parse_args(strict=True)
+        # An empty search is unfiltered
+        search = req["search"] or None
+        if search is None:
+            snapshot = api.stats.get_scoreboard_snapshot_page(
+                {"scoreboard_id": scoreboard_id},
+                req["page"],
+                encoding=api.compression.negotiate_encoding(),
+            )
+            if snapshot is not None:
+                return snapshot_response(*snapshot)
         scoreboard = api.scoreboards.get_scoreboard(scoreboard_id)
         if not scoreboard:
             raise PicoException("Scoreboard not found", 404)
-        if req["search"] is not None:
+        if search is not None:
             page = api.stats.get_filtered_scoreboard_page(
-                {"scoreboard_id": scoreboard_id}, req["search"], req["page"] or 1
+                {"scoreboard_id": scoreboard_id}, search, req["page"] or 1
             )
         else:
             page = api.stats.get_scoreboard_page(
@@ -86,18 +133,85 @@ class ScoreboardPage(Resource):
         )
 
 
+@ns.route("/<string:scoreboard_id>/events")
+class ScoreboardEvents(Resource):
+    """
+    Stream live updates to a scoreboard as Server-Sent Events.
+
+    "score" events carry the tid, new score and new rank of any team on the
+    scoreboard which gains points. Each user, or IP address if logged out, may
+    hold a limited number of streams. If logged in, "solve" events are also sent for the
+    current team's solves.
+    """
+
+    @block_before_competition
+    @ns.response(200, "Success")
+    @ns.response(404, "Scoreboard not found")
+    @ns.response(422, "Competition has not started")
+    @ns.response(429, "Too many open event streams")
+    def get(self, scoreboard_id):
+        """Subscribe to live updates for a scoreboard."""
+        scoreboard = api.scoreboards.get_scoreboard(scoreboard_id)
+        if not scoreboard:
+            raise PicoException("Scoreboard not found", 404)
+        if api.user.is_logged_in():
+            user = api.user.get_user()
+            client, tid = user["uid"], user["tid"]
+        else:
+            client, tid = request.remote_addr, None
+        token = api.events.open_stream(client)
+        events = api.events.stream_scoreboard_events(
+            scoreboard_id, client, token, tid=tid
+        )
+        return event_stream_response(events)
+
+
+@ns.route("/<string:scoreboard_id>/history")
+class HistoricalScoreboardPage(Resource):
+    """Get a results page for a scoreboard as it stood at a given time."""
+
+    @require_admin
+    @ns.response(200, "Success")
+    @ns.response(400, "Error parsing request")
+    @ns.response(401, "Not logged in")
+    @ns.response(403, "Not authorized")
+    @ns.response(404, "Scoreboard not found")
+    @ns.expect(historical_scoreboard_req)
+    def get(self, scoreboard_id):
+        """Retrieve a scoreboard page as of the specified time."""
+        req = historical_scoreboard_req.parse_args(strict=True)
+        scoreboard = api.scoreboards.get_scoreboard(scoreboard_id)
+        if not scoreboard:
+            raise PicoException("Scoreboard not found", 404)
+        page = api.stats.get_historical_scoreboard_page(
+            req["time"], req["page"], scoreboard_id=scoreboard_id
+        )
+        return jsonify(
+            {
+                "scoreboard": page[0],
+                "current_page": page[1],
+                "total_pages": page[2],
+                "time": req["time"],
+            }
+        )
+
+
 @ns.route("/<string:scoreboard_id>/score_progressions")
 class ScoreProgressionsResult(Resource):
     """Get a list of score progressions for the top n teams on a scoreboard."""
 
     @ns.response(200, "Success")
+    @ns.response(400, "align requires max_points")
     @ns.response(403, "Must be admin to specify limit")
     @ns.response(404, "Scoreboard not found")
     @ns.response(422, "Competition has not started")
     @ns.expect(score_progressions_req)
+    @coalesce(private=lambda scoreboard_id: bool(request.args.get("limit")))
     def get(self, scoreboard_id):
         """Get a list of teams' score progressions."""
         req = score_progressions_req.parse_args(strict=True)
+        if req["align"] and not req["max_points"]:
+            raise PicoException("align requires max_points", 400)
         scoreboard = api.scoreboards.get_scoreboard(scoreboard_id)
         if not scoreboard:
             raise PicoException("Scoreboard not found", 404)
@@ -105,8 +219,11 @@ class ScoreProgressionsResult(Resource):
             not api.user.is_logged_in() or not api.user.get_user()["admin"]
         ):
             raise PicoException("Must be admin to specify limit", 403)
-        return jsonify(
-            api.stats.get_top_teams_score_progressions(
-                limit=(req["limit"] or 5), scoreboard_id=scoreboard_id
-            )
+        progressions = api.stats.get_top_teams_score_progressions(
+            limit=(req["limit"] or 5), scoreboard_id=scoreboard_id
         )
+        if req["max_points"]:
+            progressions = api.stats.resample_top_teams_score_progressions(
+                progressions, req["max_points"], align=req["align"]
+            )
+        return jsonify(progressions)
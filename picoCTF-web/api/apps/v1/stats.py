@@ -1,16 +1,81 @@
 """Endpoints for getting statistical reports."""
+import csv
+import hmac
+import io
+import json
+
 import api
 from api import require_admin
-from flask import jsonify
+from api.coalescing import coalesce
+from flask import current_app, jsonify, request, Response, stream_with_context
 from flask_restplus import Namespace, Resource
 
+from .schemas import export_req, performance_req, slow_queries_req
+
 ns = Namespace("stats", "Statistical aggregations and reports")
 
+DEMOGRAPHIC_FIELDS = ["usertype", "country", "gender", "zipcode", "grade", "score"]
+USER_SCORE_FIELDS = ["name", "score"]
+ACTION_FIELDS = [
+    "time",
+    "event",
+    "success",
+    "api_endpoint",
+    "ip",
+    "browser",
+    "platform",
+    "username",
+    "team_name",
+    "groups",
+]
+
+
+def _export_response(rows, fields, export_format, filename):
+    """
+    Build a streaming response which emits rows as they are generated.
+
+    Args:
+        rows: iterable of row dicts
+        fields: ordered list of row fields (used for the CSV header)
+        export_format: "ndjson" or "csv"
+        filename: download filename, without extension
+    """
+
+    def generate_ndjson():
+        for row in rows:
+            yield json.dumps(row) + "\n"
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        yield buffer.getvalue()
+
+    if export_format == "csv":
+        generator, mimetype = generate_csv(), "text/csv"
+    else:
+        generator, mimetype = generate_ndjson(), "application/x-ndjson"
+    return Response(
+        stream_with_context(generator),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": "attachment; filename={}.{}".format(
+                filename, export_format
+            )
+        },
+    )
+
 
 @ns.route("/registration")
 class RegistrationStatus(Resource):
     """Get information on user, team, and group registrations."""
 
+    @coalesce()
     def get(self):
         """Get information on user, team, and group registrations."""
         return jsonify(api.stats.get_registration_count())
@@ -34,6 +99,77 @@ class SubmissionStatistics(Resource):
         )
 
 
+@ns.response(200, "Success")
+@ns.response(401, "Not logged in")
+@ns.response(403, "Not authorized")
+@ns.route("/coalescing")
+class CoalescingStatistics(Resource):
+    """View request coalescing statistics, broken down by endpoint."""
+
+    @require_admin
+    def get(self):
+        """Get the numbers of requests and computed responses per endpoint."""
+        return jsonify(api.coalescing.get_metrics())
+
+
+@ns.response(200, "Success")
+@ns.response(400, "Error parsing request")
+@ns.response(401, "Not logged in")
+@ns.response(403, "Not authorized")
+@ns.route("/performance")
+class PerformanceStatistics(Resource):
+    """View recent request performance, broken down by endpoint."""
+
+    @require_admin
+    @ns.expect(performance_req)
+    def get(self):
+        """Get recent percentiles of request durations and database work."""
+        req = performance_req.parse_args(strict=True)
+        return jsonify(api.metrics.get_recent_percentiles(minutes=req["minutes"]))
+
+
+@ns.response(200, "Success")
+@ns.response(400, "Error parsing request")
+@ns.response(401, "Not logged in")
+@ns.response(403, "Not authorized")
+@ns.route("/slow_queries")
+class SlowQueryStatistics(Resource):
+    """View the slowest database query shapes and where they are issued."""
+
+    @require_admin
+    @ns.expect(slow_queries_req)
+    def get(self):
+        """Get the query shapes which have spent the most time as slow queries."""
+        req = slow_queries_req.parse_args(strict=True)
+        return jsonify(api.metrics.get_slow_queries(limit=req["limit"]))
+
+
+@ns.response(200, "Success")
+@ns.response(401, "Not logged in")
+@ns.response(403, "Not authorized")
+@ns.route("/metrics")
+class PrometheusMetrics(Resource):
+    """
+    Export request performance histograms for Prometheus.
+
+    Available to admins, or with the METRICS_TOKEN as a bearer token.
+    """
+
+    def get(self):
+        """Get the per-endpoint histograms in the Prometheus text format."""
+        token = current_app.config["METRICS_TOKEN"]
+        authorization = request.headers.get("Authorization", "")
+        if token and hmac.compare_digest(authorization, "Bearer " + token):
+            return self.render()
+        return require_admin(self.render)()
+
+    def render(self):
+        return Response(
+            api.metrics.get_prometheus_metrics(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
 @ns.response(200, "Success")
 @ns.response(401, "Not logged in")
 @ns.response(403, "Not authorized")
@@ -45,3 +181,63 @@ class DemographicInformation(Resource):
     def get(self):
         """Get demographic information used in analytics."""
         return jsonify(api.stats.get_demographic_data())
+
+
+@ns.response(200, "Success")
+@ns.response(400, "Error parsing request")
+@ns.response(401, "Not logged in")
+@ns.response(403, "Not authorized")
+@ns.route("/demographics/export")
+class DemographicExport(Resource):
+    """Stream demographic information used in analytics."""
+
+    @require_admin
+    @ns.expect(export_req)
+    def get(self):
+        """Stream demographic information as NDJSON or CSV."""
+        req = export_req.parse_args(strict=True)
+        return _export_response(
+            api.stats.iter_demographic_data(),
+            DEMOGRAPHIC_FIELDS,
+            req["format"],
+            "demographics",
+        )
+
+
+@ns.response(200, "Success")
+@ns.response(400, "Error parsing request")
+@ns.response(401, "Not logged in")
+@ns.response(403, "Not authorized")
+@ns.route("/scores/export")
+class UserScoreExport(Resource):
+    """Stream the score of every user."""
+
+    @require_admin
+    @ns.expect(export_req)
+    def get(self):
+        """Stream every user's score as NDJSON or CSV (unsorted)."""
+        req = export_req.parse_args(strict=True)
+        return _export_response(
+            api.stats.iter_all_user_scores(),
+            USER_SCORE_FIELDS,
+            req["format"],
+            "user_scores",
+        )
+
+
+@ns.response(200, "Success")
+@ns.response(400, "Error parsing request")
+@ns.response(401, "Not logged in")
+@ns.response(403, "Not authorized")
+@ns.route("/actions/export")
+class ActionExport(Resource):
+    """Stream the log of API actions."""
+
+    @require_admin
+    @ns.expect(export_req)
+    def get(self):
+        """Stream every logged API action as NDJSON or CSV, oldest first."""
+        req = export_req.parse_args(strict=True)
+        return _export_response(
+            api.logger.iter_statistics(), ACTION_FIELDS, req["format"], "actions"
+        )
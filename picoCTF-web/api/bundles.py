@@ -94,5 +94,5 @@ def set_bundle_dependencies_enabled(bid, enabled):
     if not success:
         return None
     else:
-        api.cache.clear()
+        api.stats.clear_cache()
         return bid
@@ -1,45 +1,123 @@
 """Caching Library using redis."""
 
 import logging
+import os
 from functools import wraps
 
-from flask import current_app
+from flask import current_app, g, make_response, request, session
+from redis import ConnectionPool
 from walrus import Walrus
 
 import api
 import hashlib
+import json
 import pickle
 from api import PicoException
+from api.metrics import InstrumentedConnection
 
 log = logging.getLogger(__name__)
 
+# Display metadata of every team on a scoreboard, keyed by tid
+SCOREBOARD_TEAMS_KEY = "scoreboard_teams"
+
+# Scoreboard scores hold the score above this multiplier and a tie-break
+# below it
+SCORE_SHIFT = 2 ** 32
+
+# Length of the n-grams in scoreboard search indexes
+SEARCH_NGRAM_LEN = 3
+
+# Compares the team fields indexed for a scoreboard (KEYS[1]) to the current
+# ones (ARGV, as tid, fields pairs). Returns the tid and previously indexed
+# fields (false if new) of each team which was added, changed or removed.
+DIFF_SEARCH_INDEX_SCRIPT = """
+local current = {}
+local changes = {}
+for i = 1, #ARGV, 2 do
+    current[ARGV[i]] = true
+    local indexed = redis.call("HGET", KEYS[1], ARGV[i])
+    if indexed ~= ARGV[i + 1] then
+        table.insert(changes, ARGV[i])
+        table.insert(changes, indexed)
+    end
+end
+for _, tid in ipairs(redis.call("HKEYS", KEYS[1])) do
+    if not current[tid] then
+        table.insert(changes, tid)
+        table.insert(changes, redis.call("HGET", KEYS[1], tid))
+    end
+end
+return changes
+"""
+__diff_search_index_script = {"conn": None, "script": None}
+
 __redis = {
     "walrus": None,
+    "state": None,
     "cache": None,
-    "zsets": {"scores": None},
+    "zsets": {"scores": None, "scoreboard_scores": None},
 }
 
 
-def get_conn():
-    """Get a redis connection, reusing one if it exists."""
+def _reset_after_fork():
+    """Forget the parent process's connections in a forked child."""
     global __redis
-    if __redis.get("walrus") is None:
-        conf = current_app.config
-        try:
-            __redis["walrus"] = Walrus(
+    __redis.update(
+        walrus=None,
+        state=None,
+        cache=None,
+        zsets={"scores": None, "scoreboard_scores": None},
+    )
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _connect(db):
+    """Connect to a redis database, instrumenting its commands."""
+    conf = current_app.config
+    try:
+        return Walrus(
+            connection_pool=ConnectionPool(
+                connection_class=InstrumentedConnection,
                 host=conf["REDIS_ADDR"],
                 port=conf["REDIS_PORT"],
                 password=conf["REDIS_PW"],
-                db=conf["REDIS_DB_NUMBER"],
-            )
-        except Exception as error:
-            raise PicoException(
-                "Internal server error. " + "Please contact a system administrator.",
-                data={"original_error": error},
+                db=db,
+                max_connections=conf["REDIS_MAX_CONNECTIONS"],
+                socket_timeout=conf["REDIS_SOCKET_TIMEOUT"],
+                socket_connect_timeout=conf["REDIS_CONNECT_TIMEOUT"],
             )
+        )
+    except Exception as error:
+        raise PicoException(
+            "Internal server error. " + "Please contact a system administrator.",
+            data={"original_error": error},
+        )
+
+
+def get_conn():
+    """Get a redis connection, reusing one if it exists."""
+    global __redis
+    if __redis.get("walrus") is None:
+        __redis["walrus"] = _connect(current_app.config["REDIS_DB_NUMBER"])
     return __redis["walrus"]
 
 
+def get_state_conn():
+    """
+    Get a redis connection to the state database, reusing one if it exists.
+
+    State such as rate limits, background job progress and leases is kept
+    apart from the cache, so that clearing the cache does not reset it.
+    """
+    global __redis
+    if __redis.get("state") is None:
+        __redis["state"] = _connect(current_app.config["REDIS_STATE_DB_NUMBER"])
+    return __redis["state"]
+
+
 def get_cache():
     """Get a walrus cache, reusing one if it exists."""
     global __redis
@@ -55,6 +133,13 @@ def get_score_cache():
     return __redis["zsets"]["scores"]
 
 
+def get_scoreboard_score_cache():
+    global __redis
+    if __redis["zsets"].get("scoreboard_scores") is None:
+        __redis["zsets"]["scoreboard_scores"] = get_conn().ZSet("scoreboard_scores")
+    return __redis["zsets"]["scoreboard_scores"]
+
+
 def get_scoreboard_cache(**kwargs):
     global __redis
     scoreboard_name = "scoreboard:{}".format(_hash_key((), kwargs))
@@ -107,42 +192,278 @@ def _hash_key(a, k):
     return hashlib.md5(pickle.dumps((a, k))).hexdigest()
 
 
-def get_scoreboard_key(team):
-    # For lack of better idea of delimiter, use '>' illegal team name char
-    return "{}>{}>{}".format(team["team_name"], team["affiliation"], team["tid"])
+def encode_scoreboard_score(score, last_solve_time):
+    """
+    Encode a team's score and last solve time as one integer.
+
+    Higher scores rank first, and equal scores are ranked by earliest last
+    solve. Values stay far below 2^53, so ZSets store them exactly.
+
+    Args:
+        score: the team's integer score
+        last_solve_time: unix timestamp of the team's last scoring solve
+    Returns:
+        score * 2^32 + (2^32 - 1 - last_solve_time), or 0 for no score
+    """
+    if score <= 0:
+        return 0
+    return score * SCORE_SHIFT + (SCORE_SHIFT - 1 - int(last_solve_time))
+
+
+def decode_scoreboard_score(value):
+    """Get the integer score from an encoded scoreboard score."""
+    return int(value) // SCORE_SHIFT
+
+
+def set_scoreboard_teams(teams):
+    """
+    Store the display metadata of teams appearing on scoreboards.
+
+    Args:
+        teams: list of team dicts
+    """
+    if not teams:
+        return
+    pipe = get_conn().pipeline(transaction=False)
+    for team in teams:
+        pipe.hset(
+            SCOREBOARD_TEAMS_KEY,
+            team["tid"],
+            json.dumps({"name": team["team_name"], "affiliation": team["affiliation"]}),
+        )
+    pipe.execute()
+
+
+def remove_scoreboard_teams(tids):
+    """
+    Remove the display metadata of teams which no longer appear on any
+    scoreboard.
+
+    Args:
+        tids: list of team ids
+    """
+    if tids:
+        get_conn().hdel(SCOREBOARD_TEAMS_KEY, *tids)
+
+
+def _get_scoreboard_teams(tids):
+    """Get the display metadata of teams, in the same order as tids."""
+    metadata = get_conn().hmget(SCOREBOARD_TEAMS_KEY, tids) if tids else []
+    return [json.loads(team) if team is not None else {} for team in metadata]
+
+
+def decode_scoreboard_items(items):
+    """
+    Attach display metadata to a range of scoreboard ZSet items.
+
+    Args:
+        items: list of (tid, encoded score) tuples
+    Returns:
+        list of dicts with name, affiliation, tid and integer score
+    """
+    tids = [item[0].decode("utf-8") for item in items]
+    return [
+        {
+            "name": team.get("name", ""),
+            "affiliation": team.get("affiliation", ""),
+            "tid": tid,
+            "score": decode_scoreboard_score(item[1]),
+        }
+        for tid, item, team in zip(tids, items, _get_scoreboard_teams(tids))
+    ]
+
+
+def _search_ngrams(*fields):
+    """Get the lowercased n-grams of some text fields."""
+    return {
+        field.lower()[i : i + SEARCH_NGRAM_LEN]
+        for field in fields
+        for i in range(len(field) - SEARCH_NGRAM_LEN + 1)
+    }
 
 
-def decode_scoreboard_item(item, with_weight=False, include_key=False):
+def _search_ngram_key(board_key, ngram):
+    return "{}:search:{}".format(board_key, ngram)
+
+
+def _search_fields_key(board_key):
+    return "{}:search".format(board_key)
+
+
+def index_scoreboard_teams(board_key, teams):
+    """
+    Update a scoreboard's search index to cover exactly the given teams.
+
+    The index maps each n-gram of a team's name and affiliation to the set
+    of tids containing it. The indexed fields of each team are kept
+    alongside and compared to the current ones in redis, so only the teams
+    which joined, left or were renamed since the last update are
+    transferred back and reindexed.
+
+    Args:
+        board_key: key of the scoreboard ZSet
+        teams: dict of tid to team dict, for every team on the scoreboard
+    Returns:
+        the tids of the teams which left the scoreboard
     """
-    :param item: tuple of ZSet (key, score)
-    :param with_weight: keep decimal weighting of score, or return as int
-    :param include_key: whether to include to raw key
-    :return: dict of scoreboard item
+    conn = get_conn()
+    fields_key = _search_fields_key(board_key)
+    current = {
+        tid: json.dumps([team["team_name"], team["affiliation"]])
+        for tid, team in teams.items()
+    }
+
+    if __diff_search_index_script["conn"] is not conn:
+        __diff_search_index_script["script"] = conn.register_script(
+            DIFF_SEARCH_INDEX_SCRIPT
+        )
+        __diff_search_index_script["conn"] = conn
+    diff = __diff_search_index_script["script"](
+        keys=[fields_key], args=[value for item in current.items() for value in item]
+    )
+    if not diff:
+        return []
+
+    removals, additions = {}, {}
+    changed, removed = {}, []
+    for tid, indexed in zip(diff[::2], diff[1::2]):
+        tid = tid.decode("utf-8")
+        if indexed is not None:
+            for ngram in _search_ngrams(*json.loads(indexed)):
+                removals.setdefault(ngram, []).append(tid)
+        if tid in current:
+            changed[tid] = current[tid]
+            for ngram in _search_ngrams(*json.loads(current[tid])):
+                additions.setdefault(ngram, []).append(tid)
+        else:
+            removed.append(tid)
+
+    pipe = conn.pipeline(transaction=False)
+    for ngram, tids in removals.items():
+        pipe.srem(_search_ngram_key(board_key, ngram), *tids)
+    for ngram, tids in additions.items():
+        pipe.sadd(_search_ngram_key(board_key, ngram), *tids)
+    if removed:
+        pipe.hdel(fields_key, *removed)
+    if changed:
+        pipe.hset(fields_key, mapping=changed)
+    pipe.execute()
+    return removed
+
+
+def delete_scoreboard(board_key):
     """
-    key = item[0].decode("utf-8")
-    data = key.split(">")
-    score = item[1]
-    if not with_weight:
-        score = int(score)
-    output = {"name": data[0], "affiliation": data[1], "tid": data[2], "score": score}
-    if include_key:
-        output["key"] = key
-    return output
+    Delete a scoreboard along with its search index.
+
+    Args:
+        board_key: key of the scoreboard ZSet
+    Returns:
+        the tids of the teams which were on the scoreboard
+    """
+    conn = get_conn()
+    fields_key = _search_fields_key(board_key)
+    indexed = conn.hgetall(fields_key)
+    ngrams = set()
+    for fields in indexed.values():
+        ngrams.update(_search_ngrams(*json.loads(fields)))
+    conn.delete(
+        board_key,
+        fields_key,
+        *[_search_ngram_key(board_key, ngram) for ngram in ngrams]
+    )
+    return [tid.decode("utf-8") for tid in indexed]
 
 
 def search_scoreboard_cache(scoreboard, pattern):
     """
-    :param scoreboard: scoreboard cache ZSet
-    :param pattern: text pattern to search team names and affiliations,
-                    not including wildcards
-    :return: sorted list of scoreboard entries
+    Search a scoreboard for teams by name or affiliation.
+
+    Patterns are looked up in the scoreboard's search index, so only
+    candidate teams are examined. They must be at least SEARCH_NGRAM_LEN
+    characters long, as shorter ones cannot use the index.
+
+    Args:
+        scoreboard: scoreboard cache ZSet
+        pattern: text to search for in team names and affiliations
+    Returns:
+        list of matching scoreboard entries, including rank, in rank order
+    Raises:
+        PicoException: if the pattern is too short
     """
-    # Trailing '*>' avoids search on last token, tid
+    if len(pattern) < SEARCH_NGRAM_LEN:
+        raise PicoException(
+            "Search patterns must be at least {} characters long.".format(
+                SEARCH_NGRAM_LEN
+            ),
+            422,
+        )
+
+    conn = get_conn()
+    candidates = [
+        tid.decode("utf-8")
+        for tid in conn.sinter(
+            [
+                _search_ngram_key(scoreboard.key, ngram)
+                for ngram in _search_ngrams(pattern)
+            ]
+        )
+    ]
+    # The index is case-insensitive and matches n-grams anywhere in the
+    # fields, so confirm each candidate against its current metadata
+    matches = [
+        (tid, team)
+        for tid, team in zip(candidates, _get_scoreboard_teams(candidates))
+        if pattern in team.get("name", "") or pattern in team.get("affiliation", "")
+    ]
+
+    pipe = conn.pipeline(transaction=False)
+    for tid, _ in matches:
+        pipe.zrevrank(scoreboard.key, tid)
+        pipe.zscore(scoreboard.key, tid)
+    positions = pipe.execute() if matches else []
     results = [
-        decode_scoreboard_item(item, with_weight=True, include_key=True)
-        for item in list(scoreboard.search("*{}*>*".format(pattern)))
+        {
+            "name": team["name"],
+            "affiliation": team["affiliation"],
+            "tid": tid,
+            "score": decode_scoreboard_score(score),
+            "rank": rank + 1,
+        }
+        for (tid, team), rank, score in zip(matches, positions[::2], positions[1::2])
+        if rank is not None
     ]
-    return sorted(results, key=lambda item: item["score"], reverse=True)
+    return sorted(results, key=lambda item: item["rank"])
+
+
+def fenced_write(key, write):
+    """
+    Apply writes to a resource, unless a newer writer has written it.
+
+    Writers fenced by the stats scheduler carry its fencing token in
+    flask.g.fencing_token. The newest token to write each resource is stored
+    beside it, and writes under an older token are discarded. Other writes
+    are always applied.
+
+    Args:
+        key: the resource's key
+        write: function adding the writes to a transactional pipeline
+    Returns:
+        whether the writes were applied
+    """
+    token = g.get("fencing_token")
+    fence_key = "fence:{}".format(key)
+
+    def apply(pipe):
+        newest = pipe.get(fence_key)
+        if token is not None and newest is not None and int(newest) > token:
+            return False
+        pipe.multi()
+        if token is not None:
+            pipe.set(fence_key, token)
+        write(pipe)
+        return True
+
+    return get_conn().transaction(apply, fence_key, value_from_callable=True)
 
 
 def invalidate(f, *args, **kwargs):
@@ -153,6 +474,90 @@ def invalidate(f, *args, **kwargs):
     if f == api.stats.get_score:
         key = args[0]
         get_score_cache().remove(key)
+        get_scoreboard_score_cache().remove(key)
     else:
         key = "%s:%s" % (f.__name__, _hash_key(args, kwargs))
         get_cache().delete(key)
+
+
+def get_versions(names):
+    """
+    Get the current version tokens of some versioned resources.
+
+    Versions are random tokens rather than counters, so that a flushed cache
+    can never reproduce the version of some earlier state.
+
+    Args:
+        names: list of version names
+    Returns:
+        list of version tokens, in the same order
+    """
+    conn = get_conn()
+    keys = ["version:{}".format(name) for name in names]
+    versions = conn.mget(keys) if keys else []
+    missing = [key for key, version in zip(keys, versions) if version is None]
+    if missing:
+        pipe = conn.pipeline()
+        for key in missing:
+            pipe.set(key, api.common.token(), nx=True)
+        pipe.mget(keys)
+        versions = pipe.execute()[-1]
+    return [version.decode("utf-8") for version in versions]
+
+
+def bump_version(*names):
+    """Assign new version tokens to versioned resources."""
+    pipe = get_conn().pipeline()
+    for name in names:
+        pipe.set("version:{}".format(name), api.common.token())
+    pipe.execute()
+
+
+def conditional(versions, private=True):
+    """
+    Serve a GET resource with a version-derived ETag.
+
+    The ETag is derived from the request path and query, the current tokens
+    of the resource's versions, the negotiated content encoding and, for
+    private resources, the current user.
+    Requests whose If-None-Match matches it are answered with a 304 without
+    calling the wrapped function. Responses may be stored, but must be
+    revalidated before reuse.
+
+    Should be placed after any authorization decorators.
+
+    Args:
+        versions: function of the view arguments, returning the list of
+                  version names that the resource is derived from
+        private: whether the resource varies by user
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag_parts = [request.full_path] + get_versions(versions(**kwargs))
+            encoding = api.compression.negotiate_encoding()
+            if encoding is not None:
+                etag_parts.append(encoding)
+            if private:
+                etag_parts.append(session.get("uid", ""))
+            etag = api.common.hash("|".join(etag_parts))
+
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            # Weak, as the body may be compressed differently per request
+            response.set_etag(etag, weak=True)
+            response.cache_control.no_cache = True
+            if private:
+                response.cache_control.private = True
+            else:
+                response.cache_control.public = True
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,142 @@
+"""
+Request coalescing for idempotent GET endpoints.
+
+Concurrent identical requests handled by the same worker process share a
+single computation: the first request computes the response, and the others
+wait for it and are sent copies of its status, headers and body bytes.
+Requests are identical if they have the same path, query, validators and
+negotiated encoding, and come from the same class of client.
+"""
+
+import logging
+import threading
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+
+import api
+
+log = logging.getLogger(__name__)
+
+METRICS_KEY = "coalescing"
+
+__in_flight = {}
+__lock = threading.Lock()
+
+
+class _Computation:
+    """A response being computed on behalf of one or more requests."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+def _request_key(private):
+    """Identify the current request, for the purpose of sharing responses."""
+    if private:
+        client = "uid:{}".format(session.get("uid", ""))
+    else:
+        client = "user" if "uid" in session else "anonymous"
+    return (
+        request.endpoint,
+        request.full_path,
+        request.headers.get("If-None-Match", ""),
+        api.compression.negotiate_encoding(),
+        client,
+    )
+
+
+def _record(endpoint, requests, computed):
+    """Add to an endpoint's shared request and computation counters."""
+    try:
+        pipe = api.cache.get_conn().pipeline(transaction=False)
+        pipe.hincrby(METRICS_KEY, "{}:requests".format(endpoint), requests)
+        pipe.hincrby(METRICS_KEY, "{}:computed".format(endpoint), computed)
+        pipe.execute()
+    except Exception as e:
+        log.error("Failed to record coalescing metrics: {}".format(e))
+
+
+def get_metrics():
+    """
+    Get the coalescing counters of every coalesced endpoint.
+
+    Returns:
+        dict of endpoint name to a dict of its number of requests, number of
+        computed responses, and the ratio of requests to computations
+    """
+    metrics = {}
+    for field, value in api.cache.get_conn().hgetall(METRICS_KEY).items():
+        endpoint, counter = field.decode("utf-8").rsplit(":", 1)
+        metrics.setdefault(endpoint, {"requests": 0, "computed": 0})
+        metrics[endpoint][counter] = int(value)
+    for endpoint in metrics.values():
+        endpoint["ratio"] = (
+            endpoint["requests"] / endpoint["computed"] if endpoint["computed"] else 0
+        )
+    return metrics
+
+
+def coalesce(private=False):
+    """
+    Share the response to a GET request with identical concurrent requests.
+
+    Should be placed after any authorization and conditional decorators, and
+    only used on endpoints with non-streamed responses which depend on
+    nothing but the request key and, if private, the current user.
+
+    Args:
+        private: whether the response varies by user. May be a function of
+                 the view arguments, returning whether this request does
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not current_app.config["COALESCING_ENABLED"]:
+                return f(*args, **kwargs)
+            key = _request_key(private(**kwargs) if callable(private) else private)
+
+            with __lock:
+                computation = __in_flight.get(key)
+                leader = computation is None
+                if leader:
+                    computation = __in_flight[key] = _Computation()
+                else:
+                    computation.waiters += 1
+
+            if not leader:
+                if computation.done.wait(current_app.config["COALESCING_TIMEOUT"]):
+                    if computation.error is not None:
+                        raise computation.error
+                    body, status, headers = computation.result
+                    return current_app.response_class(
+                        body, status=status, headers=headers
+                    )
+                # The computation is taking too long, so do it ourselves
+                _record(request.endpoint, 0, 1)
+                return f(*args, **kwargs)
+
+            try:
+                response = make_response(f(*args, **kwargs))
+                computation.result = (
+                    response.get_data(),
+                    response.status_code,
+                    list(response.headers),
+                )
+                return response
+            except Exception as e:
+                computation.error = e
+                raise
+            finally:
+                with __lock:
+                    del __in_flight[key]
+                computation.done.set()
+                _record(request.endpoint, computation.waiters + 1, 1)
+
+        return wrapper
+
+    return decorator
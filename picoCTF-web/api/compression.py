@@ -0,0 +1,117 @@
+"""
+Response compression.
+
+Bodies are compressed with brotli (if installed) or gzip, as negotiated via
+the Accept-Encoding header. Small, streamed and already-encoded responses
+are sent as-is.
+"""
+
+import gzip
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def available_encodings():
+    """Get the supported content encodings, in order of preference."""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress(data, encoding, level=None):
+    """
+    Compress a body with the given content encoding.
+
+    Args:
+        data: bytes to compress
+        encoding: "br" or "gzip"
+        level: Optional, compression level (defaults to COMPRESSION_LEVEL)
+    Returns:
+        the compressed bytes
+    """
+    if level is None:
+        level = current_app.config["COMPRESSION_LEVEL"]
+    if encoding == "br":
+        # Brotli quality ranges from 0 to 11, rather than 1 to 9
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level)
+
+
+def negotiate_encoding():
+    """
+    Choose a content encoding for the current request.
+
+    Returns:
+        the client's most preferred supported encoding, or None if it accepts
+        none or compression is disabled
+    """
+    if not current_app.config["COMPRESSION_ENABLED"]:
+        return None
+    return request.accept_encodings.best_match(available_encodings())
+
+
+def is_compressible(mimetype, size):
+    """
+    Check whether a body is worth compressing under the current config.
+
+    Args:
+        mimetype: the body's mimetype
+        size: the body's length in bytes
+    Returns:
+        whether compression is enabled for bodies of this type and size
+    """
+    config = current_app.config
+    return (
+        config["COMPRESSION_ENABLED"]
+        and mimetype in config["COMPRESSION_MIMETYPES"]
+        and size >= config["COMPRESSION_MIN_SIZE"]
+    )
+
+
+def compress_response(response):
+    """
+    Compress a response body, if worthwhile and accepted by the client.
+
+    Args:
+        response: a Flask response
+    Returns:
+        the (possibly modified) response
+    """
+    config = current_app.config
+    if not config["COMPRESSION_ENABLED"]:
+        return response
+
+    # The representation now depends on Accept-Encoding, even if this one
+    # happens not to be compressed
+    if response.mimetype in config["COMPRESSION_MIMETYPES"]:
+        response.vary.add("Accept-Encoding")
+
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.content_length is None
+        or not is_compressible(response.mimetype, response.content_length)
+    ):
+        return response
+
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    weaken_etag(response)
+    return response
+
+
+def weaken_etag(response):
+    """Mark a response's ETag as weak, as its bytes depend on the encoding."""
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
@@ -210,6 +210,11 @@ The {competition_name} Team""",  # noqa (79char)
             "c3": 20,
         },
     },
+    # SCOREBOARD SNAPSHOTS
+    "scoreboard_snapshots": {
+        "enable_snapshots": False,
+        "snapshot_interval": 60,  # Seconds between snapshots until end_time
+    },
     # RATE LIMITING
     "enable_rate_limiting": True,
     # GROUP LIMIT
@@ -282,6 +287,7 @@ def change_settings(changes):
     check_keys(settings, changes)
     db = api.db.get_conn()
     db.settings.find_one_and_update({}, {"$set": changes})
+    api.cache.bump_version("settings")
 
 
 def check_competition_active():
@@ -1,19 +1,50 @@
 """Handles database interaction."""
 
 import logging
+import os
+from urllib.parse import parse_qsl
 
 from flask import current_app
 
 import pymongo
-from pymongo.collation import Collation, CollationStrength
+from pymongo import read_preferences
 from pymongo.errors import PyMongoError
 
 from api import PicoException
+from api.metrics import MongoCommandListener
+from api.migrations import check_schema
 
 log = logging.getLogger(__name__)
 
+READ_PREFERENCES = {
+    "primary": read_preferences.Primary,
+    "primaryPreferred": read_preferences.PrimaryPreferred,
+    "secondary": read_preferences.Secondary,
+    "secondaryPreferred": read_preferences.SecondaryPreferred,
+    "nearest": read_preferences.Nearest,
+}
+
 __connection = None
 __client = None
+__analytics_connections = {}
+
+
+def _reset_after_fork():
+    """
+    Forget the parent process's client in a forked child.
+
+    MongoClient is not fork-safe, so a child must not use the sockets or
+    monitor threads of a client created before the fork (e.g. by
+    create_app() in a preloading gunicorn master).
+    """
+    global __client, __connection
+    __client = None
+    __connection = None
+    __analytics_connections.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
 
 
 def get_conn():
@@ -44,7 +75,20 @@ def get_conn():
                 conf["MONGO_ADDR"], conf["MONGO_PORT"], conf["MONGO_DB_NAME"]
             )
         try:
-            __client = pymongo.MongoClient(uri)
+            __client = pymongo.MongoClient(
+                uri,
+                connect=False,
+                maxPoolSize=conf["MONGO_MAX_POOL_SIZE"],
+                waitQueueTimeoutMS=conf["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+                serverSelectionTimeoutMS=conf["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+                connectTimeoutMS=conf["MONGO_CONNECT_TIMEOUT_MS"],
+                socketTimeoutMS=conf["MONGO_SOCKET_TIMEOUT_MS"],
+                event_listeners=[
+                    MongoCommandListener(
+                        slow_query_threshold=conf["SLOW_QUERY_THRESHOLD_MS"]
+                    )
+                ],
+            )
             __connection = __client[conf["MONGO_DB_NAME"]]
         except PyMongoError as error:
             raise PicoException(
@@ -52,78 +96,74 @@ def get_conn():
                 data={"original_error": error},
             )
 
-        log.debug("Ensuring mongo is indexed.")
+        log.debug("Checking mongo schema version.")
+        check_schema(__connection, conf)
 
-        __connection.exceptions.create_index([("time", pymongo.DESCENDING)])
+    return __connection
 
-        __connection.users.create_index("uid", unique=True, name="unique uid")
-        __connection.users.create_index(
-            "username", unique=True, name="unique usernames"
-        )
-        __connection.users.create_index(
-            "username",
-            unique=True,
-            collation=Collation(locale="en", strength=CollationStrength.PRIMARY),
-            name="unique normalized usernames",
-        )
-        __connection.users.create_index("tid")
-        __connection.users.create_index("email")
-        __connection.users.create_index("demo.parentemail")
-
-        __connection.groups.create_index("gid", unique=True, name="unique gid")
-        __connection.groups.create_index("owner", name="owner")
-        __connection.groups.create_index("teachers", name="teachers")
-        __connection.groups.create_index("members", name="members")
-        __connection.groups.create_index(
-            [("owner", 1), ("name", 1)], unique=True, name="name and owner"
-        )
 
-        __connection.problems.create_index("pid", unique=True, name="unique pid")
-        __connection.problems.create_index("disabled")
-        __connection.problems.create_index(
-            [("score", pymongo.ASCENDING), ("name", pymongo.ASCENDING)]
-        )
+def parse_read_settings(settings):
+    """
+    Parse a read preference given as connection string options.
+
+    Args:
+        settings: readPreference, maxStalenessSeconds and readPreferenceTags
+                  options, in the format of MONGO_REPLICA_SETTINGS, e.g.
+                  "readPreference=secondary&maxStalenessSeconds=120"
+    Returns:
+        the read preference
+    Raises:
+        ValueError if the settings are invalid
+    """
+    options = parse_qsl(settings or "", keep_blank_values=True)
+    mode = "primary"
+    max_staleness = -1
+    tag_sets = []
+    for option, value in options:
+        if option == "readPreference":
+            mode = value
+        elif option == "maxStalenessSeconds":
+            max_staleness = int(value)
+        elif option == "readPreferenceTags":
+            tag_sets.append(
+                dict(tag.split(":", 1) for tag in value.split(",")) if value else {}
+            )
+        else:
+            raise ValueError("Unsupported read setting: {}".format(option))
+    if mode not in READ_PREFERENCES:
+        raise ValueError("Unknown read preference: {}".format(mode))
+    if mode == "primary":
+        if max_staleness != -1 or tag_sets:
+            raise ValueError("Primary reads take no staleness or tags")
+        return read_preferences.Primary()
+    return READ_PREFERENCES[mode](
+        tag_sets=tag_sets or None, max_staleness=max_staleness
+    )
+
+
+def get_analytics_conn(function):
+    """
+    Get the database connection an analytics function should read from.
 
-        __connection.scoreboards.create_index(
-            "sid", unique=True, name="unique scoreboard sid"
-        )
+    Functions listed in MONGO_ANALYTICS_FUNCTIONS read with the
+    MONGO_ANALYTICS_READ_SETTINGS read preference, so that on a replica set
+    their scans can be served by secondaries, or by members tagged as
+    analytics nodes, instead of competing with writes on the primary. Their
+    results may lag behind recent writes by up to the configured
+    maxStalenessSeconds. Other functions read from the primary.
 
-        __connection.shell_servers.create_index(
-            "sid", unique=True, name="unique shell sid"
-        )
+    Args:
+        function: name of the calling analytics function
+    Raises:
+        PicoException if a successful connection cannot be established
 
-        __connection.submissions.create_index([("pid", 1), ("uid", 1), ("correct", 1)])
-        __connection.submissions.create_index([("pid", 1), ("tid", 1), ("correct", 1)])
-        __connection.submissions.create_index([("uid", 1), ("correct", 1)])
-        __connection.submissions.create_index([("tid", 1), ("correct", 1)])
-        __connection.submissions.create_index([("pid", 1), ("correct", 1)])
-        __connection.submissions.create_index("uid")
-        __connection.submissions.create_index("tid")
-        __connection.submissions.create_index("suspicious")
-
-        __connection.teams.create_index(
-            "team_name", unique=True, name="unique team_names"
-        )
-        __connection.teams.create_index(
-            "team_name",
-            unique=True,
-            collation=Collation(locale="en", strength=CollationStrength.PRIMARY),
-            name="unique normalized team names",
-        )
-        __connection.teams.create_index("tid", unique=True, name="unique tid")
-        __connection.teams.create_index(
-            "eligibilities",
-            name="non-empty eligiblity",
-            partialFilterExpression={"size": {"$gt": 0}},
-        )
-        __connection.teams.create_index(
-            "size", name="non-empty size", partialFilterExpression={"size": {"$gt": 0}}
+    """
+    conf = current_app.config
+    if function not in conf["MONGO_ANALYTICS_FUNCTIONS"]:
+        return get_conn()
+    settings = conf["MONGO_ANALYTICS_READ_SETTINGS"]
+    if settings not in __analytics_connections:
+        __analytics_connections[settings] = get_conn().with_options(
+            read_preference=parse_read_settings(settings)
         )
-
-        __connection.tokens.create_index("uid")
-        __connection.tokens.create_index("gid")
-        __connection.tokens.create_index("tokens.registration_token")
-        __connection.tokens.create_index("tokens.email_verification")
-        __connection.tokens.create_index("tokens.password_reset")
-
-    return __connection
+    return __analytics_connections[settings]
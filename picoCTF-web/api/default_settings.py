@@ -11,11 +11,100 @@ MONGO_USER = None
 MONGO_PW = None
 MONGO_REPLICA_SETTINGS = None
 MONGO_TLS_SETTINGS = None
+# Apply pending index migrations when a worker connects, rather than only
+# with daemons/migrate_db.py
+MONGO_AUTO_MIGRATE = False
+# Connection pool limits and timeouts, in ms (None waits indefinitely)
+MONGO_MAX_POOL_SIZE = 100
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 10000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 10000
+MONGO_CONNECT_TIMEOUT_MS = 10000
+MONGO_SOCKET_TIMEOUT_MS = None
+# Read preference of the analytics functions in MONGO_ANALYTICS_FUNCTIONS,
+# as connection string options like MONGO_REPLICA_SETTINGS. For example,
+# "readPreference=secondaryPreferred&maxStalenessSeconds=120" offloads them
+# from the primary of a replica set, and adding
+# "&readPreferenceTags=nodeType:ANALYTICS" targets tagged analytics members.
+MONGO_ANALYTICS_READ_SETTINGS = None
+MONGO_ANALYTICS_FUNCTIONS = [
+    "get_historical_scoreboard",
+    "get_problem_feedback",
+    "get_problem_submission_stats",
+    "get_registration_count",
+    "iter_all_user_scores",
+    "iter_demographic_data",
+    "iter_statistics",
+]
 
 REDIS_DB_NUMBER = 0
 REDIS_ADDR = "127.0.0.1"
 REDIS_PORT = 6379
 REDIS_PW = None
+# Separate database for state which must survive cache flushes: rate limits,
+# background job progress and leases
+REDIS_STATE_DB_NUMBER = 1
+# Connections per pool (None for unlimited) and timeouts, in seconds. The
+# socket timeout also applies to idle event stream subscriptions, so should
+# be left unset unless redis is unreliable.
+REDIS_MAX_CONNECTIONS = None
+REDIS_SOCKET_TIMEOUT = None
+REDIS_CONNECT_TIMEOUT = 5
+
+# Seconds between keepalive comments on idle event streams
+EVENT_STREAM_KEEPALIVE = 15
+# Event streams which each user, or each IP address if logged out, may hold
+EVENT_STREAM_MAX_PER_CLIENT = 5
+
+# Compress response bodies of these types which are at least this large
+COMPRESSION_ENABLED = True
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_MIMETYPES = ["application/json", "text/csv", "text/plain"]
+
+# Share responses between identical concurrent requests to coalesced
+# endpoints, waiting at most this many seconds for a shared response
+COALESCING_ENABLED = True
+COALESCING_TIMEOUT = 10
+
+# Count and time the mongo and redis commands of each request, adding them
+# to per-endpoint histograms in redis every METRICS_FLUSH_INTERVAL seconds.
+# Per-minute histograms are kept for METRICS_WINDOW_RETENTION minutes.
+# Server-Timing headers are sent in debug mode or if METRICS_SERVER_TIMING.
+# If METRICS_TOKEN is set, it may be sent as a bearer token to read
+# /stats/metrics without logging in.
+METRICS_ENABLED = True
+METRICS_FLUSH_INTERVAL = 10
+METRICS_WINDOW_RETENTION = 60
+METRICS_SERVER_TIMING = False
+METRICS_TOKEN = None
+
+# Record mongo commands taking at least this many ms, or None to disable
+SLOW_QUERY_THRESHOLD_MS = 100
+
+# Encode JSON responses with orjson, if installed
+JSON_FAST_ENCODER = True
+
+# Write @log_action statistics in batches of STATISTICS_FLUSH_SIZE records,
+# or every STATISTICS_FLUSH_INTERVAL seconds. Records beyond
+# STATISTICS_BUFFER_SIZE, or whose write fails, are spilled to files in
+# STATISTICS_SPILL_DIR, or dropped if it is None. Statistics are written
+# synchronously when TESTING.
+STATISTICS_BUFFER_SIZE = 10000
+STATISTICS_FLUSH_SIZE = 500
+STATISTICS_FLUSH_INTERVAL = 2
+STATISTICS_SPILL_DIR = None
+
+# Days after which logged exceptions and statistics are deleted, or None to
+# keep them forever. Exceptions are kept until this long after they last
+# occurred.
+EXCEPTIONS_RETENTION_DAYS = 30
+STATISTICS_RETENTION_DAYS = None
+
+# Threads hashing batch-registered students' passwords. The progress and,
+# until retrieved, the credentials of background batch registrations are
+# kept in redis for BATCH_REGISTRATION_JOB_TTL seconds.
+BATCH_REGISTRATION_HASH_WORKERS = 4
+BATCH_REGISTRATION_JOB_TTL = 3600
 
 RATE_LIMIT_BYPASS_KEY = "INSECURE_DEFAULT_CHANGE_ME"
 SECRET_KEY = "INSECURE_DEFAULT_CHANGE_ME"
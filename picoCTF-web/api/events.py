@@ -0,0 +1,315 @@
+"""
+Live event notifications using redis pub/sub.
+
+Events are published by the worker handling a submission, which also does
+any work they require, such as ranking a new score, so that it is done once
+per event rather than once per client. They are fanned out to every
+worker's connected event stream clients. Each worker process holds a
+single redis subscription, shared by all of its streams, so an idle client
+costs only a queue and a suspended generator. Under the eventlet gunicorn
+worker class the listener and the streams are green threads.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+
+import api
+from api import PicoException
+
+log = logging.getLogger(__name__)
+
+EVENTS_CHANNEL = "events"
+
+# Per-client buffer; a client this far behind is dropped rather than
+# allowed to grow without bound
+STREAM_QUEUE_SIZE = 256
+
+# Open streams of a user or IP address, scored by when they last checked in
+STREAMS_KEY = "event_streams:{}"
+
+# Seconds to wait before resubscribing after losing the subscription,
+# doubling after each consecutive failure
+LISTEN_RETRY_DELAY = 1
+LISTEN_MAX_RETRY_DELAY = 30
+
+__broadcaster = {"pid": None, "thread": None, "queues": set()}
+__lock = threading.Lock()
+
+
+def publish(event_type, data):
+    """
+    Publish an event to all connected event streams.
+
+    Failures are logged and ignored, as notifications are best-effort.
+
+    Args:
+        event_type: name of the event, e.g. "score"
+        data: JSON-serializable event payload
+    """
+    try:
+        api.cache.get_conn().publish(
+            EVENTS_CHANNEL, json.dumps({"type": event_type, "data": data})
+        )
+    except Exception as e:
+        log.error("Failed to publish {} event: {}".format(event_type, e))
+
+
+def publish_solve(tid, uid, pid, score, solve_time):
+    """
+    Publish the events caused by a team's first solve of a problem.
+
+    Args:
+        tid: the solving team's tid
+        uid: the solving user's uid
+        pid: the solved problem's pid
+        score: the team's new encoded scoreboard score
+        solve_time: datetime of the solve
+    """
+    try:
+        team = api.team.get_team(tid=tid)
+        ranks = _rank_on_scoreboards(tid, score, team.get("eligibilities", []))
+    except Exception as e:
+        log.error("Failed to rank score event: {}".format(e))
+        ranks = {}
+    if ranks:
+        publish(
+            "score",
+            {
+                "tid": tid,
+                "score": api.cache.decode_scoreboard_score(score),
+                "ranks": ranks,
+            },
+        )
+    publish(
+        "solve",
+        {
+            "tid": tid,
+            "uid": uid,
+            "pid": pid,
+            "score": api.cache.decode_scoreboard_score(score),
+            "time": int(solve_time.timestamp()),
+        },
+    )
+
+
+def _rank_on_scoreboards(tid, score, scoreboard_ids):
+    """
+    Rank a team's new score on each of the stored scoreboards it is on.
+
+    Scoreboards are rebuilt periodically, so the new score is ranked against
+    the stored board rather than the team's entry in it.
+
+    Args:
+        tid: the team's tid
+        score: the team's new encoded scoreboard score
+        scoreboard_ids: the scoreboards the team is eligible for
+    Returns:
+        dict of scoreboard id to rank, for the boards listing the team
+    """
+    keys = [
+        api.cache.get_scoreboard_cache(scoreboard_id=scoreboard_id).key
+        for scoreboard_id in scoreboard_ids
+    ]
+    pipe = api.cache.get_conn().pipeline(transaction=False)
+    for key in keys:
+        pipe.zscore(key, tid)
+        pipe.zcount(key, "({}".format(score), "+inf")
+    results = pipe.execute() if keys else []
+    return {
+        scoreboard_id: higher + 1
+        for scoreboard_id, entry, higher in zip(
+            scoreboard_ids, results[::2], results[1::2]
+        )
+        if entry is not None
+    }
+
+
+def _listen(app, conn, queues):
+    """
+    Relay published events to each registered client queue.
+
+    Resubscribes with a backoff if the subscription is lost, so that open
+    streams resume receiving events. Events published in the meantime are
+    missed. Runs in the app's context, so that failures can be logged.
+    """
+    with app.app_context():
+        _relay_events(conn, queues)
+
+
+def _relay_events(conn, queues):
+    """Relay events from a subscription, resubscribing whenever it is lost."""
+    delay = LISTEN_RETRY_DELAY
+    while True:
+        pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(EVENTS_CHANNEL)
+            delay = LISTEN_RETRY_DELAY
+            for message in pubsub.listen():
+                _relay(message, queues)
+        except Exception as e:
+            log.error("Lost event subscription, retrying in {}s: {}".format(delay, e))
+        finally:
+            pubsub.close()
+        time.sleep(delay)
+        delay = min(delay * 2, LISTEN_MAX_RETRY_DELAY)
+
+
+def _relay(message, queues):
+    """Put a published event on each registered client queue."""
+    try:
+        event = json.loads(message["data"])
+    except (TypeError, ValueError):
+        return
+    for client_queue in list(queues):
+        try:
+            client_queue.put_nowait(event)
+        except queue.Full:
+            # Signal the stream to close
+            queues.discard(client_queue)
+            client_queue.queue.clear()
+            client_queue.put_nowait(None)
+
+
+def _ensure_listener():
+    """Start this process's pub/sub listener if it is not running."""
+    with __lock:
+        thread = __broadcaster["thread"]
+        if (
+            __broadcaster["pid"] == os.getpid()
+            and thread is not None
+            and thread.is_alive()
+        ):
+            return
+        if __broadcaster["pid"] != os.getpid():
+            # Streams of a parent process are not ours to serve
+            __broadcaster["queues"] = set()
+        __broadcaster["pid"] = os.getpid()
+        __broadcaster["thread"] = threading.Thread(
+            target=_listen,
+            args=(
+                current_app._get_current_object(),
+                api.cache.get_conn(),
+                __broadcaster["queues"],
+            ),
+            name="event-listener",
+            daemon=True,
+        )
+        __broadcaster["thread"].start()
+
+
+def subscribe():
+    """
+    Register a new client of this process's event broadcast.
+
+    Returns:
+        a queue receiving event dicts, or None if the client was dropped
+    """
+    _ensure_listener()
+    client_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    __broadcaster["queues"].add(client_queue)
+    return client_queue
+
+
+def unsubscribe(client_queue):
+    """Deregister a client of this process's event broadcast."""
+    __broadcaster["queues"].discard(client_queue)
+
+
+def open_stream(client):
+    """
+    Count a new event stream against its client's limit.
+
+    Open streams check in periodically, so that those of a worker which
+    exited without closing them no longer count.
+
+    Args:
+        client: the uid or IP address of the client
+    Returns:
+        the stream's token, to pass to stream_scoreboard_events
+    Raises:
+        PicoException: if the client already has too many open streams
+    """
+    conf = current_app.config
+    key = STREAMS_KEY.format(client)
+    lifetime = 3 * conf["EVENT_STREAM_KEEPALIVE"]
+    now = time.time()
+    token = api.common.token()
+    pipe = api.cache.get_state_conn().pipeline()
+    pipe.zremrangebyscore(key, "-inf", now - lifetime)
+    pipe.zadd(key, {token: now})
+    pipe.zcard(key)
+    pipe.expire(key, lifetime)
+    count = pipe.execute()[2]
+    if count > conf["EVENT_STREAM_MAX_PER_CLIENT"]:
+        api.cache.get_state_conn().zrem(key, token)
+        raise PicoException("Too many open event streams", 429)
+    return token
+
+
+def _check_in_stream(client, token):
+    """Record that an open event stream is still being served."""
+    key = STREAMS_KEY.format(client)
+    pipe = api.cache.get_state_conn().pipeline()
+    pipe.zadd(key, {token: time.time()})
+    pipe.expire(key, 3 * current_app.config["EVENT_STREAM_KEEPALIVE"])
+    pipe.execute()
+
+
+def _format_event(event_type, data):
+    """Format an event as a text/event-stream message."""
+    return "event: {}\ndata: {}\n\n".format(event_type, json.dumps(data))
+
+
+def stream_scoreboard_events(scoreboard_id, client, token, tid=None):
+    """
+    Generate the event stream for a scoreboard.
+
+    Yields a "score" message with the new rank whenever a team on the
+    scoreboard gains points, and a "solve" message whenever the given team
+    solves a problem. A comment is sent when the stream is otherwise idle, so
+    proxies and clients can detect dropped connections.
+
+    Args:
+        scoreboard_id: the scoreboard's id
+        client: the uid or IP address of the client
+        token: the stream's token, from open_stream
+        tid: Optional, also report solves by this team
+
+    Yields:
+        text/event-stream messages
+    """
+    keepalive = current_app.config["EVENT_STREAM_KEEPALIVE"]
+    client_queue = subscribe()
+    checked_in = time.time()
+    try:
+        yield "retry: {}\n\n".format(keepalive * 1000)
+        while True:
+            if time.time() - checked_in >= keepalive:
+                _check_in_stream(client, token)
+                checked_in = time.time()
+            try:
+                event = client_queue.get(timeout=keepalive)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                return
+            data = event["data"]
+            if event["type"] == "score":
+                rank = data["ranks"].get(scoreboard_id)
+                if rank is None:
+                    continue
+                yield _format_event(
+                    "score", {"tid": data["tid"], "score": data["score"], "rank": rank}
+                )
+            elif event["type"] == "solve" and data["tid"] == tid:
+                yield _format_event("solve", data)
+    finally:
+        unsubscribe(client_queue)
+        api.cache.get_state_conn().zrem(STREAMS_KEY.format(client), token)
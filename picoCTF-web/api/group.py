@@ -1,10 +1,44 @@
 """Module for handling groups of teams."""
 
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import eventlet.patcher
+import eventlet.tpool
+from flask import current_app
+from pymongo import ReturnDocument
+from pymongo.collation import Collation, CollationStrength
+from pymongo.errors import PyMongoError
 from voluptuous import Required, Schema
 
 import api
 from api import cache, check, log_action, PicoException, validate
 
+log = logging.getLogger(__name__)
+
+BATCH_REGISTRATION_JOB_KEY = "batch_registration:{}"
+
+# Fields every batch registration job is created with
+JOB_FIELDS = {"status", "gid", "uid", "total", "completed", "students"}
+
+# Sets fields of an existing job hash and renews its TTL
+UPDATE_JOB_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("HMSET", KEYS[1], unpack(ARGV, 2))
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+return 1
+"""
+
+__update_job_script = {"conn": None, "script": None}
+
+# Number of passwords hashed between progress updates
+PROGRESS_INTERVAL = 10
+
 group_settings_schema = Schema(
     {
         Required("email_filter"): check(
@@ -175,6 +209,7 @@ def join_group(gid, tid, teacher=False):
 
     db.groups.update({"gid": gid}, {"$addToSet": {role_group: tid}})
     cache.invalidate(api.team.get_groups, tid)
+    api.stats.mark_groups_dirty(gid)
 
 
 @log_action
@@ -190,6 +225,7 @@ def leave_group(gid, tid):
     db.groups.update({"gid": gid}, {"$pull": {"teachers": tid}})
     db.groups.update({"gid": gid}, {"$pull": {"members": tid}})
     cache.invalidate(api.team.get_groups, tid)
+    api.stats.mark_groups_dirty(gid)
 
 
 @log_action
@@ -205,6 +241,7 @@ def elevate_team(gid, tid):
     db.groups.update({"gid": gid}, {"$pull": {"members": tid}})
     db.groups.update({"gid": gid}, {"$addToSet": {"teachers": tid}})
     cache.invalidate(api.team.get_groups, tid)
+    api.stats.mark_groups_dirty(gid)
 
 
 @log_action
@@ -217,6 +254,7 @@ def delete_group(gid):
     """
     db = api.db.get_conn()
     db.groups.remove({"gid": gid})
+    api.stats.mark_groups_dirty(gid)
 
 
 def get_all_groups():
@@ -225,52 +263,148 @@ def get_all_groups():
     return list(db.groups.find({}, {"_id": 0}))
 
 
-def batch_register(students, teacher, gid):
+def _reserve_student_numbers(teacher_uid, count):
+    """
+    Reserve the numbers of a teacher's next batch-registered students.
+
+    Returns:
+        the first reserved number
+
+    """
+    db = api.db.get_conn()
+    token_path = api.token.get_token_path("batch_registered_students")
+    key = db.tokens.find_one_and_update(
+        {"uid": teacher_uid},
+        {"$inc": {token_path: count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return key["tokens"]["batch_registered_students"] - count + 1
+
+
+def _hash_passwords(passwords, progress=None):
+    """
+    Hash passwords in parallel.
+
+    bcrypt releases the GIL while hashing. Under eventlet, whose threads are
+    green, hashes are run in its pool of native threads instead, so that they
+    neither serialize nor block the worker's other requests.
+
+    Args:
+        passwords: list of plaintext passwords
+        progress: Optional, called with the number of passwords hashed so far
+    Returns:
+        list of password hashes, in the same order
+
+    """
+    hash_password = api.common.hash_password
+    if eventlet.patcher.is_monkey_patched("thread"):
+        hash_password = partial(eventlet.tpool.execute, api.common.hash_password)
+
+    hashes = []
+    workers = current_app.config["BATCH_REGISTRATION_HASH_WORKERS"]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for password_hash in executor.map(hash_password, passwords):
+            hashes.append(password_hash)
+            if progress is not None and (
+                len(hashes) % PROGRESS_INTERVAL == 0 or len(hashes) == len(passwords)
+            ):
+                progress(len(hashes))
+    return hashes
+
+
+def batch_register(students, teacher, gid, progress=None):
     """
     Batch registers multiple students and assigns them to a group.
 
-    Stops if an error is encountered adding a user, and returns the information
-    for the users created successfully up to that point.
+    Either all of the students' accounts are created, or none are. Usernames
+    are checked up front, passwords are hashed in parallel, and the users,
+    their teams and the group membership are written in bulk.
 
     Args:
         students: list of DictParser dicts from the uploaded CSV
         teacher: teacher object performing the batch registration
-        group: ID of the group the students should be assigned to
+        gid: ID of the group the students should be assigned to
+        progress: Optional, called with the number of accounts prepared so far
 
     Returns:
-        list of {uid, username, (plaintext) password} tuples for created users
+        list of {uid, username, (plaintext) password} dicts for created users
+
+    Raises:
+        PicoException if the accounts could not be created
 
     """
+    db = api.db.get_conn()
+    group = get_group(gid=gid)
+    if not group:
+        raise PicoException("Classroom not found", 404)
+    if not students:
+        return []
+    settings = api.config.get_settings()
+
     # Created accounts' usernames are: {teacher_username}.student{number}
-    teacher_metadata = api.token.find_key({"uid": teacher["uid"]})
-    if not teacher_metadata:
-        curr_student_number = 0
-    else:
-        curr_student_number = teacher_metadata.get("tokens", {}).get(
-            "batch_registered_students", 0
+    first_number = _reserve_student_numbers(teacher["uid"], len(students))
+    usernames = [
+        f"{teacher['username']}.student{number}"
+        for number in range(first_number, first_number + len(students))
+    ]
+    case_insensitive = Collation(locale="en", strength=CollationStrength.PRIMARY)
+    taken = [
+        user["username"]
+        for user in db.users.find(
+            {"username": {"$in": usernames}},
+            {"_id": 0, "username": 1},
+            collation=case_insensitive,
+        )
+    ] + [
+        team["team_name"]
+        for team in db.teams.find(
+            {"team_name": {"$in": usernames}},
+            {"_id": 0, "team_name": 1},
+            collation=case_insensitive,
+        )
+    ]
+    if taken:
+        raise PicoException(
+            "These usernames are already taken: {}. Please try again.".format(
+                ", ".join(sorted(set(taken)))
+            ),
+            409,
         )
 
-    created_users = []
-    for i, student in enumerate(students):
-        curr_student_number += 1
-        username = f"{teacher['username']}.student{str(curr_student_number)}"
-        password = api.common.token()
-        try:
-            # Create a registration token to bypass verification & reCAPTCHA
-            rid = api.token.set_token(
-                {"gid": gid, "email": teacher["email"], "teacher": False},
-                "registration_token",
-            )
-            uid = api.user.add_user(
+    passwords = [api.common.token() for _ in students]
+    password_hashes = _hash_passwords(passwords, progress)
+    # Students log in to their own team, so its password is never checked
+    team_password_hash = api.common.hash_password("-")
+
+    server_numbers = [None] * len(students)
+    if settings["shell_servers"]["enable_sharding"]:
+        server_numbers = api.shell_servers.get_new_team_server_numbers(len(students))
+
+    teams = []
+    users = []
+    for student, username, password_hash, server_number in zip(
+        students, usernames, password_hashes, server_numbers
+    ):
+        team = api.team.new_team_document(
+            {
+                "team_name": username,
+                "password": team_password_hash,
+                "affiliation": group["name"],
+            },
+            size=1,
+            server_number=server_number,
+        )
+        teams.append(team)
+        users.append(
+            api.user.new_user_document(
                 {
-                    "username": username,
-                    "password": password,
                     "firstname": "",
                     "lastname": "",
+                    "username": username,
                     "email": teacher["email"],
-                    "country": teacher["country"],
-                    "affiliation": api.group.get_group(gid=gid)["name"],
                     "usertype": "student",
+                    "country": teacher["country"],
                     "demo": {
                         "age": student["age"],
                         "gender": student["gender"],
@@ -283,17 +417,170 @@ def batch_register(students, teacher, gid):
                         "url": teacher.get("demo", {}).get("url", ""),
                         "zipcode": teacher.get("demo", {}).get("zipcode", ""),
                     },
-                    "gid": gid,
-                    "rid": rid,
                 },
-                batch_registration=True,
+                password_hash,
+                team["tid"],
+                # Batch-registered students are invited by their teacher
+                verified=True,
             )
-            api.token.set_token(
-                {"uid": teacher["uid"]},
-                "batch_registered_students",
-                curr_student_number,
-            )
-        except PicoException:
-            return created_users
-        created_users.append({"uid": uid, "username": username, "password": password})
-    return created_users
+        )
+
+    uids = [user["uid"] for user in users]
+    tids = [team["tid"] for team in teams]
+    try:
+        db.users.insert_many(users)
+        # Eligibility conditions are queries over users, so are evaluated
+        # for the whole batch once the users exist
+        eligibilities = {uid: [] for uid in uids}
+        for scoreboard in api.scoreboards.get_all_scoreboards():
+            query = {
+                "$and": [scoreboard["eligibility_conditions"], {"uid": {"$in": uids}}]
+            }
+            for user in db.users.find(query, {"_id": 0, "uid": 1}):
+                eligibilities[user["uid"]].append(scoreboard["sid"])
+        for user, team in zip(users, teams):
+            team["eligibilities"] = eligibilities[user["uid"]]
+        db.teams.insert_many(teams)
+        db.groups.update_one({"gid": gid}, {"$addToSet": {"members": {"$each": tids}}})
+    except PyMongoError as error:
+        db.users.delete_many({"uid": {"$in": uids}})
+        db.teams.delete_many({"tid": {"$in": tids}})
+        raise PicoException(
+            "An error occurred while adding student accounts. No accounts were "
+            "created. Please try again.",
+            data={"original_error": error},
+        )
+    api.stats.mark_groups_dirty(gid)
+
+    return [
+        {"uid": user["uid"], "username": user["username"], "password": password}
+        for user, password in zip(users, passwords)
+    ]
+
+
+def _update_batch_registration(job_id, fields):
+    """
+    Update the state of a background batch registration, if it still exists.
+
+    The job's TTL is re-applied, and a job which has expired or been deleted
+    is never recreated.
+
+    Returns:
+        whether the job exists
+
+    """
+    conn = api.cache.get_state_conn()
+    if __update_job_script["conn"] is not conn:
+        __update_job_script["script"] = conn.register_script(UPDATE_JOB_SCRIPT)
+        __update_job_script["conn"] = conn
+    args = [current_app.config["BATCH_REGISTRATION_JOB_TTL"]]
+    for field, value in fields.items():
+        args.extend([field, value])
+    return bool(
+        __update_job_script["script"](
+            keys=[BATCH_REGISTRATION_JOB_KEY.format(job_id)], args=args
+        )
+    )
+
+
+def start_batch_registration(students, teacher, gid):
+    """
+    Batch register students in the background.
+
+    The job's state, including the created accounts' credentials, is kept in
+    the redis state database for BATCH_REGISTRATION_JOB_TTL seconds after
+    its last update, or until its result is retrieved.
+
+    Args:
+        students: list of DictParser dicts from the uploaded CSV
+        teacher: teacher object performing the batch registration
+        gid: ID of the group the students should be assigned to
+    Returns:
+        the job id
+
+    """
+    job_id = api.common.token()
+    key = BATCH_REGISTRATION_JOB_KEY.format(job_id)
+    pipe = api.cache.get_state_conn().pipeline()
+    pipe.hset(
+        key,
+        mapping={
+            "status": "running",
+            "gid": gid,
+            "uid": teacher["uid"],
+            "total": len(students),
+            "completed": 0,
+            "students": json.dumps(students),
+        },
+    )
+    pipe.expire(key, current_app.config["BATCH_REGISTRATION_JOB_TTL"])
+    pipe.execute()
+
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            try:
+                accounts = batch_register(
+                    students,
+                    teacher,
+                    gid,
+                    progress=lambda completed: _update_batch_registration(
+                        job_id, {"completed": completed}
+                    ),
+                )
+                state = {"status": "done", "accounts": json.dumps(accounts)}
+            except PicoException as e:
+                state = {"status": "failed", "error": e.message}
+            except Exception:
+                log.exception("Batch registration {} failed".format(job_id))
+                state = {
+                    "status": "failed",
+                    "error": "An error occurred while adding student accounts. "
+                    "Please contact an administrator.",
+                }
+            if not _update_batch_registration(job_id, state):
+                log.warning(
+                    "Batch registration {} expired before finishing".format(job_id)
+                )
+
+    threading.Thread(
+        target=run, name="batch-registration-{}".format(job_id), daemon=True
+    ).start()
+    return job_id
+
+
+def get_batch_registration(job_id, pop_result=False):
+    """
+    Get the progress of a background batch registration.
+
+    Args:
+        job_id: the job id
+        pop_result: Whether to delete the job once it has finished, so that
+                    its account credentials can only be retrieved once
+    Returns:
+        dict of status ("running", "done" or "failed"), gid, uid of the
+        teacher, total and completed number of students, the students, and
+        either the created accounts or an error message if finished; or None
+        if there is no such job, or its state is incomplete
+
+    """
+    key = BATCH_REGISTRATION_JOB_KEY.format(job_id)
+    conn = api.cache.get_state_conn()
+    job = {
+        field.decode("utf-8"): value.decode("utf-8")
+        for field, value in conn.hgetall(key).items()
+    }
+    if not JOB_FIELDS.issubset(job) or (
+        job["status"] == "done" and "accounts" not in job
+    ):
+        return None
+    job["total"] = int(job["total"])
+    job["completed"] = int(job["completed"])
+    job["students"] = json.loads(job["students"])
+    if "accounts" in job:
+        job["accounts"] = json.loads(job["accounts"])
+    job.setdefault("error", "Batch registration failed")
+    if pop_result and job["status"] != "running":
+        conn.delete(key)
+    return job
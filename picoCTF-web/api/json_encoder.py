@@ -0,0 +1,77 @@
+"""
+Fast JSON encoding for API responses.
+
+When orjson is installed, compact responses are encoded with it, falling back
+to the standard library for anything orjson would encode differently.
+"""
+
+import math
+import re
+
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"')
+# Outside of strings, only exponent-notation numbers contain a digit and an e
+_EXPONENT = re.compile(rb"[0-9][eE]")
+
+
+def _has_non_finite_float(o, default):
+    """Check whether an object would be encoded with a non-finite float."""
+    if isinstance(o, float):
+        return not math.isfinite(o)
+    if isinstance(o, dict):
+        return any(_has_non_finite_float(v, default) for v in o.values())
+    if isinstance(o, (list, tuple)):
+        return any(_has_non_finite_float(v, default) for v in o)
+    if o is None or isinstance(o, (str, int)):
+        return False
+    try:
+        return _has_non_finite_float(default(o), default)
+    except TypeError:
+        # Encoded natively by orjson, so the standard library must decide
+        return True
+
+
+class FastJSONEncoder(JSONEncoder):
+    """
+    Flask JSON encoder which uses orjson when available.
+
+    Output is byte-for-byte identical to Flask's default encoder, including
+    its formatting of dates as HTTP dates. orjson writes exponent-notation
+    floats differently and non-finite floats as null, so output containing
+    either is re-encoded with the standard library.
+    """
+
+    def encode(self, o):
+        """Encode an object, using orjson when its output is compatible."""
+        if (
+            orjson is not None
+            and self.indent is None
+            and self.item_separator == ","
+            and self.key_separator == ":"
+            and self.ensure_ascii
+            and not self.skipkeys
+        ):
+            options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS
+            if self.sort_keys:
+                options |= orjson.OPT_SORT_KEYS
+            try:
+                encoded = orjson.dumps(o, default=self.default, option=options)
+            except (orjson.JSONEncodeError, TypeError):
+                # e.g. non-string keys or integers over 64 bits
+                pass
+            else:
+                # json escapes DEL and non-ASCII characters when ensure_ascii
+                # is set, while orjson does not
+                if encoded.isascii() and b"\x7f" not in encoded:
+                    tokens = _STRING.sub(b'""', encoded)
+                    if not _EXPONENT.search(tokens) and not (
+                        b"null" in tokens and _has_non_finite_float(o, self.default)
+                    ):
+                        return encoded.decode("ascii")
+        return super().encode(o)
@@ -1,21 +1,226 @@
 """Manage loggers for the API."""
 
+import atexit
+import glob
 import logging
 import logging.handlers
+import os
+import sys
+import threading
 import traceback
 from datetime import datetime
 from functools import wraps
 
+import bson
 import pymongo
-from flask import has_request_context
+from bson.codec_options import CodecOptions
+from bson.errors import InvalidBSON
+from bson.raw_bson import RawBSONDocument
+from flask import current_app, has_request_context
 from flask import logging as flask_logging
-from flask import request
+from flask import request, session
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from werkzeug.useragents import UserAgent
 
 import api
 
 critical_error_timeout = 600
 log = logging.getLogger(__name__)
 
+# Hashes of the user agents this process has stored, cleared when full
+KNOWN_USER_AGENTS_SIZE = 4096
+__known_user_agents = set()
+
+# Root handlers installed by setup_logs, which only installs them once per
+# process however many apps are created
+__handlers = {}
+
+
+class StatisticsBuffer:
+    """
+    Writes statistics records to the database in batches.
+
+    Records are buffered in memory and inserted by a background thread once
+    flush_size of them are waiting, or every flush_interval seconds. At most
+    max_size records are held in memory: beyond that, and whenever a write
+    fails, records are appended to a spill file in spill_dir (or dropped, if
+    it is None) and replayed after the next successful write. Replayed
+    records may occasionally be inserted twice.
+
+    Records are held as encoded BSON, so later changes to the logged
+    arguments do not affect them.
+    """
+
+    def __init__(self, app):
+        """
+        Initialize the buffer.
+
+        Args:
+            app: the Flask app, whose config and database to use
+        """
+        config = app.config
+        self.app = app
+        self.max_size = config["STATISTICS_BUFFER_SIZE"]
+        self.flush_size = config["STATISTICS_FLUSH_SIZE"]
+        self.flush_interval = config["STATISTICS_FLUSH_INTERVAL"]
+        self.spill_dir = config["STATISTICS_SPILL_DIR"]
+        self.dropped = 0
+        self._records = []
+        self._condition = threading.Condition()
+        self._pid = None
+        self._thread = None
+        self._closed = False
+
+    def add(self, record):
+        """
+        Buffer a record for insertion.
+
+        Args:
+            record: statistics record dict
+        """
+        document = RawBSONDocument(bson.BSON.encode(record))
+        with self._condition:
+            self._ensure_thread()
+            if len(self._records) >= self.max_size:
+                self._spill([document])
+                return
+            self._records.append(document)
+            if len(self._records) >= self.flush_size:
+                self._condition.notify()
+
+    def close(self):
+        """Write out all buffered records and stop the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None and thread.is_alive():
+            thread.join(timeout=max(self.flush_interval, 10))
+        else:
+            with self._condition:
+                batch, self._records = self._records, []
+            self._write(batch)
+
+    def _ensure_thread(self):
+        """Start this process's writer thread if it is not running."""
+        if (
+            self._pid == os.getpid()
+            and self._thread is not None
+            and self._thread.is_alive()
+        ):
+            return
+        if self._pid != os.getpid():
+            # Records buffered by a parent process are its to write
+            self._records = []
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._run, name="statistics-writer", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        """Write batches of buffered records until closed."""
+        while True:
+            with self._condition:
+                if len(self._records) < self.flush_size and not self._closed:
+                    self._condition.wait(self.flush_interval)
+                batch, self._records = self._records, []
+                closed = self._closed
+            self._write(batch)
+            if closed:
+                return
+
+    def _write(self, batch):
+        """Insert a batch of records, spilling it if the write fails."""
+        with self.app.app_context():
+            try:
+                if batch:
+                    api.db.get_conn().statistics.insert_many(batch, ordered=False)
+            except BulkWriteError as error:
+                # Individual invalid records are not worth retrying
+                log.warning(
+                    "Failed to write {} statistics records: {}".format(
+                        len(error.details["writeErrors"]), error
+                    )
+                )
+            except PyMongoError as error:
+                log.warning("Failed to write statistics records: {}".format(error))
+                with self._condition:
+                    self._spill(batch)
+                return
+            self._replay()
+
+    def _spill_path(self, pid):
+        return os.path.join(self.spill_dir, "statistics-{}.bson".format(pid))
+
+    def _spill(self, documents):
+        """Append records to this process's spill file, or drop them."""
+        if self.spill_dir is None:
+            self.dropped += len(documents)
+            return
+        try:
+            with open(self._spill_path(os.getpid()), "ab") as spill_file:
+                for document in documents:
+                    spill_file.write(document.raw)
+        except OSError as error:
+            self.dropped += len(documents)
+            log.warning("Failed to spill statistics records: {}".format(error))
+
+    def _replay(self):
+        """Insert the records of this and any dead process's spill files."""
+        if self.spill_dir is None:
+            return
+        for path in glob.glob(self._spill_path("*")) + glob.glob(
+            self._spill_path("*") + ".replay"
+        ):
+            pid = int(os.path.basename(path).split("-")[1].split(".")[0])
+            if pid != os.getpid() and _is_running(pid):
+                continue
+            if not path.endswith(".replay"):
+                # Stop further appends, then replay outside of the lock
+                with self._condition:
+                    try:
+                        os.rename(path, path + ".replay")
+                    except OSError:
+                        continue
+                path += ".replay"
+            try:
+                with open(path, "rb") as spill_file:
+                    batch = []
+                    for document in bson.decode_file_iter(
+                        spill_file, CodecOptions(document_class=RawBSONDocument)
+                    ):
+                        batch.append(document)
+                        if len(batch) >= self.flush_size:
+                            self._insert_replayed(batch)
+                            batch = []
+                    self._insert_replayed(batch)
+                os.remove(path)
+            except PyMongoError as error:
+                log.warning("Failed to replay statistics records: {}".format(error))
+                return
+            except (OSError, InvalidBSON) as error:
+                log.error("Discarding unreadable spill file {}: {}".format(path, error))
+                os.remove(path)
+
+    def _insert_replayed(self, batch):
+        if batch:
+            try:
+                api.db.get_conn().statistics.insert_many(batch, ordered=False)
+            except BulkWriteError:
+                pass
+
+
+def _is_running(pid):
+    """Check whether a process is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
 
 class FunctionLoggingHandler(logging.StreamHandler):
     """
@@ -24,9 +229,16 @@ class FunctionLoggingHandler(logging.StreamHandler):
     Used by the @log_action decorator.
     """
 
-    def __init__(self):
-        """Initialize the logger."""
+    def __init__(self, buffer=None):
+        """
+        Initialize the logger.
+
+        Args:
+            buffer: Optional, StatisticsBuffer to write records through.
+                    Records are written synchronously without one.
+        """
         logging.StreamHandler.__init__(self)
+        self.buffer = buffer
 
     def emit(self, record):
         """Store record into the db."""
@@ -51,11 +263,20 @@ class FunctionLoggingHandler(logging.StreamHandler):
                 information["success"] = True
                 information["result"] = repr(result["result"])
 
-            api.db.get_conn().statistics.insert(information)
+            if self.buffer is not None:
+                self.buffer.add(information)
+            else:
+                api.db.get_conn().statistics.insert(information)
 
 
 class ExceptionHandler(logging.StreamHandler):
-    """Logs exceptions into the database."""
+    """
+    Logs exceptions into the database.
+
+    Occurrences of the same exception are aggregated into one document,
+    counting them and recording when they were first and last seen. A
+    dismissed exception is shown again if it recurs.
+    """
 
     def __init__(self):
         """Initialize the logger."""
@@ -64,23 +285,68 @@ class ExceptionHandler(logging.StreamHandler):
     def emit(self, record):
         """Store record into the db."""
         information = get_request_information()
+        trace = traceback.format_exc()
+        now = datetime.now()
 
         information.update(
-            {
-                "id": api.common.token(),
-                "time": datetime.now(),
-                "message": record.msg,
-                "trace": traceback.format_exc(),
-                "visible": True,
-            }
+            {"time": now, "message": record.msg, "trace": trace, "visible": True}
         )
-        api.db.get_conn().exceptions.insert(information)
+        update = {
+            "$set": information,
+            "$setOnInsert": {"id": api.common.token(), "first_seen": now},
+            "$inc": {"count": 1},
+        }
+        # Describe the latest occurrence: without a request or user, remove
+        # those of any earlier occurrence
+        missing = {
+            field: "" for field in ("request", "uid", "tid") if field not in information
+        }
+        if missing:
+            update["$unset"] = missing
+        fingerprint = get_exception_fingerprint(sys.exc_info(), record.msg)
+        try:
+            api.db.get_conn().exceptions.update_one(
+                {"fingerprint": fingerprint}, update, upsert=True
+            )
+        except DuplicateKeyError:
+            # Concurrently inserted by another process, so now an update
+            api.db.get_conn().exceptions.update_one(
+                {"fingerprint": fingerprint}, update, upsert=True
+            )
+
+
+def get_exception_fingerprint(exc_info, message):
+    """
+    Identify an exception by its type and where it was raised.
+
+    The exception's message is ignored, as it often contains values which
+    vary between occurrences.
+
+    Args:
+        exc_info: exception info tuple, as from sys.exc_info()
+        message: the logged message, used if there is no exception
+    Returns:
+        the fingerprint string
+    """
+    exc_type, _, exc_traceback = exc_info
+    if exc_type is None:
+        return api.common.hash(str(message))
+    frames = [
+        "{}:{}:{}".format(frame.filename, frame.lineno, frame.name)
+        for frame in traceback.extract_tb(exc_traceback)
+    ]
+    return api.common.hash(
+        "|".join(["{}.{}".format(exc_type.__module__, exc_type.__qualname__)] + frames)
+    )
 
 
 def get_request_information():
     """
     Return a dictionary of information about the user at the time of logging.
 
+    Only cheap identifiers are recorded: the names they refer to are
+    resolved by enrich_log_records when records are viewed.
+
     Returns:
         The dictionary.
 
@@ -92,30 +358,175 @@ def get_request_information():
             "api_endpoint_method": request.method,
             "api_endpoint": request.path,
             "ip": request.remote_addr,
-            "platform": request.user_agent.platform,
-            "browser": request.user_agent.browser,
-            "browser_version": request.user_agent.version,
-            "user_agent": request.user_agent.string,
+            "user_agent_hash": _store_user_agent(request.headers.get("User-Agent", "")),
         }
 
-        if api.user.is_logged_in():
-            user = api.user.get_user()
-            team = api.user.get_team()
-            groups = api.team.get_groups(user["tid"])
+        # The session's team is kept current whenever the user is loaded
+        uid = session.get("uid")
+        if uid is not None:
+            information["uid"] = uid
+            information["tid"] = session.get("tid")
+    return information
+
+
+def _store_user_agent(user_agent):
+    """
+    Store a user agent string, if it has not been seen by this process.
 
-            information["user"] = {
+    Args:
+        user_agent: the raw user agent string
+    Returns:
+        the hash identifying the user agent
+    """
+    user_agent_hash = api.common.hash(user_agent)
+    if user_agent_hash not in __known_user_agents:
+        try:
+            api.db.get_conn().user_agents.update_one(
+                {"hash": user_agent_hash},
+                {"$setOnInsert": {"user_agent": user_agent}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Concurrently stored by another process
+            pass
+        if len(__known_user_agents) >= KNOWN_USER_AGENTS_SIZE:
+            __known_user_agents.clear()
+        __known_user_agents.add(user_agent_hash)
+    return user_agent_hash
+
+
+def enrich_log_records(records):
+    """
+    Resolve the identifiers recorded in log records into readable details.
+
+    Users, teams, groups and user agents are fetched in bulk for all of the
+    records. Adds the "user" field and the browser details of the "request"
+    field which get_request_information omits.
+
+    Args:
+        records: list of statistics or exception records
+    Returns:
+        the records, enriched in place
+    """
+    db = api.db.get_conn()
+    uids = list({record["uid"] for record in records if record.get("uid")})
+    tids = list({record["tid"] for record in records if record.get("tid")})
+    user_agent_hashes = list(
+        {
+            record["request"]["user_agent_hash"]
+            for record in records
+            if "user_agent_hash" in record.get("request", {})
+        }
+    )
+
+    users = {
+        user["uid"]: user
+        for user in db.users.find(
+            {"uid": {"$in": uids}}, {"_id": 0, "uid": 1, "username": 1, "email": 1}
+        )
+    }
+    team_names = {
+        team["tid"]: team["team_name"]
+        for team in db.teams.find(
+            {"tid": {"$in": tids}}, {"_id": 0, "tid": 1, "team_name": 1}
+        )
+    }
+    group_names = {tid: [] for tid in tids}
+    for group in db.groups.find(
+        {
+            "$or": [
+                {"owner": {"$in": tids}},
+                {"teachers": {"$in": tids}},
+                {"members": {"$in": tids}},
+            ]
+        },
+        {"_id": 0, "name": 1, "owner": 1, "teachers": 1, "members": 1},
+    ):
+        for tid in {group["owner"], *group["teachers"], *group["members"]}:
+            if tid in group_names:
+                group_names[tid].append(group["name"])
+    user_agents = {
+        user_agent["hash"]: user_agent["user_agent"]
+        for user_agent in db.user_agents.find(
+            {"hash": {"$in": user_agent_hashes}}, {"_id": 0}
+        )
+    }
+
+    for record in records:
+        request_information = record.get("request", {})
+        if "user_agent_hash" in request_information:
+            user_agent = UserAgent(
+                user_agents.get(request_information["user_agent_hash"], "")
+            )
+            request_information.update(
+                {
+                    "platform": user_agent.platform,
+                    "browser": user_agent.browser,
+                    "browser_version": user_agent.version,
+                    "user_agent": user_agent.string,
+                }
+            )
+        user = users.get(record.get("uid"))
+        if user is not None:
+            record["user"] = {
                 "username": user["username"],
                 "email": user["email"],
-                "team_name": team["team_name"],
-                "groups": [group["name"] for group in groups],
+                "team_name": team_names.get(record.get("tid"), ""),
+                "groups": group_names.get(record.get("tid"), []),
             }
-    return information
+    return records
+
+
+def iter_statistics(chunk_size=1000):
+    """
+    Iterate over the logged function invocations, oldest first.
+
+    Records are read and enriched a chunk at a time, so that the full result
+    never has to be held in memory.
+
+    Args:
+        chunk_size: number of records to enrich at once
+    """
+    chunk = []
+    cursor = (
+        api.db.get_analytics_conn("iter_statistics")
+        .statistics.find({}, {"_id": 0, "args": 0, "kwargs": 0, "result": 0})
+        .sort([("time", pymongo.ASCENDING)])
+    )
+    for record in cursor:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield from _statistics_rows(enrich_log_records(chunk))
+            chunk = []
+    yield from _statistics_rows(enrich_log_records(chunk))
+
+
+def _statistics_rows(records):
+    """Flatten enriched statistics records into export rows."""
+    for record in records:
+        request_information = record.get("request", {})
+        user = record.get("user", {})
+        yield {
+            "time": record["time"].isoformat(),
+            "event": record["event"],
+            "success": record.get("success"),
+            "api_endpoint": request_information.get("api_endpoint", ""),
+            "ip": request_information.get("ip", ""),
+            "browser": request_information.get("browser", ""),
+            "platform": request_information.get("platform", ""),
+            "username": user.get("username", ""),
+            "team_name": user.get("team_name", ""),
+            "groups": ", ".join(user.get("groups", [])),
+        }
 
 
 def setup_logs(args):
     """
     Initialize the api loggers.
 
+    The exception and statistics handlers are installed by the first app
+    created in each process; later apps share them.
+
     Args:
         args: dict containing the configuration options.
     """
@@ -129,17 +540,27 @@ def setup_logs(args):
         min(args.get("verbose", 1), 2)
     ]
 
+    log.root.setLevel(level)
+    if __handlers:
+        return
+
     # Handle ERROR level with ExceptionHandler
     internal_error_log = ExceptionHandler()
     internal_error_log.setLevel(logging.ERROR)
-    log.root.setLevel(level)
     log.root.addHandler(internal_error_log)
 
     # Handle INFO level with FunctionLoggingHandler
-    stats_log = FunctionLoggingHandler()
+    app = current_app._get_current_object()
+    buffer = None
+    if not app.testing:
+        buffer = StatisticsBuffer(app)
+        atexit.register(buffer.close)
+    stats_log = FunctionLoggingHandler(buffer=buffer)
     stats_log.setLevel(logging.INFO)
     log.root.addHandler(stats_log)
 
+    __handlers.update({"exceptions": internal_error_log, "statistics": stats_log})
+
 
 def log_action(f):
     """Log a function invocation and its result."""
@@ -167,7 +588,10 @@ def log_action(f):
 
 def get_api_exceptions(result_limit=50):
     """
-    Retrieve the most recent logged exceptions.
+    Retrieve the most recently seen logged exceptions.
+
+    Each exception includes its number of occurrences ("count"), and the
+    times it was first ("first_seen") and most recently ("time") seen.
 
     Args:
         result_limit: the maximum number of exceptions to return.
@@ -182,7 +606,7 @@ def get_api_exceptions(result_limit=50):
         .sort([("time", pymongo.DESCENDING)])
         .limit(result_limit)
     )
-    return list(results)
+    return enrich_log_records(list(results))
 
 
 def get_api_exception(exception_id):
@@ -197,7 +621,10 @@ def get_api_exception(exception_id):
 
     """
     db = api.db.get_conn()
-    return db.exceptions.find_one({"id": exception_id}, {"_id": 0})
+    exception = db.exceptions.find_one({"id": exception_id}, {"_id": 0})
+    if exception is not None:
+        enrich_log_records([exception])
+    return exception
 
 
 def dismiss_api_exceptions(exception_id=None):
@@ -0,0 +1,432 @@
+"""
+Per-request performance instrumentation.
+
+The mongo commands and redis round trips made while handling each request
+are counted and timed, via a pymongo command listener and an instrumented
+redis connection class. Per-endpoint histograms of these are accumulated in
+each worker process and periodically added to redis, both as running totals
+(exposed in the Prometheus text format) and in per-minute windows (used for
+recent percentiles).
+
+Mongo commands slower than a configured threshold are also recorded in
+redis, aggregated by query shape.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+from flask import current_app, request
+from pymongo import monitoring
+from redis.connection import Connection
+
+import api
+
+log = logging.getLogger(__name__)
+
+TOTALS_KEY = "metrics:totals"
+WINDOW_KEY = "metrics:window:{}"
+SLOW_QUERIES_KEY = "slow_queries"
+
+# Command fields which are not part of a query's shape
+SHAPE_IGNORED_FIELDS = {
+    "$clusterTime",
+    "$db",
+    "$readPreference",
+    "documents",
+    "lsid",
+    "txnNumber",
+}
+
+# Bound on the started commands awaiting completion, in case some never
+# complete
+MAX_TRACKED_COMMANDS = 10000
+
+# Histogram bucket upper bounds, by metric
+DURATION_BUCKETS = [1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+METRICS = {
+    "request_duration_ms": DURATION_BUCKETS,
+    "mongo_duration_ms": DURATION_BUCKETS,
+    "mongo_commands": COUNT_BUCKETS,
+    "redis_duration_ms": DURATION_BUCKETS,
+    "redis_commands": COUNT_BUCKETS,
+    "redis_bytes_sent": [100, 1000, 10000, 100000, 1000000],
+}
+
+# Counters of the request being handled by the current (green) thread
+_current = threading.local()
+
+__pending = defaultdict(int)
+__state = {"last_flush": time.time()}
+__lock = threading.Lock()
+
+
+def _counters():
+    """Get the counters of the current request, or None outside requests."""
+    return getattr(_current, "counters", None)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Counts and times the mongo commands of the current request.
+
+    Also records commands slower than a threshold, with their query shape
+    and calling function.
+    """
+
+    def __init__(self, slow_query_threshold=None):
+        """
+        Initialize the listener.
+
+        Args:
+            slow_query_threshold: Optional, duration in ms from which
+                                  commands are recorded as slow queries
+        """
+        self.slow_query_threshold = slow_query_threshold
+        self._commands = {}
+
+    def started(self, event):
+        if self.slow_query_threshold is not None:
+            if len(self._commands) >= MAX_TRACKED_COMMANDS:
+                self._commands.clear()
+            self._commands[event.request_id] = event.command
+
+    def succeeded(self, event):
+        duration_ms = event.duration_micros / 1000
+        counters = _counters()
+        if counters is not None:
+            counters["mongo_commands"] += 1
+            counters["mongo_duration_ms"] += duration_ms
+        if self.slow_query_threshold is not None:
+            command = self._commands.pop(event.request_id, None)
+            if command is not None and duration_ms >= self.slow_query_threshold:
+                record_slow_query(
+                    query_shape(event.command_name, command), duration_ms, get_caller(),
+                )
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+class InstrumentedConnection(Connection):
+    """Redis connection which counts and times the current request's commands."""
+
+    def send_packed_command(self, command, *args, **kwargs):
+        counters = _counters()
+        if counters is None:
+            return super().send_packed_command(command, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().send_packed_command(command, *args, **kwargs)
+        finally:
+            counters["redis_duration_ms"] += (time.perf_counter() - start) * 1000
+            if isinstance(command, (bytes, str)):
+                command = [command]
+            counters["redis_bytes_sent"] += sum(len(chunk) for chunk in command)
+
+    def read_response(self, *args, **kwargs):
+        counters = _counters()
+        if counters is None:
+            return super().read_response(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().read_response(*args, **kwargs)
+        finally:
+            counters["redis_duration_ms"] += (time.perf_counter() - start) * 1000
+            counters["redis_commands"] += 1
+
+
+def query_shape(command_name, command):
+    """
+    Get the shape of a mongo command, with all values replaced by "?".
+
+    Args:
+        command_name: the command's name, e.g. "find"
+        command: the command document
+    Returns:
+        the shape, naming the command's collection
+    """
+
+    def shape(value):
+        if isinstance(value, dict):
+            return {
+                key: shape(item)
+                for key, item in value.items()
+                if key not in SHAPE_IGNORED_FIELDS
+            }
+        if isinstance(value, (list, tuple)):
+            shapes = []
+            for item in value:
+                item_shape = shape(item)
+                if item_shape not in shapes:
+                    shapes.append(item_shape)
+            return shapes
+        return "?"
+
+    command_shape = shape(command)
+    command_shape[command_name] = command.get(command_name)
+    return command_shape
+
+
+def get_caller():
+    """
+    Get the innermost API function in the current call stack.
+
+    Returns:
+        "path:line in function", or None if not called from the API
+    """
+    for frame in reversed(traceback.extract_stack()):
+        path = frame.filename.replace(os.sep, "/")
+        if "/api/" in path and not path.endswith("/api/metrics.py"):
+            return "{}:{} in {}".format(
+                path[path.rindex("/api/") + 1 :], frame.lineno, frame.name
+            )
+    return None
+
+
+def record_slow_query(shape, duration_ms, caller):
+    """
+    Record an occurrence of a slow query, aggregated by query shape.
+
+    Args:
+        shape: the query shape, from query_shape
+        duration_ms: how long the query took
+        caller: the calling function, from get_caller
+    """
+    key = json.dumps(shape, sort_keys=True)
+    fingerprint = api.common.hash(key)
+    try:
+        pipe = api.cache.get_conn().pipeline(transaction=False)
+        pipe.zincrby(SLOW_QUERIES_KEY + ":count", 1, fingerprint)
+        pipe.zincrby(SLOW_QUERIES_KEY + ":duration", duration_ms, fingerprint)
+        pipe.hset(
+            SLOW_QUERIES_KEY,
+            fingerprint,
+            json.dumps(
+                {
+                    "shape": key,
+                    "caller": caller,
+                    "last_duration_ms": duration_ms,
+                    "last_seen": int(time.time()),
+                }
+            ),
+        )
+        pipe.execute()
+    except Exception as e:
+        log.error("Failed to record slow query: {}".format(e))
+
+
+def get_slow_queries(limit=50):
+    """
+    Get the query shapes which have spent the most time as slow queries.
+
+    Args:
+        limit: the maximum number of query shapes to return
+    Returns:
+        list of dicts of query shape, last caller, count, total and last
+        duration in ms, and last seen timestamp
+    """
+    conn = api.cache.get_conn()
+    durations = conn.zrevrange(
+        SLOW_QUERIES_KEY + ":duration", 0, limit - 1, withscores=True
+    )
+    fingerprints = [fingerprint for fingerprint, _ in durations]
+    if not fingerprints:
+        return []
+    pipe = conn.pipeline(transaction=False)
+    for fingerprint in fingerprints:
+        pipe.zscore(SLOW_QUERIES_KEY + ":count", fingerprint)
+    pipe.hmget(SLOW_QUERIES_KEY, fingerprints)
+    *counts, details = pipe.execute()
+
+    slow_queries = []
+    for (_, duration), count, detail in zip(durations, counts, details):
+        if detail is None:
+            continue
+        detail = json.loads(detail)
+        detail["shape"] = json.loads(detail["shape"])
+        detail.update({"count": int(count or 0), "total_duration_ms": duration})
+        slow_queries.append(detail)
+    return slow_queries
+
+
+def start_request():
+    """Start counting the work done for the current request."""
+    if current_app.config["METRICS_ENABLED"]:
+        _current.counters = defaultdict(float)
+        _current.start = time.perf_counter()
+
+
+def finish_request(response):
+    """
+    Record the work done for the current request.
+
+    Adds a Server-Timing header to the response in debug mode, and adds the
+    request's metrics to the pending histograms, flushing them if due.
+
+    Args:
+        response: the Flask response
+    Returns:
+        the response
+    """
+    counters = _counters()
+    if counters is None:
+        return response
+    _current.counters = None
+    counters["request_duration_ms"] = (time.perf_counter() - _current.start) * 1000
+
+    if current_app.debug or current_app.config["METRICS_SERVER_TIMING"]:
+        response.headers["Server-Timing"] = ", ".join(
+            [
+                'mongo;dur={:.1f};desc="{:.0f} commands"'.format(
+                    counters["mongo_duration_ms"], counters["mongo_commands"]
+                ),
+                'redis;dur={:.1f};desc="{:.0f} commands"'.format(
+                    counters["redis_duration_ms"], counters["redis_commands"]
+                ),
+                "total;dur={:.1f}".format(counters["request_duration_ms"]),
+            ]
+        )
+
+    endpoint = request.endpoint or "none"
+    for metric, buckets in METRICS.items():
+        value = counters[metric]
+        bucket = next((str(bound) for bound in buckets if value <= bound), "+Inf")
+        __pending["{}|{}|{}".format(metric, endpoint, bucket)] += 1
+        __pending["{}|{}|sum".format(metric, endpoint)] += value
+
+    if (
+        time.time() - __state["last_flush"]
+        >= current_app.config["METRICS_FLUSH_INTERVAL"]
+    ):
+        flush()
+    return response
+
+
+def flush():
+    """Add this process's pending histogram counts to redis."""
+    global __pending
+    with __lock:
+        pending, __pending = __pending, defaultdict(int)
+        __state["last_flush"] = time.time()
+    if not pending:
+        return
+    window_key = WINDOW_KEY.format(int(time.time() // 60))
+    try:
+        pipe = api.cache.get_conn().pipeline(transaction=False)
+        for field, value in pending.items():
+            if isinstance(value, float):
+                pipe.hincrbyfloat(TOTALS_KEY, field, value)
+                pipe.hincrbyfloat(window_key, field, value)
+            else:
+                pipe.hincrby(TOTALS_KEY, field, value)
+                pipe.hincrby(window_key, field, value)
+        pipe.expire(window_key, current_app.config["METRICS_WINDOW_RETENTION"] * 60)
+        pipe.execute()
+    except Exception as e:
+        log.error("Failed to flush metrics: {}".format(e))
+
+
+def _parse_histograms(fields):
+    """
+    Parse stored histogram fields.
+
+    Args:
+        fields: dict of "metric|endpoint|bucket" field to count
+    Returns:
+        dict of (metric, endpoint) to a dict of bucket bound to count, with
+        the total of the observed values under "sum"
+    """
+    histograms = defaultdict(lambda: defaultdict(float))
+    for field, value in fields.items():
+        if isinstance(field, bytes):
+            field = field.decode("utf-8")
+        metric, endpoint, bucket = field.split("|")
+        histograms[(metric, endpoint)][bucket] += float(value)
+    return histograms
+
+
+def _bucket_bounds(metric):
+    return [str(bound) for bound in METRICS[metric]] + ["+Inf"]
+
+
+def get_recent_percentiles(minutes=5, percentiles=(50, 95, 99)):
+    """
+    Get per-endpoint percentiles of each metric over the last few minutes.
+
+    Percentiles are estimated as the upper bound of the histogram bucket
+    containing them, or None if that is the unbounded bucket.
+
+    Args:
+        minutes: length of the window to report on
+        percentiles: the percentiles to report
+    Returns:
+        dict of endpoint to dict of metric to a dict of its request count,
+        mean, and each percentile
+    """
+    conn = api.cache.get_conn()
+    now = int(time.time() // 60)
+    pipe = conn.pipeline(transaction=False)
+    for minute in range(now - minutes + 1, now + 1):
+        pipe.hgetall(WINDOW_KEY.format(minute))
+    fields = defaultdict(float)
+    for window in pipe.execute():
+        for field, value in window.items():
+            fields[field.decode("utf-8")] += float(value)
+
+    report = defaultdict(dict)
+    for (metric, endpoint), histogram in _parse_histograms(fields).items():
+        bounds = _bucket_bounds(metric)
+        count = sum(histogram[bound] for bound in bounds)
+        if not count:
+            continue
+        summary = {"count": int(count), "mean": histogram["sum"] / count}
+        for percentile in percentiles:
+            cumulative = 0
+            for bound in bounds:
+                cumulative += histogram[bound]
+                if cumulative >= count * percentile / 100:
+                    summary["p{}".format(percentile)] = (
+                        float(bound) if bound != "+Inf" else None
+                    )
+                    break
+        report[endpoint][metric] = summary
+    return report
+
+
+def get_prometheus_metrics():
+    """
+    Render the running per-endpoint histograms in the Prometheus text format.
+
+    Returns:
+        the exposition text
+    """
+    histograms = _parse_histograms(api.cache.get_conn().hgetall(TOTALS_KEY))
+    lines = []
+    for metric in METRICS:
+        name = "picoctf_{}".format(metric)
+        lines.append("# TYPE {} histogram".format(name))
+        for (hist_metric, endpoint), histogram in sorted(histograms.items()):
+            if hist_metric != metric:
+                continue
+            # Counts are integers, but are summed as floats when parsed
+            cumulative = 0
+            for bound in _bucket_bounds(metric):
+                cumulative += int(histogram[bound])
+                lines.append(
+                    '{}_bucket{{endpoint="{}",le="{}"}} {:d}'.format(
+                        name, endpoint, bound, cumulative
+                    )
+                )
+            lines.append(
+                '{}_sum{{endpoint="{}"}} {!r}'.format(name, endpoint, histogram["sum"])
+            )
+            lines.append(
+                '{}_count{{endpoint="{}"}} {:d}'.format(name, endpoint, cumulative)
+            )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,306 @@
+"""
+Versioned database index migrations.
+
+The indexes of every collection are declared in INDEXES. Migrating creates
+any declared index which is missing, one at a time as background builds. An
+existing index whose keys or options differ from its declaration is
+reported but left alone: to change an index, declare it under a new name.
+
+Indexes which are no longer declared are listed, but only dropped on
+request (daemons/migrate_db.py --drop-undeclared), after the declared ones
+are built so that queries stay indexed throughout.
+
+The applied version is stored in the schema_version collection. Workers only
+compare it to INDEX_VERSION on startup; migrations are run by
+daemons/migrate_db.py, or by workers if MONGO_AUTO_MIGRATE is set.
+"""
+
+import logging
+
+import pymongo
+from pymongo import IndexModel
+from pymongo.collation import Collation, CollationStrength
+
+log = logging.getLogger(__name__)
+
+# Increment whenever INDEXES changes
+INDEX_VERSION = 1
+
+SCHEMA_VERSION_ID = "indexes"
+
+# Log collections indexed by time, expiring after their configured retention
+TIME_INDEXED_COLLECTIONS = {
+    "exceptions": "EXCEPTIONS_RETENTION_DAYS",
+    "statistics": "STATISTICS_RETENTION_DAYS",
+}
+
+_case_insensitive = Collation(locale="en", strength=CollationStrength.PRIMARY)
+
+INDEXES = {
+    "achievements": [IndexModel("aid")],
+    "bundles": [IndexModel("bid")],
+    "earned_achievements": [IndexModel("tid"), IndexModel("uid")],
+    "exceptions": [
+        IndexModel("fingerprint", unique=True, sparse=True, name="unique fingerprint")
+    ],
+    "groups": [
+        IndexModel("gid", unique=True, name="unique gid"),
+        IndexModel("owner", name="owner"),
+        IndexModel("teachers", name="teachers"),
+        IndexModel("members", name="members"),
+        IndexModel([("owner", 1), ("name", 1)], unique=True, name="name and owner"),
+    ],
+    "problem_feedback": [
+        IndexModel([("pid", 1), ("uid", 1)]),
+        IndexModel("uid"),
+        IndexModel("tid"),
+    ],
+    "problems": [
+        IndexModel("pid", unique=True, name="unique pid"),
+        IndexModel("disabled"),
+        IndexModel("category"),
+        IndexModel([("score", pymongo.ASCENDING), ("name", pymongo.ASCENDING)]),
+    ],
+    "scoreboards": [IndexModel("sid", unique=True, name="unique scoreboard sid")],
+    "shell_servers": [IndexModel("sid", unique=True, name="unique shell sid")],
+    "submissions": [
+        IndexModel([("pid", 1), ("uid", 1), ("correct", 1)]),
+        IndexModel([("pid", 1), ("tid", 1), ("correct", 1)]),
+        IndexModel([("uid", 1), ("correct", 1)]),
+        IndexModel([("tid", 1), ("correct", 1)]),
+        IndexModel([("uid", 1), ("category", 1), ("correct", 1)]),
+        IndexModel([("tid", 1), ("category", 1), ("correct", 1)]),
+        IndexModel([("pid", 1), ("correct", 1)]),
+        IndexModel("uid"),
+        IndexModel("tid"),
+        IndexModel("suspicious"),
+        IndexModel([("correct", 1), ("timestamp", 1)]),
+    ],
+    "teams": [
+        IndexModel("team_name", unique=True, name="unique team_names"),
+        IndexModel(
+            "team_name",
+            unique=True,
+            collation=_case_insensitive,
+            name="unique normalized team names",
+        ),
+        IndexModel("tid", unique=True, name="unique tid"),
+        IndexModel(
+            "eligibilities",
+            name="non-empty eligiblity",
+            partialFilterExpression={"size": {"$gt": 0}},
+        ),
+        IndexModel(
+            "size", name="non-empty size", partialFilterExpression={"size": {"$gt": 0}},
+        ),
+    ],
+    "tokens": [
+        IndexModel("uid"),
+        IndexModel("gid"),
+        IndexModel("tokens.registration_token"),
+        IndexModel("tokens.email_verification"),
+        IndexModel("tokens.password_reset"),
+    ],
+    "user_agents": [IndexModel("hash", unique=True, name="unique user agent hash")],
+    "users": [
+        IndexModel("uid", unique=True, name="unique uid"),
+        IndexModel("username", unique=True, name="unique usernames"),
+        IndexModel(
+            "username",
+            unique=True,
+            collation=_case_insensitive,
+            name="unique normalized usernames",
+        ),
+        IndexModel("tid"),
+        IndexModel("email"),
+        IndexModel("demo.parentemail"),
+    ],
+}
+
+
+def _expected_schema(conf):
+    """Get the schema version document the current code and config expect."""
+    return {
+        "version": INDEX_VERSION,
+        "retention": {
+            collection: conf[setting]
+            for collection, setting in TIME_INDEXED_COLLECTIONS.items()
+        },
+    }
+
+
+def get_schema(db):
+    """
+    Get the applied schema version document.
+
+    Args:
+        db: the database
+    Returns:
+        the document, or None if no migration has been applied
+    """
+    return db.schema_version.find_one({"_id": SCHEMA_VERSION_ID}, {"_id": 0})
+
+
+def check_schema(db, conf):
+    """
+    Check that the database's indexes match the current code and config.
+
+    Migrates the database if they do not and MONGO_AUTO_MIGRATE is set.
+
+    Args:
+        db: the database
+        conf: the app config
+    Returns:
+        whether the indexes are up to date
+    """
+    schema = get_schema(db)
+    if schema == _expected_schema(conf):
+        return True
+    if schema is not None and schema["version"] > INDEX_VERSION:
+        log.warning(
+            "Database indexes are at version {}, newer than this code's {}.".format(
+                schema["version"], INDEX_VERSION
+            )
+        )
+        return False
+    if conf["MONGO_AUTO_MIGRATE"]:
+        migrate(db, conf)
+        return True
+    log.warning(
+        "Database indexes are out of date: run daemons/migrate_db.py to apply "
+        "version {}.".format(INDEX_VERSION)
+    )
+    return False
+
+
+def _index_matches(existing, declared):
+    """
+    Check whether an existing index matches its declaration.
+
+    Options which do not affect queries, like background, are not compared.
+
+    Args:
+        existing: the index's entry in index_information()
+        declared: the document of the declared IndexModel
+    Returns:
+        whether their keys and compared options are the same
+    """
+    if existing["key"] != list(declared["key"].items()):
+        return False
+    for option in ("unique", "sparse"):
+        if bool(existing.get(option)) != bool(declared.get(option)):
+            return False
+    if existing.get("partialFilterExpression") != declared.get(
+        "partialFilterExpression"
+    ):
+        return False
+    # The server fills in the defaults of a collation
+    existing_collation = existing.get("collation")
+    declared_collation = declared.get("collation")
+    if existing_collation is None or declared_collation is None:
+        return existing_collation is None and declared_collation is None
+    return all(
+        existing_collation.get(field) == value
+        for field, value in declared_collation.items()
+    )
+
+
+def plan_migration(db):
+    """
+    Compare the database's indexes to the declared ones.
+
+    Args:
+        db: the database
+    Returns:
+        tuple of lists of (collection, IndexModel) to create, of
+        (collection, index name) which are undeclared, and of
+        (collection, index name) which differ from their declarations
+    """
+    to_create = []
+    to_drop = []
+    mismatched = []
+    existing_collections = set(db.list_collection_names())
+    for collection, indexes in sorted(INDEXES.items()):
+        existing = {}
+        if collection in existing_collections:
+            existing = db[collection].index_information()
+        declared = set()
+        for index in indexes:
+            name = index.document["name"]
+            declared.add(name)
+            if name not in existing:
+                to_create.append((collection, index))
+            elif not _index_matches(existing[name], index.document):
+                mismatched.append((collection, name))
+        for name in existing:
+            if name not in declared and name not in ("_id_", "time_-1"):
+                to_drop.append((collection, name))
+    return to_create, to_drop, mismatched
+
+
+def migrate(db, conf, progress=log.info, drop_undeclared=False):
+    """
+    Bring the database's indexes up to date and record the applied version.
+
+    Args:
+        db: the database
+        conf: the app config
+        progress: Optional, called with a message before each change
+        drop_undeclared: Optional, drop indexes which are no longer declared
+                         rather than only listing them
+    """
+    to_create, to_drop, mismatched = plan_migration(db)
+    for collection, name in mismatched:
+        log.error(
+            "Index {} of {} does not match its declaration; declare "
+            "changed indexes under a new name.".format(name, collection)
+        )
+    for collection, index in to_create:
+        progress("Building index {} of {}".format(index.document["name"], collection))
+        options = {
+            field: value
+            for field, value in index.document.items()
+            if field not in ("key", "name")
+        }
+        db[collection].create_index(
+            list(index.document["key"].items()),
+            name=index.document["name"],
+            background=True,
+            **options
+        )
+    for collection, name in to_drop:
+        if drop_undeclared:
+            progress("Dropping index {} of {}".format(name, collection))
+            db[collection].drop_index(name)
+        else:
+            progress("Keeping undeclared index {} of {}".format(name, collection))
+    for collection, setting in TIME_INDEXED_COLLECTIONS.items():
+        _ensure_time_index(db[collection], conf[setting])
+
+    db.schema_version.replace_one(
+        {"_id": SCHEMA_VERSION_ID}, _expected_schema(conf), upsert=True
+    )
+
+
+def _ensure_time_index(collection, retention_days):
+    """
+    Index a log collection by time, expiring old documents if configured.
+
+    Args:
+        collection: the collection, whose documents have a "time" field
+        retention_days: days after which documents are deleted, or None to
+                        keep them forever
+    """
+    seconds = retention_days * 24 * 60 * 60 if retention_days else None
+    existing = collection.index_information().get("time_-1")
+    if existing is not None and existing.get("expireAfterSeconds") != seconds:
+        if existing.get("expireAfterSeconds") is not None and seconds is not None:
+            collection.database.command(
+                "collMod",
+                collection.name,
+                index={"keyPattern": {"time": -1}, "expireAfterSeconds": seconds},
+            )
+            return
+        collection.drop_index("time_-1")
+    options = {"expireAfterSeconds": seconds} if seconds else {}
+    collection.create_index([("time", pymongo.DESCENDING)], background=True, **options)
@@ -128,9 +128,11 @@ def upsert_problem(problem, sid):
         problem["disabled"] = existing["disabled"] or len(problem["instances"]) == 0
 
         db.problems.find_one_and_update({"pid": problem["pid"]}, {"$set": problem})
+        api.cache.bump_version("problems")
         return problem["pid"]
 
     db.problems.insert(problem)
+    api.cache.bump_version("problems")
     return problem["pid"]
 
 
@@ -431,7 +433,7 @@ def load_published(data):
         for bundle in data["bundles"]:
             api.bundles.upsert_bundle(bundle)
 
-    api.cache.clear()
+    api.stats.clear_cache()
 
 
 def sanitize_problem_data(data):
@@ -508,7 +510,7 @@ def set_problem_availability(pid, disabled):
     if not success:
         return None
     else:
-        api.cache.clear()
+        api.stats.clear_cache()
         return pid
 
 
@@ -545,3 +547,4 @@ def unlock_walkthrough(uid, pid, cost):
         {"uid": uid, "tokens": {"$gte": cost}, "unlocked_walkthroughs": {"$ne": pid}},
         {"$addToSet": {"unlocked_walkthroughs": pid}, "$inc": {"tokens": (cost * -1)}},
     )
+    api.cache.bump_version("user:{}".format(uid))
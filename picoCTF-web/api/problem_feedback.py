@@ -23,7 +23,9 @@ feedback_schema = Schema(
 )
 
 
-def get_problem_feedback(pid=None, tid=None, uid=None, count_only=False):
+def get_problem_feedback(
+    pid=None, tid=None, uid=None, count_only=False, analytics=False
+):
     """
     Retrieve feedback for a given problem, team, or user.
 
@@ -32,10 +34,15 @@ def get_problem_feedback(pid=None, tid=None, uid=None, count_only=False):
         tid: the team id
         uid: the user id
         count_only: only sums likes dislikes instead of full feedback entries
+        analytics: read as an analytics listing, which may lag behind
+                   recently submitted feedback
     Returns:
         A list of problem feedback entries.
     """
-    db = api.db.get_conn()
+    if analytics:
+        db = api.db.get_analytics_conn("get_problem_feedback")
+    else:
+        db = api.db.get_conn()
     match = {}
 
     if pid is not None:
@@ -106,3 +113,5 @@ def upsert_feedback(pid, feedback):
         #     "tid": team['tid'],
         #     "pid": pid
         # })
+    # Only admins' problem lists, which include feedback counts, depend on this
+    api.cache.bump_version("problem_feedback")
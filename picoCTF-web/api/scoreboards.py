@@ -62,6 +62,7 @@ def add_scoreboard(
             "logo": logo,
         }
     )
+    api.cache.bump_version("scoreboards")
     return sid
 
 
@@ -101,6 +101,7 @@ def add_server(*ignore, name, host, port, username, password, protocol, server_n
             "server_number": server_number,
         }
     )
+    api.cache.bump_version("shell_servers")
     return sid
 
 
@@ -133,6 +134,7 @@ def update_server(sid, updates):
         )
 
     success = db.shell_servers.find_one_and_update({"sid": sid}, {"$set": updates})
+    api.cache.bump_version("shell_servers")
     if not success:
         return None
     else:
@@ -153,6 +155,7 @@ def remove_server(sid):
     """
     db = api.db.get_conn()
     res = db.shell_servers.find_one_and_delete({"sid": sid})
+    api.cache.bump_version("shell_servers")
     if res is None:
         return None
     else:
@@ -264,7 +267,6 @@ def get_assigned_server_number(new_team=True, tid=None):
          (int) server_number
 
     """
-    settings = api.config.get_settings()["shell_servers"]
     db = api.db.get_conn()
 
     if new_team:
@@ -277,25 +279,47 @@ def get_assigned_server_number(new_team=True, tid=None):
             raise PicoException("Invalid tid.")
         team_count = db.teams.count({"_id": {"$lt": oid["_id"]}})
 
-    assigned_number = 1
+    return _get_server_numbers(team_count, 1)[0]
+
+
+def get_new_team_server_numbers(count):
+    """
+    Assign server numbers to several teams about to be created together.
+
+    Args:
+        count: the number of new teams
+    Returns:
+        list of (int) server_number, in creation order
+
+    """
+    return _get_server_numbers(api.db.get_conn().teams.count(), count)
+
 
+def _get_server_numbers(team_count, count):
+    """Assign server numbers to the teams created after team_count others."""
+    settings = api.config.get_settings()["shell_servers"]
+    db = api.db.get_conn()
     steps = settings["steps"]
 
-    if steps:
-        if team_count < steps[-1]:
-            for i, step in enumerate(steps):
-                if team_count < step:
-                    assigned_number = i + 1
-                    break
-        else:
-            assigned_number = (
-                1
-                + len(steps)
-                + (team_count - steps[-1]) // settings["default_stepping"]
-            )
+    assigned_numbers = []
+    for team_count in range(team_count, team_count + count):
+        assigned_number = 1
+        if steps:
+            if team_count < steps[-1]:
+                for i, step in enumerate(steps):
+                    if team_count < step:
+                        assigned_number = i + 1
+                        break
+            else:
+                assigned_number = (
+                    1
+                    + len(steps)
+                    + (team_count - steps[-1]) // settings["default_stepping"]
+                )
 
-    else:
-        assigned_number = team_count // settings["default_stepping"] + 1
+        else:
+            assigned_number = team_count // settings["default_stepping"] + 1
+        assigned_numbers.append(assigned_number)
 
     if settings["limit_added_range"]:
         max_number = list(
@@ -303,9 +327,9 @@ def get_assigned_server_number(new_team=True, tid=None):
             .sort("server_number", -1)
             .limit(1)
         )[0]["server_number"]
-        return min(max_number, assigned_number)
+        return [min(max_number, number) for number in assigned_numbers]
     else:
-        return assigned_number
+        return assigned_numbers
 
 
 def reassign_teams(include_assigned=False):
@@ -329,5 +353,6 @@ def reassign_teams(include_assigned=False):
             )
             # Re-assign instances
             api.problem.get_unlocked_pids(team["tid"])
+    api.cache.bump_version("shell_servers")
 
     return len(teams)
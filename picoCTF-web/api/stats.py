@@ -1,22 +1,79 @@
 """Module for calculating gameplay statistics."""
 
+import bisect
 import datetime
+import json
 import math
 import pymongo
 
 import api
 from api.cache import (
-    decode_scoreboard_item,
+    decode_scoreboard_items,
+    decode_scoreboard_score,
+    encode_scoreboard_score,
     get_score_cache,
     get_scoreboard_cache,
-    get_scoreboard_key,
+    get_scoreboard_score_cache,
+    index_scoreboard_teams,
     memoize,
+    remove_scoreboard_teams,
     search_scoreboard_cache,
+    set_scoreboard_teams,
 )
 from api import PicoException
 
 
 SCOREBOARD_PAGE_LEN = 50
+EXPORT_BATCH_SIZE = 1000
+
+SNAPSHOT_PAGE_KEY = "scoreboard_snapshot:{}:page:{}"
+SNAPSHOT_PAGES_KEY = "scoreboard_snapshot:{}:pages"
+# Set of the keys of snapshotted scoreboards
+SNAPSHOT_BOARDS_KEY = "scoreboard_snapshots"
+
+DIRTY_GROUPS_KEY = "dirty_groups"
+REFRESH_BATCH_SIZE = 1000
+
+SCORE_TIMELINE_KEY = "score_timeline:{}"
+SCORE_TIMELINE_PIDS_KEY = "score_timeline:{}:pids"
+# Incremented by every change to a team's solves, so that rebuilds which
+# raced with one are discarded
+SCORE_TIMELINE_GENERATION_KEY = "score_timeline:{}:generation"
+SCORE_TIMELINE_HEAD = "0:0"
+
+# Atomically appends "time:cumulative score" to an existing timeline, unless
+# the problem (ARGV[3]) is already counted in it
+_APPEND_TIMELINE_SCRIPT = """
+redis.call("INCR", KEYS[3])
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return nil
+end
+if redis.call("SADD", KEYS[2], ARGV[3]) == 0 then
+    return nil
+end
+local last = redis.call("LINDEX", KEYS[1], -1)
+local score = tonumber(string.match(last, ":(%d+)$")) + tonumber(ARGV[2])
+redis.call("RPUSH", KEYS[1], ARGV[1] .. ":" .. score)
+return score
+"""
+
+# Stores a rebuilt timeline only if it is still missing and no solve was
+# appended since the rebuild read its generation
+_STORE_TIMELINE_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+if (redis.call("GET", KEYS[3]) or "") ~= ARGV[1] then
+    return 0
+end
+local entries = tonumber(ARGV[2])
+redis.call("DEL", KEYS[2])
+redis.call("RPUSH", KEYS[1], unpack(ARGV, 3, 2 + entries))
+if #ARGV > 2 + entries then
+    redis.call("SADD", KEYS[2], unpack(ARGV, 3 + entries))
+end
+return 1
+"""
 
 
 def _get_problem_names(problems):
@@ -73,6 +130,124 @@ def get_score(tid=None, uid=None, time_weighted=True):
         return int(score)
 
 
+def get_scoreboard_score(tid):
+    """
+    Get a team's encoded scoreboard score, which includes its tie-break.
+
+    Memoized in a zset alongside get_score, and invalidated with it.
+
+    Args:
+        tid: The team id
+    Returns:
+        int: the team's score and last solve time, as encoded by
+        api.cache.encode_scoreboard_score
+    """
+    score_cache = get_scoreboard_score_cache()
+    value = score_cache.score(tid)
+
+    # Not cached
+    if value is None:
+        solved_problems = api.problem.get_solved_problems(tid=tid)
+        score = sum([problem["score"] for problem in solved_problems])
+        last_solve_time = 0
+        if score > 0:
+            last_solve_time = max(
+                problem["solve_time"] for problem in solved_problems
+            ).timestamp()
+        value = encode_scoreboard_score(score, last_solve_time)
+        score_cache.add({tid: value})
+    return int(value)
+
+
+def _get_scoreboard_scores(tids):
+    """
+    Get the encoded scoreboard scores for a batch of teams in one round trip.
+
+    Scores which are not yet cached are calculated (and cached) individually.
+
+    Args:
+        tids: list of team ids
+
+    Returns:
+        list of int encoded scores, in the same order as tids
+
+    """
+    score_cache = get_scoreboard_score_cache()
+    pipe = api.cache.get_conn().pipeline(transaction=False)
+    for tid in tids:
+        pipe.zscore(score_cache.key, tid)
+    cached_scores = pipe.execute()
+    return [
+        int(value) if value is not None else get_scoreboard_score(tid)
+        for tid, value in zip(tids, cached_scores)
+    ]
+
+
+def _replace_scoreboard(board_key, scores, teams):
+    """
+    Atomically replace a scoreboard's contents, so readers never see it empty.
+
+    Also brings the scoreboard's search index up to date, and forgets the
+    metadata of teams which left it for no other scoreboard. Does nothing if
+    the scoreboard was written by a newer stats leader.
+
+    Args:
+        board_key: key of the scoreboard ZSet
+        scores: dict of tid to encoded score
+        teams: dict of tid to team dict, for at least the teams in scores
+    """
+
+    def write(pipe):
+        pipe.delete(board_key)
+        if scores:
+            pipe.zadd(board_key, scores)
+
+    if not api.cache.fenced_write(board_key, write):
+        return
+    removed = index_scoreboard_teams(board_key, {tid: teams[tid] for tid in scores})
+    _prune_scoreboard_teams(removed)
+    api.cache.bump_version(board_key)
+
+
+def _prune_scoreboard_teams(tids):
+    """
+    Forget the display metadata of teams which are on no stored scoreboard.
+
+    Args:
+        tids: ids of teams which just left a scoreboard
+    """
+    if not tids:
+        return
+    db = api.db.get_conn()
+    boards = {
+        team["tid"]: [
+            get_scoreboard_cache(scoreboard_id=scoreboard_id).key
+            for scoreboard_id in team.get("eligibilities", [])
+        ]
+        for team in db.teams.find(
+            {"tid": {"$in": tids}, "size": {"$gt": 0}},
+            {"_id": 0, "tid": 1, "eligibilities": 1},
+        )
+    }
+    for group in db.groups.find(
+        {"members": {"$in": list(boards.keys())}}, {"_id": 0, "gid": 1, "members": 1}
+    ):
+        for tid in group["members"]:
+            if tid in boards:
+                boards[tid].append(get_scoreboard_cache(group_id=group["gid"]).key)
+
+    candidates = [(tid, key) for tid, keys in boards.items() for key in keys]
+    pipe = api.cache.get_conn().pipeline(transaction=False)
+    for tid, key in candidates:
+        pipe.zscore(key, tid)
+    listed = {
+        tid
+        for (tid, _), score in zip(candidates, pipe.execute() if candidates else [])
+        if score is not None
+    }
+    remove_scoreboard_teams([tid for tid in tids if tid not in listed])
+
+
 def get_team_review_count(tid=None, uid=None):
     """
     Get the count of reviewed problems for a user or team.
@@ -101,26 +276,107 @@ def get_group_scores(gid=None, name=None):
         gid: The group id
         name: The group name
     Returns:
-        A dictionary containing name, tid, and score
+        The group's scoreboard ZSet
     """
-    key_args = {"group_id": gid}
-    scoreboard_cache = get_scoreboard_cache(**key_args)
-    scoreboard_cache.clear()
+    return get_scoreboard_cache(group_id=gid)
 
-    member_teams = [
-        api.team.get_team(tid=tid) for tid in api.group.get_group(gid=gid)["members"]
-    ]
 
-    result = {}
-    for team in member_teams:
-        if team["size"] > 0:
-            score = get_score(tid=team["tid"])
-            key = get_scoreboard_key(team)
-            result[key] = score
-    if result:
-        scoreboard_cache.add(result)
+def mark_groups_dirty(*gids):
+    """
+    Mark group scoreboards for rebuilding by the cache_stats daemon.
+
+    Args:
+        gids: The group ids
+    """
+    if gids:
+        api.cache.get_conn().sadd(DIRTY_GROUPS_KEY, *gids)
 
-    return scoreboard_cache
+
+def mark_team_groups_dirty(tid):
+    """
+    Mark the scoreboards of all of a team's groups for rebuilding.
+
+    Args:
+        tid: The team id
+    """
+    mark_groups_dirty(*[group["gid"] for group in api.team.get_groups(tid=tid)])
+
+
+def mark_all_groups_dirty():
+    """Mark every group's scoreboard for rebuilding."""
+    mark_groups_dirty(*[group["gid"] for group in api.group.get_all_groups()])
+
+
+def clear_cache():
+    """
+    Flush the cache, marking every group scoreboard for rebuilding.
+
+    Group scoreboards are only rebuilt when marked dirty, so they would
+    otherwise stay empty after the flush until a member's score changed.
+    """
+    api.cache.clear()
+    mark_all_groups_dirty()
+
+
+def refresh_group_scores(gids=None):
+    """
+    Rebuild group scoreboards.
+
+    Args:
+        gids: Optional, the groups to rebuild. Defaults to the groups
+              marked dirty, which are then unmarked.
+    Returns:
+        The ids of the rebuilt groups
+    """
+    conn = api.cache.get_conn()
+    if gids is None:
+        gids = []
+        while True:
+            batch = conn.spop(DIRTY_GROUPS_KEY, REFRESH_BATCH_SIZE)
+            if not batch:
+                break
+            gids.extend(gid.decode("utf-8") for gid in batch)
+    if not gids:
+        return []
+
+    try:
+        db = api.db.get_conn()
+        groups = {
+            group["gid"]: group
+            for group in db.groups.find(
+                {"gid": {"$in": gids}}, {"_id": 0, "gid": 1, "members": 1}
+            )
+        }
+        member_tids = list(
+            {tid for group in groups.values() for tid in group["members"]}
+        )
+        teams = list(
+            db.teams.find(
+                {"tid": {"$in": member_tids}, "size": {"$gt": 0}},
+                {"_id": 0, "tid": 1, "team_name": 1, "affiliation": 1},
+            )
+        )
+        set_scoreboard_teams(teams)
+        tids = [team["tid"] for team in teams]
+        scores = dict(zip(tids, _get_scoreboard_scores(tids)))
+        teams = dict(zip(tids, teams))
+
+        for gid in gids:
+            board_key = get_scoreboard_cache(group_id=gid).key
+            if gid not in groups:
+                # The group was deleted
+                _prune_scoreboard_teams(api.cache.delete_scoreboard(board_key))
+                api.cache.bump_version(board_key)
+                continue
+            _replace_scoreboard(
+                board_key,
+                {tid: scores[tid] for tid in groups[gid]["members"] if tid in scores},
+                teams,
+            )
+    except Exception:
+        mark_groups_dirty(*gids)
+        raise
+    return gids
 
 
 def get_group_average_score(gid=None, name=None):
@@ -135,7 +391,7 @@ def get_group_average_score(gid=None, name=None):
     """
     group_scoreboard = get_group_scores(gid=gid, name=name)
     group_scores = group_scoreboard.as_items()
-    total_score = sum([int(item[1]) for item in group_scores])
+    total_score = sum([decode_scoreboard_score(item[1]) for item in group_scores])
     return int(total_score / len(group_scores)) if len(group_scores) > 0 else 0
 
 
@@ -152,11 +408,38 @@ def get_all_team_scores(scoreboard_id=None):
 
     """
     key_args = {"scoreboard_id": scoreboard_id}
-    teams = api.team.get_all_teams(**key_args)
     scoreboard_cache = get_scoreboard_cache(**key_args)
 
-    result = {}
+    teams = _get_scoreboard_teams(scoreboard_id=scoreboard_id)
+    tids = [team["tid"] for team in teams]
+    scores = {
+        tid: score
+        for tid, score in zip(tids, _get_scoreboard_scores(tids))
+        if score > 0
+    }
+    # Only teams on the board need display metadata
+    set_scoreboard_teams([team for team in teams if team["tid"] in scores])
+    _replace_scoreboard(scoreboard_cache.key, scores, dict(zip(tids, teams)))
+    return scoreboard_cache
+
+
+def _get_scoreboard_teams(scoreboard_id=None):
+    """
+    Get the teams which appear on a scoreboard.
+
+    Teams which are exclusively members of hidden groups are excluded.
+
+    Args:
+        scoreboard_id: Optional, limit to teams eligible for this scoreboard
+
+    Returns:
+        A list of team dicts
+
+    """
+    teams = api.team.get_all_teams(scoreboard_id=scoreboard_id)
     all_groups = api.group.get_all_groups()
+
+    result = []
     for team in teams:
         # Get the full version of the group.
         groups = [
@@ -172,14 +455,8 @@ def get_all_team_scores(scoreboard_id=None):
         if len(groups) == 0 or any(
             [not (group["settings"]["hidden"]) for group in groups]
         ):
-            score = get_score(tid=team["tid"])
-            if score > 0:
-                key = get_scoreboard_key(team=team)
-                result[key] = score
-    scoreboard_cache.clear()
-    if result:
-        scoreboard_cache.add(result)
-    return scoreboard_cache
+            result.append(team)
+    return result
 
 
 def get_all_user_scores():
@@ -190,18 +467,75 @@ def get_all_user_scores():
         A list of dictionaries with name and score
 
     """
-    users = api.user.get_all_users()
+    return sorted(iter_all_user_scores(), key=lambda item: item["score"], reverse=True)
 
-    result = []
-    for user in users:
-        result.append(
-            {
-                "name": user["username"],
-                "score": get_score(uid=user["uid"], time_weighted=False),
-            }
-        )
 
-    return sorted(result, key=lambda item: item["score"], reverse=True)
+def iter_all_user_scores():
+    """
+    Iterate over the score of every user in the database.
+
+    Unlike get_all_user_scores(), rows are produced in database order as
+    they are read, so this is suitable for streaming exports.
+
+    Yields:
+        dicts with name and score
+
+    """
+    for user, score in _iter_users_with_scores({"username": 1}, "iter_all_user_scores"):
+        yield {"name": user["username"], "score": score}
+
+
+def _iter_users_with_scores(projection, function):
+    """
+    Iterate over all users along with their (non time-weighted) scores.
+
+    Users are read through a server-side cursor, and their scores are
+    fetched from the score cache in pipelined batches.
+
+    Args:
+        projection: user fields to retrieve in addition to the uid
+        function: name of the calling analytics function, to route its reads
+
+    Yields:
+        (user dict, int score) tuples
+
+    """
+    db = api.db.get_analytics_conn(function)
+    projection = dict(projection, uid=1, _id=0)
+    cursor = db.users.find({}, projection, batch_size=EXPORT_BATCH_SIZE)
+
+    batch = []
+    for user in cursor:
+        batch.append(user)
+        if len(batch) == EXPORT_BATCH_SIZE:
+            yield from zip(batch, _get_user_scores([u["uid"] for u in batch]))
+            batch = []
+    if batch:
+        yield from zip(batch, _get_user_scores([u["uid"] for u in batch]))
+
+
+def _get_user_scores(uids):
+    """
+    Get the scores for a batch of users in a single round trip.
+
+    Scores which are not yet cached are calculated (and cached) individually.
+
+    Args:
+        uids: list of user ids
+
+    Returns:
+        list of int scores, in the same order as uids
+
+    """
+    score_cache = get_score_cache()
+    pipe = api.cache.get_conn().pipeline(transaction=False)
+    for uid in uids:
+        pipe.zscore(score_cache.key, uid)
+    cached_scores = pipe.execute()
+    return [
+        int(score) if score is not None else get_score(uid=uid, time_weighted=False)
+        for uid, score in zip(uids, cached_scores)
+    ]
 
 
 @memoize(timeout=120)
@@ -252,17 +586,21 @@ def get_problem_submission_stats(pid=None):
     Returns:
         Dict of {valid: #, invalid: #}
     """
+    db = api.db.get_analytics_conn("get_problem_submission_stats")
+    match = {} if pid is None else {"pid": pid}
     return {
-        "valid": len(api.submissions.get_submissions(pid, correctness=True)),
-        "invalid": len(api.submissions.get_submissions(pid, correctness=False)),
+        "valid": db.submissions.count_documents(dict(match, correct=True)),
+        "invalid": db.submissions.count_documents(dict(match, correct=False)),
     }
 
 
-@memoize(timeout=3 * 24 * 60 * 60)
 def get_score_progression(tid=None, uid=None, category=None):
     """
     Find the score and time after each correct submission of a team or user.
 
+    Unfiltered team progressions are read from the team's score timeline.
+    Other progressions are calculated from the solved problems and memoized.
+
     NOTE: this is slower than get_score.
           Do not use this for getting current score.
 
@@ -273,6 +611,19 @@ def get_score_progression(tid=None, uid=None, category=None):
     Returns:
         A list of dictionaries containing score and time
     """
+    if tid is not None and uid is None and category is None:
+        return get_score_timeline(tid)
+    return _get_filtered_score_progression(tid=tid, uid=uid, category=category)
+
+
+@memoize(timeout=3 * 24 * 60 * 60)
+def _get_filtered_score_progression(tid=None, uid=None, category=None):
+    """Memoized wrapper around _calculate_score_progression()."""
+    return _calculate_score_progression(tid=tid, uid=uid, category=category)
+
+
+def _calculate_score_progression(tid=None, uid=None, category=None):
+    """Calculate a score progression from the solved problems."""
     solved_kwargs = {}
     if tid is not None:
         solved_kwargs["tid"] = tid
@@ -296,6 +647,98 @@ def get_score_progression(tid=None, uid=None, category=None):
     return result
 
 
+def _encode_timeline_entry(entry):
+    return "{}:{}".format(entry["time"], entry["score"])
+
+
+def _decode_timeline_entry(entry):
+    time, score = entry.decode("utf-8").split(":")
+    return {"score": int(score), "time": int(time)}
+
+
+def get_score_timeline(tid):
+    """
+    Get a team's score timeline, rebuilding it if it is not stored.
+
+    The timeline is an append-only redis list of "time:cumulative score"
+    entries, headed by a placeholder entry so that teams without any
+    solves are still considered to be stored. The pids it counts are kept
+    in a set alongside it.
+
+    Args:
+        tid: the team id
+    Returns:
+        A list of dictionaries containing score and time
+    """
+    entries = api.cache.get_conn().lrange(SCORE_TIMELINE_KEY.format(tid), 0, -1)
+    if not entries:
+        return rebuild_score_timeline(tid)
+    return [_decode_timeline_entry(entry) for entry in entries[1:]]
+
+
+def rebuild_score_timeline(tid):
+    """
+    Rebuild a team's score timeline from its solved problems.
+
+    The rebuilt timeline is only stored if no other rebuild stored one first
+    and no solve was appended while it was calculated, as the calculation
+    may not include that solve. Otherwise it is left to the next read.
+
+    Args:
+        tid: the team id
+    Returns:
+        The rebuilt score progression
+    """
+    conn = api.cache.get_conn()
+    generation = conn.get(SCORE_TIMELINE_GENERATION_KEY.format(tid))
+    progression = _calculate_score_progression(tid=tid)
+    pids = api.problem.get_solved_pids(tid=tid)
+    entries = [SCORE_TIMELINE_HEAD] + [_encode_timeline_entry(e) for e in progression]
+    store = conn.register_script(_STORE_TIMELINE_SCRIPT)
+    store(
+        keys=[
+            SCORE_TIMELINE_KEY.format(tid),
+            SCORE_TIMELINE_PIDS_KEY.format(tid),
+            SCORE_TIMELINE_GENERATION_KEY.format(tid),
+        ],
+        args=[generation or "", len(entries)] + entries + pids,
+    )
+    return progression
+
+
+def append_score_timeline(tid, pid, score, solve_time):
+    """
+    Append a newly solved problem to a team's score timeline.
+
+    Does nothing if the timeline is not currently stored, as it will be
+    rebuilt in full the next time it is read, or if it already counts the
+    problem, as when it was rebuilt after the solve was submitted.
+
+    Args:
+        tid: the team id
+        pid: the solved problem's pid
+        score: point value of the solved problem
+        solve_time: datetime of the solve
+    """
+    append = api.cache.get_conn().register_script(_APPEND_TIMELINE_SCRIPT)
+    append(
+        keys=[
+            SCORE_TIMELINE_KEY.format(tid),
+            SCORE_TIMELINE_PIDS_KEY.format(tid),
+            SCORE_TIMELINE_GENERATION_KEY.format(tid),
+        ],
+        args=[int(solve_time.timestamp()), score, pid],
+    )
+
+
+def invalidate_score_timeline(tid):
+    """Remove a team's score timeline so that it is rebuilt on next read."""
+    pipe = api.cache.get_conn().pipeline()
+    pipe.delete(SCORE_TIMELINE_KEY.format(tid), SCORE_TIMELINE_PIDS_KEY.format(tid))
+    pipe.incr(SCORE_TIMELINE_GENERATION_KEY.format(tid))
+    pipe.execute()
+
+
 # Stored by the cache_stats daemon
 @memoize
 def get_problem_solves(pid):
@@ -329,8 +772,7 @@ def get_top_teams_score_progressions(limit=5, scoreboard_id=None, group_id=None)
 
     """
 
-    def output_item(item):
-        data = decode_scoreboard_item(item)
+    def output_item(data):
         return {
             "name": data["name"],
             "affiliation": data["affiliation"],
@@ -343,14 +785,123 @@ def get_top_teams_score_progressions(limit=5, scoreboard_id=None, group_id=None)
         scoreboard_cache = get_group_scores(gid=group_id)
 
     team_items = scoreboard_cache.range(0, limit - 1, with_scores=True, desc=True)
-    return [output_item(team_item) for team_item in team_items]
+    return [output_item(team_item) for team_item in decode_scoreboard_items(team_items)]
+
+
+def downsample_score_progression(progression, max_points):
+    """
+    Reduce a score progression to at most max_points points.
+
+    Uses the Largest-Triangle-Three-Buckets algorithm, which keeps the first
+    and last points and, for each bucket in between, the point forming the
+    largest triangle with its neighbours, preserving the visual shape.
+
+    Args:
+        progression: list of {score, time} dicts, sorted by time
+        max_points: maximum number of points to return
+    Returns:
+        The downsampled progression
+    """
+    if len(progression) <= max_points:
+        return progression
+    if max_points <= 2:
+        return [progression[0], progression[-1]][-max_points:]
+
+    sampled = [progression[0]]
+    bucket_size = (len(progression) - 2) / (max_points - 2)
+    selected = 0
+    for bucket in range(max_points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+
+        # Average of the next bucket (or the last point)
+        next_end = min(int((bucket + 2) * bucket_size) + 1, len(progression))
+        next_points = progression[end:next_end] or progression[-1:]
+        avg_time = sum(p["time"] for p in next_points) / len(next_points)
+        avg_score = sum(p["score"] for p in next_points) / len(next_points)
+
+        a = progression[selected]
+        best_area = -1
+        for i in range(start, end):
+            p = progression[i]
+            area = abs(
+                (a["time"] - avg_time) * (p["score"] - a["score"])
+                - (a["time"] - p["time"]) * (avg_score - a["score"])
+            )
+            if area > best_area:
+                best_area = area
+                selected = i
+        sampled.append(progression[selected])
+    sampled.append(progression[-1])
+    return sampled
+
+
+def align_score_progressions(progressions, max_points):
+    """
+    Sample score progressions on a shared, evenly spaced time grid.
+
+    Each progression is treated as a step function; a team's score at a grid
+    time is its score after its last solve at or before that time.
+
+    Args:
+        progressions: list of score progressions (lists of {score, time})
+        max_points: number of grid points
+    Returns:
+        list of aligned progressions, in the same order
+    """
+    times = [p["time"] for progression in progressions for p in progression]
+    if not times or max_points < 1:
+        return [[] for _ in progressions]
+    start, end = min(times), max(times)
+    if max_points == 1 or start == end:
+        grid = [end]
+    else:
+        step = (end - start) / (max_points - 1)
+        grid = [int(round(start + i * step)) for i in range(max_points)]
+
+    aligned = []
+    for progression in progressions:
+        solve_times = [p["time"] for p in progression]
+        aligned_progression = []
+        for time in grid:
+            index = bisect.bisect_right(solve_times, time)
+            score = progression[index - 1]["score"] if index else 0
+            aligned_progression.append({"score": score, "time": time})
+        aligned.append(aligned_progression)
+    return aligned
+
+
+def resample_top_teams_score_progressions(teams, max_points, align=False):
+    """
+    Bound the size of the output of get_top_teams_score_progressions().
+
+    Args:
+        teams: list of team progression dicts
+        max_points: maximum number of points per progression
+        align: sample every progression on a shared time grid
+               rather than downsampling each one independently
+    Returns:
+        list of team progression dicts with resampled progressions
+    """
+    progressions = [team["score_progression"] for team in teams]
+    if align:
+        progressions = align_score_progressions(progressions, max_points)
+    else:
+        progressions = [
+            downsample_score_progression(progression, max_points)
+            for progression in progressions
+        ]
+    return [
+        dict(team, score_progression=progression)
+        for team, progression in zip(teams, progressions)
+    ]
 
 
 # Stored by the cache_stats daemon.
 @memoize
 def get_registration_count():
     """Get the user, team, and group counts."""
-    db = api.db.get_conn()
+    db = api.db.get_analytics_conn("get_registration_count")
     users = db.users.count()
     stats = {
         "users": users,
@@ -392,26 +943,27 @@ def get_scoreboard_page(scoreboard_key, page_number=None):
     """
     board_cache = get_scoreboard_cache(**scoreboard_key)
     if not page_number:
-        try:
-            user = api.user.get_user()
-            team = api.team.get_team(tid=user["tid"])
-            team_position = (
-                board_cache.rank(get_scoreboard_key(team), reverse=True) or 0
-            )
-            page_number = math.floor(team_position / SCOREBOARD_PAGE_LEN) + 1
-        except PicoException:
-            page_number = 1
+        page_number = _get_current_team_page(board_cache)
     start = SCOREBOARD_PAGE_LEN * (page_number - 1)
     end = start + SCOREBOARD_PAGE_LEN - 1
-    board_page = [
-        decode_scoreboard_item(item)
-        for item in board_cache.range(start, end, with_scores=True, reverse=True)
-    ]
+    board_page = decode_scoreboard_items(
+        board_cache.range(start, end, with_scores=True, reverse=True)
+    )
 
     available_pages = max(math.ceil(len(board_cache) / SCOREBOARD_PAGE_LEN), 1)
     return board_page, page_number, available_pages
 
 
+def _get_current_team_page(board_cache):
+    """Get the scoreboard page containing the current team, or page 1."""
+    try:
+        user = api.user.get_user()
+        team_position = board_cache.rank(user["tid"], reverse=True) or 0
+        return math.floor(team_position / SCOREBOARD_PAGE_LEN) + 1
+    except PicoException:
+        return 1
+
+
 def get_filtered_scoreboard_page(scoreboard_key, pattern, page_number=1):
     """
     Get a page of a filtered scoreboard.
@@ -436,29 +988,299 @@ def get_filtered_scoreboard_page(scoreboard_key, pattern, page_number=1):
     start = SCOREBOARD_PAGE_LEN * (page_number - 1)
     end = start + SCOREBOARD_PAGE_LEN
     board_page = results[start:end]
-    for item in board_page:
-        item["rank"] = board_cache.rank(item["key"], reverse=True) + 1
-        item["score"] = int(item["score"])
-        item.pop("key")
     available_pages = max(math.ceil(len(results) / SCOREBOARD_PAGE_LEN), 1)
     return (board_page, page_number, available_pages)
 
 
-def get_demographic_data():
-    """Get demographic information used in analytics"""
-    users = api.user.get_all_users()
+def snapshot_scoreboard(scoreboard_key):
+    """
+    Pre-render every page of a scoreboard into immutable JSON blobs.
 
-    result = []
-    for user in users:
-        result.append(
+    Each page is stored under its own key, so serving a snapshotted page
+    costs a single redis GET. All pages of a scoreboard are replaced
+    atomically, and its version is bumped so that clients revalidate.
+    Nothing is stored if the snapshot was written by a newer stats leader.
+
+    Args:
+        scoreboard_key (dict): scoreboard key
+
+    Returns:
+        The number of pages stored, or 0 if fenced off
+    """
+    board_cache = get_scoreboard_cache(**scoreboard_key)
+    items = decode_scoreboard_items(
+        board_cache.range(0, -1, with_scores=True, reverse=True)
+    )
+    available_pages = max(math.ceil(len(items) / SCOREBOARD_PAGE_LEN), 1)
+
+    pages = {}
+    for page_number in range(1, available_pages + 1):
+        start = SCOREBOARD_PAGE_LEN * (page_number - 1)
+        body = json.dumps(
             {
-                "usertype": user["usertype"],
-                "country": user["country"],
-                "gender": user["demo"].get("gender", ""),
-                "zipcode": user["demo"].get("zipcode", ""),
-                "grade": user["demo"].get("grade", ""),
-                "score": get_score(uid=user["uid"], time_weighted=False),
-            }
+                "scoreboard": items[start : start + SCOREBOARD_PAGE_LEN],
+                "current_page": page_number,
+                "total_pages": available_pages,
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        page_key = SNAPSHOT_PAGE_KEY.format(board_cache.key, page_number)
+        pages[page_key] = body
+        # Pages are compressed once here, rather than on every request
+        data = (body + "\n").encode("utf-8")
+        if api.compression.is_compressible("application/json", len(data)):
+            for encoding in api.compression.available_encodings():
+                pages["{}:{}".format(page_key, encoding)] = api.compression.compress(
+                    data, encoding
+                )
+    previous_pages = int(
+        api.cache.get_conn().get(SNAPSHOT_PAGES_KEY.format(board_cache.key)) or 0
+    )
+    # Includes encodings of current pages which are no longer compressed
+    stale_keys = [
+        key
+        for key in _snapshot_page_keys(
+            board_cache.key, range(1, max(available_pages, previous_pages) + 1)
+        )
+        if key not in pages
+    ]
+
+    def write(pipe):
+        pipe.mset(pages)
+        if stale_keys:
+            pipe.delete(*stale_keys)
+        pipe.set(SNAPSHOT_PAGES_KEY.format(board_cache.key), available_pages)
+        pipe.sadd(SNAPSHOT_BOARDS_KEY, board_cache.key)
+
+    if not api.cache.fenced_write(SNAPSHOT_PAGES_KEY.format(board_cache.key), write):
+        return 0
+    api.cache.bump_version(board_cache.key)
+    return available_pages
+
+
+def get_scoreboard_snapshot_page(scoreboard_key, page_number=None, encoding=None):
+    """
+    Get a pre-rendered scoreboard page, if one has been stored.
+
+    If a page is not specified, will attempt to return the page containing the
+    current team, falling back to the first page if neccessary.
+
+    Args:
+        scoreboard_key (dict): scoreboard key
+
+    Kwargs:
+        page_number (int): page to retrieve
+        encoding (str): preferred content encoding of the body
+
+    Returns:
+        (str or bytes: body, str: encoding of the body or None), or None if
+        the page is not snapshotted
+    """
+    board_cache = get_scoreboard_cache(**scoreboard_key)
+    if not page_number:
+        page_number = _get_current_team_page(board_cache)
+    page_key = SNAPSHOT_PAGE_KEY.format(board_cache.key, page_number)
+    if encoding is None:
+        snapshot, encoded_body = api.cache.get_conn().get(page_key), None
+    else:
+        snapshot, encoded_body = api.cache.get_conn().mget(
+            page_key, "{}:{}".format(page_key, encoding)
         )
+    if snapshot is None:
+        return None
+    if encoded_body is not None:
+        return encoded_body, encoding
+    return snapshot.decode("utf-8") + "\n", None
+
+
+def _snapshot_page_keys(board_key, page_numbers):
+    """Get the keys of some pages of a scoreboard snapshot, in all encodings."""
+    keys = []
+    for page_number in page_numbers:
+        page_key = SNAPSHOT_PAGE_KEY.format(board_key, page_number)
+        keys.append(page_key)
+        for encoding in api.compression.available_encodings():
+            keys.append("{}:{}".format(page_key, encoding))
+    return keys
+
+
+def clear_scoreboard_snapshots():
+    """Remove all pre-rendered scoreboard pages."""
+    conn = api.cache.get_conn()
+    board_keys = [key.decode("utf-8") for key in conn.smembers(SNAPSHOT_BOARDS_KEY)]
+    if not board_keys:
+        return
+    page_counts = conn.mget([SNAPSHOT_PAGES_KEY.format(key) for key in board_keys])
+    keys = [SNAPSHOT_BOARDS_KEY]
+    for board_key, pages in zip(board_keys, page_counts):
+        keys.append(SNAPSHOT_PAGES_KEY.format(board_key))
+        keys.extend(_snapshot_page_keys(board_key, range(1, int(pages or 0) + 1)))
+    conn.delete(*keys)
+    # Pages are now served live
+    api.cache.bump_version(*board_keys)
+
+
+def get_historical_scoreboard(timestamp, scoreboard_id=None, group_id=None):
+    """
+    Calculate a scoreboard as it stood at a given time.
 
-    return result
+    The correct submissions made up to that time are reduced in a single
+    aggregation to each team's first solve of each (currently enabled)
+    problem, so only one document per team is returned, rather than every
+    submission being scanned in Python. Ties are broken by earliest last
+    solve, as on the live scoreboards. Teams without any solves by that time
+    are omitted.
+
+    Args:
+        timestamp: unix timestamp at which to calculate the scoreboard
+        scoreboard_id: Optional, limit to teams eligible for this scoreboard
+        group_id: Optional, limit to teams from this group.
+                  Overrides scoreboard_id.
+
+    Returns:
+        A ranked list of dicts with rank, name, affiliation, tid, score
+        and last_solve time
+
+    """
+    db = api.db.get_analytics_conn("get_historical_scoreboard")
+    if group_id is not None:
+        group = api.group.get_group(gid=group_id)
+        teams = list(
+            db.teams.find(
+                {"tid": {"$in": group["members"]}, "size": {"$gt": 0}}, {"_id": 0}
+            )
+        )
+    else:
+        teams = _get_scoreboard_teams(scoreboard_id=scoreboard_id)
+    teams = {team["tid"]: team for team in teams}
+    problem_scores = {
+        problem["pid"]: problem["score"]
+        for problem in db.problems.find(
+            {"disabled": False}, {"_id": 0, "pid": 1, "score": 1}
+        )
+    }
+
+    # Stored submission times are naive datetimes, interpreted the same way
+    # as the times in score progressions
+    match = {
+        "correct": True,
+        "timestamp": {"$lte": datetime.datetime.fromtimestamp(timestamp)},
+        "pid": {"$in": list(problem_scores.keys())},
+    }
+    if group_id is not None:
+        match["uid"] = {
+            "$in": [
+                user["uid"]
+                for user in db.users.find(
+                    {"tid": {"$in": list(teams.keys())}}, {"_id": 0, "uid": 1}
+                )
+            ]
+        }
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {"uid": "$uid", "pid": "$pid"},
+                "time": {"$min": "$timestamp"},
+            }
+        },
+        # Solves count towards the member's current team
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "_id.uid",
+                "foreignField": "uid",
+                "as": "user",
+            }
+        },
+        {"$unwind": "$user"},
+        {
+            "$group": {
+                "_id": {"tid": "$user.tid", "pid": "$_id.pid"},
+                "time": {"$min": "$time"},
+            }
+        },
+        {
+            "$group": {
+                "_id": "$_id.tid",
+                "pids": {"$push": "$_id.pid"},
+                "last_solve": {"$max": "$time"},
+            }
+        },
+    ]
+    scores = {}
+    last_solves = {}
+    for team in db.submissions.aggregate(pipeline, allowDiskUse=True):
+        tid = team["_id"]
+        if tid not in teams:
+            continue
+        scores[tid] = sum(problem_scores[pid] for pid in team["pids"])
+        last_solves[tid] = team["last_solve"]
+
+    ranked_tids = sorted(
+        [tid for tid, score in scores.items() if score > 0],
+        key=lambda tid: (-scores[tid], last_solves[tid]),
+    )
+    return [
+        {
+            "rank": rank,
+            "name": teams[tid]["team_name"],
+            "affiliation": teams[tid]["affiliation"],
+            "tid": tid,
+            "score": scores[tid],
+            "last_solve": int(last_solves[tid].timestamp()),
+        }
+        for rank, tid in enumerate(ranked_tids, start=1)
+    ]
+
+
+def get_historical_scoreboard_page(
+    timestamp, page_number=1, scoreboard_id=None, group_id=None
+):
+    """
+    Get a page of a scoreboard as it stood at a given time.
+
+    Args:
+        timestamp: unix timestamp at which to calculate the scoreboard
+
+    Kwargs:
+        page_number (int): page to retrieve, defaults to 1
+        scoreboard_id: Optional, limit to teams eligible for this scoreboard
+        group_id: Optional, limit to teams from this group
+
+    Returns:
+        (list: scoreboard page, int: current page, int: number of pages)
+    """
+    board = get_historical_scoreboard(
+        timestamp, scoreboard_id=scoreboard_id, group_id=group_id
+    )
+    start = SCOREBOARD_PAGE_LEN * (page_number - 1)
+    board_page = board[start : start + SCOREBOARD_PAGE_LEN]
+    available_pages = max(math.ceil(len(board) / SCOREBOARD_PAGE_LEN), 1)
+    return board_page, page_number, available_pages
+
+
+def get_demographic_data():
+    """Get demographic information used in analytics"""
+    return list(iter_demographic_data())
+
+
+def iter_demographic_data():
+    """
+    Iterate over the demographic information used in analytics.
+
+    Yields one row per user as it is read from the database, so that the
+    full result never has to be held in memory.
+    """
+    projection = {"usertype": 1, "country": 1, "demo": 1}
+    for user, score in _iter_users_with_scores(projection, "iter_demographic_data"):
+        demo = user.get("demo", {})
+        yield {
+            "usertype": user["usertype"],
+            "country": user["country"],
+            "gender": demo.get("gender", ""),
+            "zipcode": demo.get("zipcode", ""),
+            "grade": demo.get("grade", ""),
+            "score": score,
+        }
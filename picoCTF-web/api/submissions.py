@@ -95,17 +95,24 @@ def submit_key(tid, pid, key, method, uid, ip=None):
 
     correct, suspicious = grade_problem(pid, key, tid)
 
+    previously_counted_for_team = False
+    if correct and not previously_solved_by_team:
+        # Solves by members made before joining the team also count towards it
+        previously_counted_for_team = pid in api.problem.get_solved_pids(tid=tid)
+
+    problem = api.problem.get_problem(pid, {"category": 1, "score": 1})
+    timestamp = datetime.utcnow()
     if not previously_solved_by_user:
         db.submissions.insert(
             {
                 "uid": uid,
                 "tid": tid,
-                "timestamp": datetime.utcnow(),
+                "timestamp": timestamp,
                 "pid": pid,
                 "ip": ip,
                 "key": key,
                 "method": method,
-                "category": api.problem.get_problem(pid, {"category": 1})["category"],
+                "category": problem["category"],
                 "correct": correct,
                 "suspicious": suspicious,
             }
@@ -125,8 +132,13 @@ def submit_key(tid, pid, key, method, uid, ip=None):
         cache.invalidate(api.problem.get_solved_problems, tid=tid, uid=uid)
         cache.invalidate(api.problem.get_solved_problems, tid=tid)
         cache.invalidate(api.problem.get_solved_problems, uid=uid)
-        cache.invalidate(api.stats.get_score_progression, tid=tid, category=None)
-        cache.invalidate(api.stats.get_score_progression, tid=tid)
+        if not previously_counted_for_team:
+            api.stats.append_score_timeline(tid, pid, problem["score"], timestamp)
+            api.stats.mark_team_groups_dirty(tid)
+            api.events.publish_solve(
+                tid, uid, pid, api.stats.get_scoreboard_score(tid), timestamp
+            )
+        cache.bump_version("team:{}".format(tid))
 
     if suspicious:
         cache.invalidate(api.submissions.get_suspicious_submissions, tid)
@@ -191,6 +203,6 @@ def clear_all_submissions():
     if DEBUG_KEY is not None:
         db = api.db.get_conn()
         db.submissions.remove()
-        api.cache.clear()
+        api.stats.clear_cache()
     else:
         raise PicoException("Debug mode must be enabled", 500)
@@ -164,6 +164,27 @@ def create_and_join_new_team(team_name, team_password, user):
     return new_tid
 
 
+def new_team_document(params, size=0, server_number=None):
+    """
+    Build the document of a new team, with a fresh team id.
+
+    Args:
+        params:
+            team_name: Name of the team
+            password: team's hashed password
+            affiliation: team's affiliation
+            any other fields to store on the team
+        size: Optional, the team's initial number of members
+        server_number: Optional, the shell server assigned to the team
+    Returns:
+        The team document.
+    """
+    team = dict(params, tid=api.common.token(), size=size, instances={})
+    if server_number is not None:
+        team["server_number"] = server_number
+    return team
+
+
 def create_team(params):
     """
     Directly insert team into the database.
@@ -180,19 +201,15 @@ def create_team(params):
     """
     db = api.db.get_conn()
 
-    params["tid"] = api.common.token()
-    params["size"] = 0
-    params["instances"] = {}
-
+    server_number = None
     settings = api.config.get_settings()
     if settings["shell_servers"]["enable_sharding"]:
-        params["server_number"] = api.shell_servers.get_assigned_server_number(
-            new_team=True
-        )
+        server_number = api.shell_servers.get_assigned_server_number(new_team=True)
 
-    db.teams.insert(params)
+    team = new_team_document(params, server_number=server_number)
+    db.teams.insert(team)
 
-    return params["tid"]
+    return team["tid"]
 
 
 def get_team_members(tid=None, name=None, show_disabled=True):
@@ -436,10 +453,11 @@ def join_team(team_name, password, user):
     )
     cache.invalidate(api.problem.get_solved_problems, tid=desired_team["tid"])
     cache.invalidate(api.problem.get_solved_problems, uid=user["uid"])
-    cache.invalidate(
-        api.stats.get_score_progression, tid=desired_team["tid"], category=None
+    api.stats.invalidate_score_timeline(desired_team["tid"])
+    api.stats.mark_team_groups_dirty(desired_team["tid"])
+    cache.bump_version(
+        "team:{}".format(desired_team["tid"]), "team:{}".format(current_team["tid"])
     )
-    cache.invalidate(api.stats.get_score_progression, tid=desired_team["tid"])
 
     return desired_team["tid"]
 
@@ -1,7 +1,10 @@
 """User management and registration module."""
 
 import json
+import math
+import os
 import re
+import time
 import urllib.parse
 import urllib.request
 from functools import wraps
@@ -87,6 +90,11 @@ def get_user(name=None, uid=None, include_pw_hash=False):
         match.update({"username": name})
     elif api.user.is_logged_in():
         match.update({"uid": session["uid"]})
+        user = db.users.find_one(match, projection)
+        # Keep the session's team current for request logging
+        if user is not None and session.get("tid") != user["tid"]:
+            session["tid"] = user["tid"]
+        return user
     else:
         raise PicoException("Could not retrieve user - not logged in", 401)
 
@@ -159,6 +167,51 @@ def _validate_captcha(data):
 
 
 @log_action
+def new_user_document(
+    params, password_hash, tid, teacher=False, admin=False, verified=False
+):
+    """
+    Build the document of a new user, with a fresh user id.
+
+    Args:
+        params:
+            username: user's username
+            firstname: user's first name
+            lastname: user's last name
+            email: user's email
+            country: 2-digit country code
+            usertype: "student", "teacher" or other
+            demo: arbitrary dict of demographic data
+        password_hash: hash of the user's password
+        tid: the id of the user's team
+        teacher: Optional, whether the user is a teacher
+        admin: Optional, whether the user is an admin
+        verified: Optional, whether the user's email is verified
+    Returns:
+        The user document.
+    """
+    return {
+        "uid": api.common.token(),
+        "firstname": params["firstname"],
+        "lastname": params["lastname"],
+        "username": params["username"],
+        "email": params["email"],
+        "password_hash": password_hash,
+        "tid": tid,
+        "usertype": params["usertype"],
+        "country": params["country"],
+        "demo": params["demo"],
+        "teacher": teacher,
+        "admin": admin,
+        "disabled": False,
+        "verified": verified,
+        "extdata": {},
+        "completed_minigames": [],
+        "unlocked_walkthroughs": [],
+        "tokens": 0,
+    }
+
+
 def add_user(params, batch_registration=False):
     """
     Register a new user and creates a team for them automatically.
@@ -254,28 +307,16 @@ def add_user(params, batch_registration=False):
         user_is_teacher = True
 
     # Insert the new user in the DB
-    uid = api.common.token()
     settings = api.config.get_settings()
-    user = {
-        "uid": uid,
-        "firstname": params["firstname"],
-        "lastname": params["lastname"],
-        "username": params["username"],
-        "email": params["email"],
-        "password_hash": api.common.hash_password(params["password"]),
-        "tid": tid,
-        "usertype": params["usertype"],
-        "country": params["country"],
-        "demo": params["demo"],
-        "teacher": user_is_teacher,
-        "admin": user_is_admin,
-        "disabled": False,
-        "verified": (not settings["email"]["email_verification"] or user_was_invited),
-        "extdata": {},
-        "completed_minigames": [],
-        "unlocked_walkthroughs": [],
-        "tokens": 0,
-    }
+    user = new_user_document(
+        params,
+        api.common.hash_password(params["password"]),
+        tid,
+        teacher=user_is_teacher,
+        admin=user_is_admin,
+        verified=(not settings["email"]["email_verification"] or user_was_invited),
+    )
+    uid = user["uid"]
     db.users.insert_one(user)
 
     # Determine the user team's initial eligibilities
@@ -440,8 +481,8 @@ def disable_account(uid, disable_reason=None):
     cache.invalidate(api.problem.get_solved_problems, tid=former_tid, uid=uid)
     cache.invalidate(api.problem.get_solved_problems, tid=former_tid)
     cache.invalidate(api.problem.get_solved_problems, uid=uid)
-    cache.invalidate(api.stats.get_score_progression, tid=former_tid, category=None)
-    cache.invalidate(api.stats.get_score_progression, tid=former_tid)
+    api.stats.invalidate_score_timeline(former_tid)
+    api.stats.mark_team_groups_dirty(former_tid)
 
 
 def update_extdata(params):
@@ -518,6 +559,7 @@ def login(username, password):
 
     if confirm_password(password, user["password_hash"]):
         session["uid"] = user["uid"]
+        session["tid"] = user["tid"]
         session.permanent = True
     else:
         raise PicoException("Incorrect password", 401)
@@ -609,17 +651,72 @@ def check_csrf(f):
     return wrapper
 
 
+# Sliding window log: the key holds a sorted set of the times of the
+# requests allowed within the last window.
+#
+# KEYS[1]: rate limit key
+# ARGV: current time (us), window length (us), limit, unique request member
+# Returns: {1 if allowed else 0, remaining requests, us until a slot frees}
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local count = redis.call('ZCARD', KEYS[1])
+local allowed = 0
+if count < limit then
+    redis.call('ZADD', KEYS[1], now, ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], math.ceil(window / 1000))
+    count = count + 1
+    allowed = 1
+end
+local reset = 0
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if oldest[2] then
+    reset = tonumber(oldest[2]) + window - now
+end
+return {allowed, limit - count, reset}
+"""
+
+__rate_limit_script = {"conn": None, "script": None}
+
+
+def _check_rate_limit(key, limit, duration):
+    """
+    Count a request against a rate limit, if it is within the limit.
+
+    Args:
+        key: the rate limit key
+        limit: number of requests allowed per window
+        duration: length of the sliding window, in seconds
+    Returns:
+        (bool: whether the request is allowed, int: remaining requests,
+         int: seconds until another request will be allowed)
+    """
+    conn = cache.get_state_conn()
+    if __rate_limit_script["conn"] is not conn:
+        __rate_limit_script["script"] = conn.register_script(RATE_LIMIT_SCRIPT)
+        __rate_limit_script["conn"] = conn
+    now = int(time.time() * 1000000)
+    allowed, remaining, reset = __rate_limit_script["script"](
+        keys=[key],
+        args=[now, duration * 1000000, limit, "{}-{}".format(now, os.urandom(4).hex())],
+    )
+    return bool(allowed), remaining, math.ceil(reset / 1000000)
+
+
 def rate_limit(limit=5, duration=60, by_ip=False, allow_bypass=False):
     """
     Limits requests per user or ip to specified limit threshold
-    with lingering duration/expiry (as opposed to rolling interval).
+    within a sliding window of the specified duration.
     Note that non-user IP limits should be more generous given shared IPs
     likely in school networks.
 
-    Does not use Walrus rate_limit to avoid having to instantiate new instance
-    per rate-limit target.
-    :param limit: number of requests allowed before limit is enforced
-    :param duration: expiration of last request before limit is reset
+    Each check is a single scripted redis call. Admins and the
+    enable_rate_limiting setting are only consulted once a limit is
+    exceeded. The state of the limit is sent in RateLimit-* headers.
+    :param limit: number of requests allowed within the window
+    :param duration: length of the sliding window, in seconds
     :param by_ip: force keying by ip. Note that requests out of user context
                   default to ip-based key
     :param allow_bypass: allow inclusion of bypass secret in HTTP header
@@ -628,45 +725,56 @@ def rate_limit(limit=5, duration=60, by_ip=False, allow_bypass=False):
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            settings = api.config.get_settings()
-            if not settings.get("enable_rate_limiting", True):
-                return f(*args, **kwargs)
             app_config = current_app.config
             if allow_bypass or app_config.get("TESTING", False):
                 bypass_header = request.headers.get("Limit-Bypass")
                 if bypass_header == app_config["RATE_LIMIT_BYPASS_KEY"]:
                     return f(*args, **kwargs)
 
-            key_id = request.remote_addr
-
-            if is_logged_in():
-                current_user = get_user()
-                # Bypass admin
-                if current_user.get("admin", False):
-                    return f(*args, **kwargs)
-                if not by_ip:
-                    key_id = current_user["uid"]
-
-            _db = cache.get_conn()
+            if by_ip or "uid" not in session:
+                key_id = request.remote_addr
+            else:
+                key_id = session["uid"]
             key = "rate_limit:{}:{}".format(request.path, key_id)
-            # Avoid race conditions of setting (get-value + 1)
-            _db.incr(key)
-            _db.expire(key, duration)
-            count = int(_db.get(key))
-            if count is not None and count <= limit:
+            allowed, remaining, reset = _check_rate_limit(key, limit, duration)
+            flask.g.rate_limit = (limit, remaining, reset)
+            if allowed:
                 return f(*args, **kwargs)
-            else:
-                limit_msg = (
-                    "Too many requests, slow down! "
-                    "Limit: {}, {}s duration".format(limit, duration)
-                )
-                raise PicoException(limit_msg, 429)
+
+            settings = api.config.get_settings()
+            if not settings.get("enable_rate_limiting", True):
+                return f(*args, **kwargs)
+            # Bypass admin
+            if is_logged_in() and get_user().get("admin", False):
+                return f(*args, **kwargs)
+            limit_msg = (
+                "Too many requests, slow down! "
+                "Limit: {}, {}s duration".format(limit, duration)
+            )
+            raise PicoException(limit_msg, 429)
 
         return wrapper
 
     return decorator
 
 
+def set_rate_limit_headers(response):
+    """
+    Describe the rate limit applied to the current request in its response.
+
+    Args:
+        response: a Flask response
+    """
+    if "rate_limit" not in flask.g:
+        return
+    limit, remaining, reset = flask.g.rate_limit
+    response.headers["RateLimit-Limit"] = str(limit)
+    response.headers["RateLimit-Remaining"] = str(remaining)
+    response.headers["RateLimit-Reset"] = str(reset)
+    if response.status_code == 429:
+        response.headers["Retry-After"] = str(reset)
+
+
 def can_leave_team(uid):
     """Determine whether a user is eligible to leave their current team."""
     current_user = get_user(uid=uid)
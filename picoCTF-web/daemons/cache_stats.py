@@ -1,65 +1,480 @@
 #!/usr/bin/env python3
+"""
+Stat caching scheduler.
 
+Any number of stats workers may run at once. One of them holds a lease in
+the redis state database and acts as the leader: it splits each due job into shards (e.g. one
+per scoreboard) and distributes them across the live workers' queues. Each
+worker, including the leader, runs the shards assigned to it in a bounded
+thread pool, lower priority numbers first.
+
+Every dispatched shard carries the leader's fencing token. Shards are only
+queued while their token is current, and workers refuse shards issued under
+an older token, so a leader which has lost its lease (e.g. after a long
+pause) cannot cause duplicate work. A shard which is already running when
+its token is superseded is fenced off at its writes instead: scoreboards and
+their snapshots refuse writes under an older token than the latest one to
+write them. If the leader dies, a standby takes over within LEASE_TIME
+seconds.
+
+The duration and outcome of each job's latest run are recorded in the
+redis hash "cache_stats:job:<name>".
+"""
+
+import argparse
+import datetime
+import json
+import os
+import signal
+import socket
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
 
 import api
 import api.group
 from api.stats import (
+    clear_scoreboard_snapshots,
     get_all_team_scores,
-    get_group_scores,
     get_problem_solves,
     get_registration_count,
     get_top_teams_score_progressions,
+    mark_all_groups_dirty,
+    refresh_group_scores,
+    snapshot_scoreboard,
 )
-import socket
 
-# How long after primary stat host falls off to allow another to take primary
-COOLDOWN_TIME = 5 * 60
+LEADER_KEY = "cache_stats:leader"
+FENCING_TOKEN_KEY = "cache_stats:fencing_token"
+WORKERS_KEY = "cache_stats:workers"
+WORKER_QUEUE_KEY = "cache_stats:queue:{}"
+JOB_STATS_KEY = "cache_stats:job:{}"
 
+# Seconds a leader's lease lasts without renewal
+LEASE_TIME = 10
+
+# Seconds after its last heartbeat that a worker is considered dead
+WORKER_TIMEOUT = 10
+
+# Seconds to wait between checks for due jobs
+TICK_INTERVAL = 1
+
+# Sets the lease and issues a new fencing token if the lease is free
+_ACQUIRE_LEASE_SCRIPT = """
+if redis.call("SET", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    return redis.call("INCR", KEYS[2])
+end
+return nil
+"""
+
+# Extends the lease if it is still held by this worker
+_RENEW_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Queues shards (ARGV[3:]) onto worker queues (KEYS[2:]) if the fencing
+# token (ARGV[1]) is still current
+_DISPATCH_SCRIPT = """
+if tonumber(redis.call("GET", KEYS[1])) ~= tonumber(ARGV[1]) then
+    return 0
+end
+for i = 2, #KEYS do
+    redis.call("RPUSH", KEYS[i], ARGV[i + 1])
+    redis.call("EXPIRE", KEYS[i], ARGV[2])
+end
+return 1
+"""
+
+# Releases the lease if it is still held by this worker
+_RELEASE_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def cache(f, *args, **kwargs):
+    """Recompute and store a memoized function's result."""
+    return f(reset_cache=True, *args, **kwargs)
 
-def run():
-    """Run the stat caching daemon."""
-    with api.create_app().app_context():
-
-        def cache(f, *args, **kwargs):
-            result = f(reset_cache=True, *args, **kwargs)
-            return result
-
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        host = s.getsockname()[0]
-        s.close()
-
-        _cache = api.cache.get_cache()
-        active_stat_host = _cache.get("active_stat_host")
-        if active_stat_host is not None and host != active_stat_host:
-            print("Another ctf-stats is primary, exiting...")
-            raise SystemExit
-        else:
-            _cache.set("active_stat_host", host, COOLDOWN_TIME)
 
-        print("Caching registration stats...")
-        cache(get_registration_count)
+def snapshots_due(settings, last_snapshot):
+    """
+    Determine whether the scoreboards should be snapshotted.
 
-        print("Caching the scoreboards...")
-        for scoreboard in api.scoreboards.get_all_scoreboards():
-            get_all_team_scores(scoreboard_id=scoreboard["sid"])
+    Snapshots are taken every snapshot_interval seconds while the
+    competition is running, and once more after it has ended.
+    """
+    if last_snapshot is None:
+        return True
+    now = datetime.datetime.utcnow().timestamp()
+    end_time = settings["end_time"].timestamp()
+    if now >= end_time:
+        return last_snapshot < end_time
+    interval = settings["scoreboard_snapshots"]["snapshot_interval"]
+    return now - last_snapshot >= interval
 
-        print("Caching the score progressions for each scoreboard...")
-        for scoreboard in api.scoreboards.get_all_scoreboards():
-            cache(
-                get_top_teams_score_progressions,
-                limit=5,
-                scoreboard_id=scoreboard["sid"],
+
+def scoreboard_shards():
+    """Split a job into one shard per scoreboard."""
+    return [
+        {"scoreboard_id": scoreboard["sid"]}
+        for scoreboard in api.scoreboards.get_all_scoreboards()
+    ]
+
+
+def cache_registration_count():
+    """Cache registration stats."""
+    cache(get_registration_count)
+
+
+def cache_scoreboard(scoreboard_id):
+    """Cache a scoreboard."""
+    get_all_team_scores(scoreboard_id=scoreboard_id)
+
+
+def cache_score_progressions(scoreboard_id):
+    """Cache the score progressions for a scoreboard."""
+    cache(get_top_teams_score_progressions, limit=5, scoreboard_id=scoreboard_id)
+
+
+def cache_group_scoreboards():
+    """Rebuild the scores and score progressions of groups marked dirty."""
+    for gid in refresh_group_scores():
+        cache(get_top_teams_score_progressions, limit=5, group_id=gid)
+
+
+def snapshot_scoreboards():
+    """Snapshot the scoreboards, if enabled and due."""
+    _cache = api.cache.get_cache()
+    settings = api.config.get_settings()
+    if settings["scoreboard_snapshots"]["enable_snapshots"]:
+        last_snapshot = _cache.get("last_scoreboard_snapshot")
+        if snapshots_due(settings, last_snapshot):
+            for scoreboard in api.scoreboards.get_all_scoreboards():
+                snapshot_scoreboard({"scoreboard_id": scoreboard["sid"]})
+            for group in api.group.get_all_groups():
+                snapshot_scoreboard({"group_id": group["gid"]})
+            _cache.set(
+                "last_scoreboard_snapshot", datetime.datetime.utcnow().timestamp()
             )
+    elif _cache.get("last_scoreboard_snapshot") is not None:
+        # Snapshots were just disabled
+        clear_scoreboard_snapshots()
+        _cache.delete("last_scoreboard_snapshot")
+
+
+def cache_problem_solves():
+    """Cache the number of solves for each problem."""
+    solves_changed = False
+    for problem in api.problem.get_all_problems():
+        previous_solves = get_problem_solves(problem["pid"])
+        solves = cache(get_problem_solves, problem["pid"])
+        solves_changed = solves_changed or solves != previous_solves
+    if solves_changed:
+        api.cache.bump_version("problems")
+
+
+# Lower priority numbers run first when workers are scarce. Jobs with shards
+# are run once per shard, possibly on different workers.
+JOBS = [
+    {
+        "name": "scoreboards",
+        "run": cache_scoreboard,
+        "shards": scoreboard_shards,
+        "interval": 30,
+        "priority": 0,
+    },
+    {
+        "name": "scoreboard_snapshots",
+        "run": snapshot_scoreboards,
+        "interval": 10,
+        "priority": 1,
+    },
+    {
+        "name": "problem_solves",
+        "run": cache_problem_solves,
+        "interval": 60,
+        "priority": 2,
+    },
+    {
+        "name": "score_progressions",
+        "run": cache_score_progressions,
+        "shards": scoreboard_shards,
+        "interval": 60,
+        "priority": 3,
+    },
+    {
+        "name": "group_scoreboards",
+        "run": cache_group_scoreboards,
+        "interval": 10,
+        "priority": 4,
+    },
+    {
+        "name": "registration_count",
+        "run": cache_registration_count,
+        "interval": 60 * 60,
+        "priority": 5,
+    },
+]
+JOBS_BY_NAME = {job["name"]: job for job in JOBS}
+
 
-        print("Caching the scores and score progressions for each group...")
-        for group in api.group.get_all_groups():
-            get_group_scores(gid=group["gid"])
-            cache(get_top_teams_score_progressions, limit=5, group_id=group["gid"])
+class Lease:
+    """A lease on the stats leader role, held in redis."""
+
+    def __init__(self, conn, worker_id):
+        """
+        Args:
+            conn: redis state connection
+            worker_id: unique identifier of this worker
+        """
+        self.conn = conn
+        self.worker_id = worker_id
+        self.token = None
+        self._acquire = conn.register_script(_ACQUIRE_LEASE_SCRIPT)
+        self._renew = conn.register_script(_RENEW_LEASE_SCRIPT)
+        self._release = conn.register_script(_RELEASE_LEASE_SCRIPT)
+
+    @property
+    def held(self):
+        """Whether this worker believes it holds the lease."""
+        return self.token is not None
+
+    def refresh(self):
+        """
+        Renew the lease if held, otherwise try to acquire it.
+
+        Returns:
+            whether the lease is held
+        """
+        args = [self.worker_id, LEASE_TIME * 1000]
+        if self.held:
+            if not self._renew(keys=[LEADER_KEY], args=args):
+                print("Lost the stats leader lease")
+                self.token = None
+        else:
+            token = self._acquire(keys=[LEADER_KEY, FENCING_TOKEN_KEY], args=args)
+            if token is not None:
+                print("Acquired the stats leader lease (token {})".format(token))
+                self.token = int(token)
+        return self.held
+
+    def release(self):
+        """Give up the lease, if held."""
+        if self.held:
+            self._release(keys=[LEADER_KEY], args=[self.worker_id])
+            self.token = None
+
+
+def token_is_current(conn, token):
+    """Determine whether a fencing token is the latest one issued."""
+    return int(conn.get(FENCING_TOKEN_KEY) or 0) == token
+
+
+def heartbeat(conn, worker_id):
+    """Register this worker as alive, returning the ids of all live workers."""
+    now = time.time()
+    pipe = conn.pipeline()
+    pipe.zadd(WORKERS_KEY, {worker_id: now})
+    pipe.zremrangebyscore(WORKERS_KEY, "-inf", now - WORKER_TIMEOUT)
+    pipe.zrange(WORKERS_KEY, 0, -1)
+    return [worker.decode("utf-8") for worker in pipe.execute()[-1]]
+
+
+def dispatch(conn, job, token, workers, offset=0):
+    """
+    Split a job into shards and distribute them across workers' queues.
+
+    Nothing is dispatched if the token is no longer current.
+
+    Args:
+        conn: redis state connection
+        job: the job to dispatch
+        token: the leader's fencing token
+        workers: ids of the live workers
+        offset: index of the worker to receive the first shard
+
+    Returns:
+        the number of shards dispatched
+    """
+    shards = job["shards"]() if "shards" in job else [{}]
+    if not shards:
+        return 0
+    queue_keys = [
+        WORKER_QUEUE_KEY.format(workers[(offset + i) % len(workers)])
+        for i in range(len(shards))
+    ]
+    units = [
+        json.dumps({"job": job["name"], "kwargs": kwargs, "token": token})
+        for kwargs in shards
+    ]
+    dispatched = conn.register_script(_DISPATCH_SCRIPT)(
+        keys=[FENCING_TOKEN_KEY] + queue_keys, args=[token, WORKER_TIMEOUT] + units
+    )
+    return len(shards) if dispatched else 0
+
+
+def take_assigned(conn, worker_id):
+    """Remove and return all shards queued for this worker."""
+    queue_key = WORKER_QUEUE_KEY.format(worker_id)
+    pipe = conn.pipeline()
+    pipe.lrange(queue_key, 0, -1)
+    pipe.delete(queue_key)
+    return [json.loads(unit) for unit in pipe.execute()[0]]
+
+
+def run_job(app, job, kwargs=None, token=None):
+    """
+    Run a job or one of its shards, recording its duration and outcome.
+
+    Shards issued under a fencing token which is no longer current are
+    skipped. The token is made available to the job's fenced writes as
+    flask.g.fencing_token.
+    """
+    if kwargs is None:
+        kwargs = {}
+    with app.app_context():
+        stats_key = JOB_STATS_KEY.format(job["name"])
+        conn = api.cache.get_state_conn()
+        if token is not None and not token_is_current(conn, token):
+            print("Skipping job {} from a previous leader".format(job["name"]))
+            return
+        flask.g.fencing_token = token
+        start = time.time()
+        conn.hset(stats_key, "last_start", start)
+        try:
+            job["run"](**kwargs)
+        except Exception:
+            pipe = conn.pipeline()
+            pipe.hset(stats_key, "last_duration", time.time() - start)
+            pipe.hset(stats_key, "last_failure", time.time())
+            pipe.hset(stats_key, "last_error", traceback.format_exc())
+            pipe.hincrby(stats_key, "failures", 1)
+            pipe.execute()
+            print("Job {} failed:\n{}".format(job["name"], traceback.format_exc()))
+        else:
+            duration = time.time() - start
+            pipe = conn.pipeline()
+            pipe.hset(stats_key, "last_duration", duration)
+            pipe.hset(stats_key, "last_success", time.time())
+            pipe.hset(stats_key, "last_token", token or "")
+            pipe.hincrby(stats_key, "runs", 1)
+            pipe.execute()
+
+
+def run_once(app, lease):
+    """Run every job once, in priority order, while holding the lease."""
+    with app.app_context():
+        mark_all_groups_dirty()
+    for job in sorted(JOBS, key=lambda job: job["priority"]):
+        with app.app_context():
+            shards = job["shards"]() if "shards" in job else [{}]
+        for kwargs in shards:
+            if not lease.refresh():
+                raise SystemExit
+            run_job(app, job, kwargs, lease.token)
+
+
+def schedule(app, workers):
+    """Run assigned jobs, and dispatch jobs while leader, until terminated."""
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    worker_id = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+    with app.app_context():
+        conn = api.cache.get_state_conn()
+    lease = Lease(conn, worker_id)
+
+    next_runs = {}
+    offset = 0
+    pending = {}
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while not stopping:
+            live_workers = heartbeat(conn, worker_id)
+            was_leader = lease.held
+            if lease.refresh():
+                if not was_leader:
+                    # Run everything on taking over, as the previous leader's
+                    # schedule is unknown
+                    next_runs = {job["name"]: 0 for job in JOBS}
+                    with app.app_context():
+                        mark_all_groups_dirty()
+                now = time.time()
+                for job in sorted(JOBS, key=lambda job: job["priority"]):
+                    if next_runs[job["name"]] > now:
+                        continue
+                    with app.app_context():
+                        offset += dispatch(conn, job, lease.token, live_workers, offset)
+                    next_runs[job["name"]] = now + job["interval"]
+
+            for unit_key, future in list(running.items()):
+                if future.done():
+                    del running[unit_key]
+
+            # Run assigned shards by priority, never overlapping a shard
+            # with itself
+            for unit in take_assigned(conn, worker_id):
+                if unit["job"] in JOBS_BY_NAME:
+                    unit_key = (unit["job"], json.dumps(unit["kwargs"], sort_keys=True))
+                    pending[unit_key] = unit
+            for unit_key in sorted(
+                pending, key=lambda key: JOBS_BY_NAME[key[0]]["priority"]
+            ):
+                if len(running) >= workers:
+                    break
+                if unit_key in running:
+                    continue
+                unit = pending.pop(unit_key)
+                running[unit_key] = executor.submit(
+                    run_job,
+                    app,
+                    JOBS_BY_NAME[unit["job"]],
+                    unit["kwargs"],
+                    unit["token"],
+                )
+            time.sleep(TICK_INTERVAL)
+    finally:
+        lease.release()
+        conn.zrem(WORKERS_KEY, worker_id)
+        executor.shutdown(wait=True)
+
+
+def run():
+    """Run the stat caching daemon."""
+    parser = argparse.ArgumentParser(description="picoCTF stat caching daemon")
+    parser.add_argument(
+        "--once", action="store_true", help="run every job once and exit"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=3, help="maximum number of concurrent jobs"
+    )
+    args = parser.parse_args()
 
-        print("Caching number of solves for each problem...")
-        for problem in api.problem.get_all_problems():
-            print(problem["name"], cache(get_problem_solves, problem["pid"]))
+    app = api.create_app()
+    if args.once:
+        with app.app_context():
+            worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+            lease = Lease(api.cache.get_state_conn(), worker_id)
+            if not lease.refresh():
+                print("Another ctf-stats is the leader, exiting...")
+                raise SystemExit
+        try:
+            run_once(app, lease)
+        finally:
+            lease.release()
+    else:
+        schedule(app, args.workers)
 
 
 if __name__ == "__main__":
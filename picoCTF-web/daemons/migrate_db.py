@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Bring the database's indexes up to date with api/migrations.py."""
+
+import argparse
+
+import api
+from api.migrations import get_schema, INDEX_VERSION, migrate, plan_migration
+
+
+def run():
+    """Apply or list the pending index changes."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="list the pending index changes without applying them",
+    )
+    parser.add_argument(
+        "--drop-undeclared",
+        action="store_true",
+        help="drop indexes which are no longer declared, rather than listing them",
+    )
+    args = parser.parse_args()
+
+    app = api.create_app()
+    with app.app_context():
+        db = api.db.get_conn()
+        schema = get_schema(db)
+        print(
+            "Applied index version: {}, current: {}".format(
+                schema["version"] if schema else None, INDEX_VERSION
+            )
+        )
+        if args.dry_run:
+            to_create, to_drop, mismatched = plan_migration(db)
+            for collection, index in to_create:
+                print(
+                    "Would build index {} of {}".format(
+                        index.document["name"], collection
+                    )
+                )
+            for collection, name in to_drop:
+                if args.drop_undeclared:
+                    print("Would drop index {} of {}".format(name, collection))
+                else:
+                    print("Undeclared index {} of {}".format(name, collection))
+            for collection, name in mismatched:
+                print(
+                    "Index {} of {} does not match its declaration".format(
+                        name, collection
+                    )
+                )
+            return
+        migrate(
+            db, app.config, progress=print, drop_undeclared=args.drop_undeclared,
+        )
+        print("Indexes are up to date.")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""Backfill the stored score timeline of every team."""
+
+import api
+import api.team
+from api.stats import rebuild_score_timeline
+
+
+def run():
+    """Rebuild the score timelines of all non-empty teams."""
+    with api.create_app().app_context():
+        teams = api.team.get_all_teams()
+        print("Rebuilding score timelines for {} teams...".format(len(teams)))
+        for team in teams:
+            rebuild_score_timeline(team["tid"])
+
+
+if __name__ == "__main__":
+    run()
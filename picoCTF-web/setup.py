@@ -74,12 +74,15 @@ setup(
         "marshmallow==3.0.1",
         "py==1.8.0",
         "pymongo==3.9.0",
+        "redis==3.5.3",
         "spur==0.3.21",
         "voluptuous==0.11.7",
         "walrus==0.7.1",
         "werkzeug<=0.16.1"
     ],
     extras_require={
+        "brotli": ["brotli==1.0.7"],
+        "orjson": ["orjson==3.4.0"],
         "dev": [
             "black",
             "flake8",
@@ -0,0 +1,135 @@
+"""
+Benchmark the API's JSON encoders.
+
+Compares Flask's default encoder with api.json_encoder.FastJSONEncoder on a
+realistic /problems response and a scoreboard page, checking that both
+produce identical output. Run from the picoCTF-web directory:
+
+    python -m tests.benchmark.json_encoding [--iterations N]
+"""
+
+import argparse
+import json
+import random
+import timeit
+import uuid
+from datetime import datetime, timedelta
+
+from flask.json import JSONEncoder
+
+from api.json_encoder import FastJSONEncoder, orjson
+
+CATEGORIES = [
+    "Binary Exploitation",
+    "Cryptography",
+    "Forensics",
+    "General Skills",
+    "Reverse Engineering",
+    "Web Exploitation",
+]
+
+
+def problems_payload(count=120):
+    """Generate a list of problems as returned by GET /problems."""
+    start = datetime(2019, 10, 1)
+    problems = []
+    for i in range(count):
+        solved = random.random() < 0.3
+        problems.append(
+            {
+                "pid": uuid.uuid4().hex,
+                "name": "Problem {}".format(i),
+                "category": random.choice(CATEGORIES),
+                "description": (
+                    "Can you find the flag in this <a href='//{}'>file</a>? "
+                    "Connect with <code>nc 2019shell1.picoctf.com {}</code>. "
+                ).format(uuid.uuid4().hex, random.randint(10000, 60000))
+                * 3,
+                "hints": ["Hint {} for problem {}".format(j, i) for j in range(3)],
+                "score": random.choice([50, 100, 150, 200, 250, 300, 400, 500]),
+                "author": "picoCTF",
+                "organization": "picoCTF",
+                "event": "picoCTF 2019",
+                "disabled": False,
+                "has_walkthrough": random.random() < 0.5,
+                "unlocked": True,
+                "reviewed": solved and random.random() < 0.5,
+                "solved": solved,
+                "solves": random.randint(0, 20000),
+                "solve_time": start + timedelta(minutes=random.randint(0, 20000))
+                if solved
+                else None,
+                "unlock_weightmap": {uuid.uuid4().hex: 1 for _ in range(2)},
+                "weightmap": {},
+                "threshold": 0,
+                "port": random.randint(10000, 60000),
+                "server": "2019shell1.picoctf.com",
+            }
+        )
+    return problems
+
+
+def scoreboard_payload(length=50):
+    """Generate a scoreboard page as returned by GET /scoreboards/<sid>/..."""
+    return {
+        "scoreboard": [
+            {
+                "name": "team_{}".format(uuid.uuid4().hex[:12]),
+                "affiliation": "High School {}".format(random.randint(1, 5000)),
+                "tid": uuid.uuid4().hex,
+                "score": random.randint(0, 40000),
+            }
+            for _ in range(length)
+        ],
+        "current_page": 1,
+        "total_pages": random.randint(1, 400),
+    }
+
+
+def encode(encoder, payload):
+    """Encode a payload as Flask's jsonify does outside of debug mode."""
+    return json.dumps(payload, cls=encoder, sort_keys=True, separators=(",", ":"))
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=1000)
+    args = parser.parse_args()
+
+    if orjson is None:
+        print("orjson is not installed: FastJSONEncoder will use the stdlib")
+
+    # Values which orjson encodes differently must fall back to the stdlib
+    edge_cases = [
+        {"score": float("nan"), "time": None},
+        [float("inf"), float("-inf")],
+        {"weights": [1e-05, 1e16, -2.5e-300, 0.0001, 1e15]},
+        {"pid": "3e4f", "score": None},
+    ]
+    for payload in edge_cases:
+        assert encode(FastJSONEncoder, payload) == encode(
+            JSONEncoder, payload
+        ), "output differs for {!r}".format(payload)
+
+    payloads = {
+        "/problems": problems_payload(),
+        "scoreboard page": scoreboard_payload(),
+    }
+    for name, payload in payloads.items():
+        expected = encode(JSONEncoder, payload)
+        assert encode(FastJSONEncoder, payload) == expected, "output differs"
+        print("{} ({} bytes)".format(name, len(expected)))
+        for encoder in [JSONEncoder, FastJSONEncoder]:
+            elapsed = timeit.timeit(
+                lambda: encode(encoder, payload), number=args.iterations
+            )
+            print(
+                "  {:<16} {:8.1f} us/encode".format(
+                    encoder.__name__, elapsed / args.iterations * 1e6
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
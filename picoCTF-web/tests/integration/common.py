@@ -54,6 +54,7 @@ def client():
             "TESTING": True,
             "MONGO_DB_NAME": TESTING_DB_NAME,
             "MONGO_PORT": 27018,
+            "MONGO_AUTO_MIGRATE": True,
             "RATE_LIMIT_BYPASS_KEY": RATE_LIMIT_BYPASS_KEY,
         }
     )
@@ -63,7 +64,12 @@ def client():
 def app():
     """Create an instance of the Flask app for testing."""
     app = api.create_app(
-        {"TESTING": True, "MONGO_DB_NAME": TESTING_DB_NAME, "MONGO_PORT": 27018}
+        {
+            "TESTING": True,
+            "MONGO_DB_NAME": TESTING_DB_NAME,
+            "MONGO_PORT": 27018,
+            "MONGO_AUTO_MIGRATE": True,
+        }
     )
     return app
 
@@ -77,8 +83,9 @@ def update_all_scoreboards():
     api.stats.get_all_team_scores()
     for scoreboard in api.scoreboards.get_all_scoreboards():
         api.stats.get_all_team_scores(scoreboard_id=scoreboard["sid"])
-    for group in api.group.get_all_groups():
-        api.stats.get_group_scores(gid=group["gid"])
+    api.stats.refresh_group_scores(
+        [group["gid"] for group in api.group.get_all_groups()]
+    )
 
 
 ADMIN_DEMOGRAPHICS = {
@@ -0,0 +1,47 @@
+"""
+Query plan checks for the integration tests.
+
+When CHECK_QUERY_PLANS=1 is set, the shape of every query issued by API code
+during a test is recorded. After the test, the API's indexes are re-created
+(tests drop the database, indexes included) and each query is explained
+against the test database. A test fails if any of its queries would be
+answered with a collection scan. Queries without a filter are expected to
+scan and are not checked.
+"""
+
+import os
+
+import pytest
+from pymongo import monitoring
+
+from .common import get_conn
+from .query_plans import ensure_indexes, explain_collection_scans, QueryRecorder
+
+CHECK_QUERY_PLANS = os.environ.get("CHECK_QUERY_PLANS") == "1"
+
+recorder = QueryRecorder()
+if CHECK_QUERY_PLANS:
+    # Must be registered before the API creates its client
+    monitoring.register(recorder)
+
+
+@pytest.fixture(autouse=True)
+def check_query_plans():
+    """Fail the current test if any API query was a collection scan."""
+    recorder.queries.clear()
+    yield
+    if not CHECK_QUERY_PLANS:
+        return
+    queries = list(recorder.queries.values())
+    recorder.queries.clear()
+    if not queries:
+        return
+    db = get_conn()
+    ensure_indexes(db)
+    failures = [
+        "{} from {}".format(command, caller)
+        for command, caller in queries
+        if explain_collection_scans(db, command)
+    ]
+    if failures:
+        pytest.fail("Queries with collection scans:\n" + "\n".join(failures))
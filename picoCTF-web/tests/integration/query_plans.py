@@ -0,0 +1,100 @@
+"""Recording and explaining the queries issued by API code."""
+
+from pymongo import monitoring
+
+import api.default_settings
+from api.metrics import get_caller, query_shape, SHAPE_IGNORED_FIELDS
+from api.migrations import migrate
+from .common import TESTING_DB_NAME
+
+# Commands which can be explained, and the field holding their filter
+EXPLAINED_COMMANDS = {
+    "aggregate": "pipeline",
+    "count": "query",
+    "delete": "deletes",
+    "distinct": "query",
+    "find": "filter",
+    "findAndModify": "query",
+    "update": "updates",
+}
+
+
+class QueryRecorder(monitoring.CommandListener):
+    """Records one instance of each query shape issued by API code."""
+
+    def __init__(self):
+        self.queries = {}
+
+    def started(self, event):
+        if (
+            event.database_name != TESTING_DB_NAME
+            or event.command_name not in EXPLAINED_COMMANDS
+            or not has_filter(event.command_name, event.command)
+        ):
+            return
+        caller = get_caller()
+        if caller is None:
+            # Issued by the test itself
+            return
+        key = repr(query_shape(event.command_name, event.command))
+        if key not in self.queries:
+            command = {
+                field: value
+                for field, value in event.command.items()
+                if field not in SHAPE_IGNORED_FIELDS
+            }
+            self.queries[key] = (command, caller)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def has_filter(command_name, command):
+    """Check whether a command selects documents by a non-empty filter."""
+    criteria = command.get(EXPLAINED_COMMANDS[command_name])
+    if command_name == "aggregate":
+        return bool(criteria) and bool(criteria[0].get("$match"))
+    if command_name in ("update", "delete"):
+        return bool(criteria) and bool(criteria[0].get("q"))
+    return bool(criteria)
+
+
+def collection_scans(explain):
+    """Find the collection scan stages of an explain result's winning plans."""
+    scans = []
+
+    def walk(value, in_winning_plan):
+        if isinstance(value, dict):
+            if in_winning_plan and value.get("stage") == "COLLSCAN":
+                scans.append(value)
+            for key, item in value.items():
+                walk(item, in_winning_plan or key == "winningPlan")
+        elif isinstance(value, list):
+            for item in value:
+                walk(item, in_winning_plan)
+
+    walk(explain, False)
+    return scans
+
+
+def explain_collection_scans(db, command):
+    """
+    Explain a command against a database.
+
+    Returns:
+        the collection scan stages of its winning plans
+    """
+    return collection_scans(db.command("explain", command, verbosity="queryPlanner"))
+
+
+def ensure_indexes(db):
+    """Create the API's indexes, e.g. after the test database was dropped."""
+    conf = {
+        name: getattr(api.default_settings, name)
+        for name in dir(api.default_settings)
+        if name.isupper()
+    }
+    migrate(db, conf, progress=lambda message: None)
@@ -0,0 +1,67 @@
+"""Tests for database and cache connection management."""
+import os
+
+import pytest
+from pymongo import ReadPreference
+from pytest_mongo import factories
+from pytest_redis import factories
+from .common import app, clear_db  # noqa (fixture)
+import api
+
+
+def test_fork_resets_connections(mongo_proc, redis_proc):  # noqa
+    """Test that a forked child does not reuse its parent's connections."""
+    clear_db()
+    flask_app = app()
+    flask_app.config["MONGO_ANALYTICS_READ_SETTINGS"] = "readPreference=nearest"
+    with flask_app.app_context():
+        db = api.db.get_conn()
+        analytics_db = api.db.get_analytics_conn("get_registration_count")
+        redis = api.cache.get_conn()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            result = b"0"
+            try:
+                child_db = api.db.get_conn()
+                child_analytics_db = api.db.get_analytics_conn("get_registration_count")
+                child_redis = api.cache.get_conn()
+                child_db.users.count_documents({})
+                child_analytics_db.users.count_documents({})
+                child_redis.ping()
+                if (
+                    child_db is not db
+                    and child_analytics_db is not analytics_db
+                    and child_analytics_db.client is child_db.client
+                    and child_redis is not redis
+                ):
+                    result = b"1"
+            finally:
+                os.write(write, result)
+                os._exit(0)
+        os.waitpid(pid, 0)
+        assert os.read(read, 1) == b"1"
+        assert api.db.get_conn() is db
+        assert api.db.get_analytics_conn("get_registration_count") is analytics_db
+        assert api.cache.get_conn() is redis
+
+
+def test_analytics_read_routing(mongo_proc, redis_proc):  # noqa
+    """Test that only listed analytics functions read from secondaries."""
+    clear_db()
+    flask_app = app()
+    flask_app.config["MONGO_ANALYTICS_READ_SETTINGS"] = (
+        "readPreference=secondaryPreferred&maxStalenessSeconds=120"
+        "&readPreferenceTags=nodeType:ANALYTICS&readPreferenceTags="
+    )
+    with flask_app.app_context():
+        preference = api.db.get_analytics_conn("get_registration_count").read_preference
+        assert preference.mode == ReadPreference.SECONDARY_PREFERRED.mode
+        assert preference.max_staleness == 120
+        assert preference.tag_sets == [{"nodeType": "ANALYTICS"}, {}]
+
+        preference = api.db.get_analytics_conn("submit_key").read_preference
+        assert preference == ReadPreference.PRIMARY
+
+    with pytest.raises(ValueError):
+        api.db.parse_read_settings("readPreference=primary&maxStalenessSeconds=90")
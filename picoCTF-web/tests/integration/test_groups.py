@@ -0,0 +1,135 @@
+"""Tests for the /api/v1/groups endpoints."""
+import io
+import time
+
+from pytest_mongo import factories
+from pytest_redis import factories
+from .common import (  # noqa (fixture)
+    clear_db,
+    client,
+    ensure_within_competition,
+    get_conn,
+    get_csrf_token,
+    RATE_LIMIT_BYPASS_KEY,
+    register_test_accounts,
+    TEACHER_DEMOGRAPHICS,
+)
+import api
+
+BATCH_CSV = (
+    b"Grade (1-12),Age (13-17 or 18+),Gender,Parent Email (if under 18)\n"
+    b"8,13-17,male,sample@parentemail.com\n"
+    b"12,18+,female,\n"
+)
+
+
+def test_batch_registration(mongo_proc, redis_proc, client):  # noqa (fixture)
+    """Test synchronous and background batch registration."""
+    clear_db()
+    api.cache.clear()
+    register_test_accounts()
+    res = client.post(
+        "/api/v1/user/login",
+        json={
+            "username": TEACHER_DEMOGRAPHICS["username"],
+            "password": TEACHER_DEMOGRAPHICS["password"],
+        },
+    )
+    csrf_t = get_csrf_token(res)
+    res = client.post(
+        "/api/v1/groups", json={"name": "newgroup"}, headers=[("X-CSRF-Token", csrf_t)]
+    )
+    gid = res.json["gid"]
+    url = "/api/v1/groups/{}/batch_registration".format(gid)
+    headers = [("Limit-Bypass", RATE_LIMIT_BYPASS_KEY)]
+
+    res = client.post(
+        url, data={"csv": (io.BytesIO(BATCH_CSV), "students.csv")}, headers=headers
+    )
+    assert res.status_code == 200
+    usernames = [account["username"] for account in res.json["accounts"]]
+    assert usernames == [
+        "{}.student{}".format(TEACHER_DEMOGRAPHICS["username"], i) for i in (1, 2)
+    ]
+
+    res = client.post(
+        url,
+        data={"csv": (io.BytesIO(BATCH_CSV), "students.csv"), "background": "true"},
+        headers=headers,
+    )
+    assert res.status_code == 202
+    job_url = "{}/{}".format(url, res.json["job_id"])
+    # Jobs are not lost when the cache is cleared
+    api.cache.clear()
+    for _ in range(50):
+        res = client.get(job_url)
+        if res.json.get("status") != "running":
+            break
+        time.sleep(0.1)
+    assert res.status_code == 200
+    assert len(res.json["accounts"]) == 2
+    # Credentials are only returned once
+    assert client.get(job_url).status_code == 404
+
+    # Students can log in, and are members of the group on their own teams
+    client.get("/api/v1/user/logout")
+    account = res.json["accounts"][1]
+    res = client.post(
+        "/api/v1/user/login",
+        json={"username": account["username"], "password": account["password"]},
+    )
+    assert res.status_code == 200
+    db = get_conn()
+    members = db.groups.find_one({"gid": gid})["members"]
+    teams = list(db.teams.find({"tid": {"$in": members}}))
+    assert sorted(team["team_name"] for team in teams) == [
+        "{}.student{}".format(TEACHER_DEMOGRAPHICS["username"], i) for i in range(1, 5)
+    ]
+    assert all(team["size"] == 1 for team in teams)
+
+
+def test_batch_registration_job_expiry(mongo_proc, redis_proc, client):  # noqa
+    """Test that the state of an expired job is never recreated."""
+    with client.application.app_context():
+        assert not api.group._update_batch_registration(
+            "expired", {"status": "done", "accounts": "[]"}
+        )
+        conn = api.cache.get_state_conn()
+        assert not conn.exists(api.group.BATCH_REGISTRATION_JOB_KEY.format("expired"))
+
+        # Incomplete jobs are treated as missing
+        conn.hset(
+            api.group.BATCH_REGISTRATION_JOB_KEY.format("partial"), "status", "done"
+        )
+        assert api.group.get_batch_registration("partial") is None
+
+
+def test_scoreboard_revalidation(mongo_proc, redis_proc, client):  # noqa (fixture)
+    """Test that group scoreboard ETags are only honored for members."""
+    clear_db()
+    api.cache.clear()
+    register_test_accounts()
+    ensure_within_competition()
+    res = client.post(
+        "/api/v1/user/login",
+        json={
+            "username": TEACHER_DEMOGRAPHICS["username"],
+            "password": TEACHER_DEMOGRAPHICS["password"],
+        },
+    )
+    csrf_t = get_csrf_token(res)
+    res = client.post(
+        "/api/v1/groups", json={"name": "newgroup"}, headers=[("X-CSRF-Token", csrf_t)]
+    )
+    url = "/api/v1/groups/{}/scoreboard".format(res.json["gid"])
+
+    res = client.get(url)
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+    res = client.get(url, headers=[("If-None-Match", etag)])
+    assert res.status_code == 304
+
+    # The group's checks run before the ETag is compared
+    get_conn().groups.delete_many({})
+    res = client.get(url, headers=[("If-None-Match", etag)])
+    assert res.status_code == 404
@@ -0,0 +1,75 @@
+"""Tests for the statistics and exception loggers."""
+import logging
+
+from flask import session
+
+from pytest_mongo import factories
+from pytest_redis import factories
+from .common import app, clear_db, get_conn  # noqa (fixture)
+import api
+
+
+def test_statistics_buffer_spill(mongo_proc, redis_proc, tmp_path):  # noqa
+    """Test that overflowing records are spilled to disk and replayed."""
+    clear_db()
+    flask_app = app()
+    flask_app.config["STATISTICS_BUFFER_SIZE"] = 2
+    flask_app.config["STATISTICS_FLUSH_INTERVAL"] = 60
+    flask_app.config["STATISTICS_SPILL_DIR"] = str(tmp_path)
+    buffer = api.logger.StatisticsBuffer(flask_app)
+
+    for i in range(5):
+        buffer.add({"event": "test", "args": [i]})
+    # Only the records beyond the buffer size are spilled
+    assert len(list(tmp_path.iterdir())) == 1
+
+    buffer.close()
+    events = get_conn().statistics.find({"event": "test"}, {"_id": 0, "args": 1})
+    assert sorted(event["args"][0] for event in events) == list(range(5))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_exception_deduplication(mongo_proc, redis_proc):  # noqa
+    """Test that repeated exceptions are aggregated into one record."""
+    clear_db()
+    with app().app_context():
+        handler = api.logger.ExceptionHandler()
+        for i in range(3):
+            try:
+                raise ValueError("value {}".format(i))
+            except ValueError:
+                handler.emit(logging.makeLogRecord({"msg": "error"}))
+
+        exceptions = api.logger.get_api_exceptions()
+        assert len(exceptions) == 1
+        assert exceptions[0]["count"] == 3
+        assert exceptions[0]["first_seen"] <= exceptions[0]["time"]
+        assert "value 2" in exceptions[0]["trace"]
+
+
+def test_exception_latest_occurrence(mongo_proc, redis_proc):  # noqa
+    """Test that an exception's user is that of its latest occurrence."""
+    clear_db()
+    flask_app = app()
+    handler = api.logger.ExceptionHandler()
+
+    def emit():
+        try:
+            raise ValueError("value")
+        except ValueError:
+            handler.emit(logging.makeLogRecord({"msg": "error"}))
+
+    with flask_app.test_request_context("/api/v1/user"):
+        session["uid"] = "someone"
+        emit()
+    with flask_app.app_context():
+        assert api.logger.get_api_exceptions()[0]["uid"] == "someone"
+
+    # A later anonymous occurrence is not attributed to the earlier user
+    with flask_app.test_request_context("/api/v1/user"):
+        emit()
+    with flask_app.app_context():
+        exceptions = api.logger.get_api_exceptions()
+        assert exceptions[0]["count"] == 2
+        assert "uid" not in exceptions[0]
+        assert "tid" not in exceptions[0]
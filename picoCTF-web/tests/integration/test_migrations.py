@@ -0,0 +1,66 @@
+"""Tests for the database index migrations."""
+from pytest_mongo import factories
+from pytest_redis import factories
+from .common import app, clear_db, get_conn  # noqa (fixture)
+import api
+from api.migrations import INDEX_VERSION, migrate, plan_migration
+
+
+def test_migrate(mongo_proc, redis_proc):  # noqa
+    """Test that migrating creates declared and only lists undeclared indexes."""
+    clear_db()
+    flask_app = app()
+    with flask_app.app_context():
+        # The dropped database has none of the declared indexes
+        db = get_conn()
+        db.users.create_index("obsolete")
+        assert not api.migrations.check_schema(
+            db, dict(flask_app.config, MONGO_AUTO_MIGRATE=False)
+        )
+
+        to_create, to_drop, _ = plan_migration(db)
+        assert ("users", "obsolete_1") in to_drop
+        assert "unique uid" in [index.document["name"] for _, index in to_create]
+
+        migrate(db, flask_app.config)
+        indexes = db.users.index_information()
+        assert "obsolete_1" in indexes
+        assert indexes["unique uid"]["unique"]
+        assert "time_-1" in db.exceptions.index_information()
+        assert plan_migration(db) == ([], [("users", "obsolete_1")], [])
+
+        migrate(db, flask_app.config, drop_undeclared=True)
+        assert "obsolete_1" not in db.users.index_information()
+        assert plan_migration(db) == ([], [], [])
+        assert api.migrations.get_schema(db)["version"] == INDEX_VERSION
+        assert api.migrations.check_schema(
+            db, dict(flask_app.config, MONGO_AUTO_MIGRATE=False)
+        )
+
+
+def test_mismatched_index_options(mongo_proc, redis_proc):  # noqa
+    """Test that indexes are compared to their declarations by their options."""
+    clear_db()
+    with app().app_context():
+        db = get_conn()
+        db.users.create_index("uid", name="unique uid")
+        db.teams.create_index(
+            "team_name",
+            unique=True,
+            collation={"locale": "en", "strength": 2},
+            name="unique normalized team names",
+        )
+        db.teams.create_index(
+            "size", name="non-empty size", partialFilterExpression={"size": {"$gt": 1}}
+        )
+        _, _, mismatched = plan_migration(db)
+        assert sorted(mismatched) == [
+            ("teams", "non-empty size"),
+            ("teams", "unique normalized team names"),
+            ("users", "unique uid"),
+        ]
+
+        db.teams.drop_indexes()
+        db.users.drop_indexes()
+        migrate(db, app().config)
+        assert plan_migration(db)[2] == []
@@ -0,0 +1,28 @@
+"""Tests for the query plan checks."""
+from pytest_mongo import factories
+from pytest_redis import factories
+from .common import clear_db, get_conn
+from .query_plans import ensure_indexes, explain_collection_scans
+
+
+def test_indexes_rebuilt_after_clear(mongo_proc, redis_proc):  # noqa
+    """Test that indexed queries pass and unindexed ones fail after a clear."""
+    clear_db()
+    db = get_conn()
+    db.users.insert_many(
+        [
+            {"uid": str(i), "username": "user" + str(i), "firstname": "a"}
+            for i in range(3)
+        ]
+    )
+    ensure_indexes(db)
+
+    assert not explain_collection_scans(db, {"find": "users", "filter": {"uid": "1"}})
+    assert explain_collection_scans(db, {"find": "users", "filter": {"firstname": "a"}})
+
+    # Clearing drops the indexes; ensuring them again restores them
+    clear_db()
+    db.users.insert_one({"uid": "1", "username": "user1"})
+    assert explain_collection_scans(db, {"find": "users", "filter": {"uid": "1"}})
+    ensure_indexes(db)
+    assert not explain_collection_scans(db, {"find": "users", "filter": {"uid": "1"}})
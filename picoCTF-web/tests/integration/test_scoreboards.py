@@ -0,0 +1,394 @@
+"""Tests for the /api/v1/scoreboards endpoints."""
+import datetime
+import gzip
+import json
+import queue
+
+import flask
+import pytest
+from pytest_mongo import factories
+from pytest_redis import factories
+from .common import (  # noqa (fixture)
+    ADMIN_DEMOGRAPHICS,
+    app,
+    clear_db,
+    client,
+    get_conn,
+    get_csrf_token,
+    register_test_accounts,
+)
+import api
+
+
+def test_scoreboard_list_conditional_get(mongo_proc, redis_proc, client):  # noqa
+    """Test ETag revalidation of the GET /scoreboards endpoint."""
+    clear_db()
+    api.cache.clear()
+    register_test_accounts()
+
+    res = client.get("/api/v1/scoreboards")
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+    assert "no-store" not in res.headers["Cache-Control"]
+
+    # Unchanged list is not re-sent
+    res = client.get("/api/v1/scoreboards", headers=[("If-None-Match", etag)])
+    assert res.status_code == 304
+    assert res.data == b""
+
+    # The ETag depends on the negotiated encoding
+    res = client.get(
+        "/api/v1/scoreboards",
+        headers=[("If-None-Match", etag), ("Accept-Encoding", "gzip")],
+    )
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+
+    # Adding a scoreboard changes the ETag
+    res = client.post(
+        "/api/v1/user/login",
+        json={
+            "username": ADMIN_DEMOGRAPHICS["username"],
+            "password": ADMIN_DEMOGRAPHICS["password"],
+        },
+    )
+    res = client.post(
+        "/api/v1/scoreboards",
+        json={"name": "Test scoreboard"},
+        headers=[("X-CSRF-Token", get_csrf_token(res))],
+    )
+    assert res.status_code == 201
+    res = client.get("/api/v1/scoreboards", headers=[("If-None-Match", etag)])
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+    assert len(res.json) == 1
+
+
+def test_scoreboard_search_index(mongo_proc, redis_proc):  # noqa
+    """Test searching a scoreboard through its n-gram index."""
+    api.cache.clear()
+    with app().app_context():
+        teams = {
+            "t1": {"tid": "t1", "team_name": "Hackers", "affiliation": "Oak School"},
+            "t2": {"tid": "t2", "team_name": "Pwners", "affiliation": "Elm School"},
+            "t3": {"tid": "t3", "team_name": "oak trees", "affiliation": "None"},
+        }
+        board = api.cache.get_scoreboard_cache(scoreboard_id="search_test")
+        board.add(
+            {
+                "t1": api.cache.encode_scoreboard_score(300, 100),
+                "t2": api.cache.encode_scoreboard_score(500, 100),
+                "t3": api.cache.encode_scoreboard_score(100, 100),
+            }
+        )
+        api.cache.set_scoreboard_teams(list(teams.values()))
+        api.cache.index_scoreboard_teams(board.key, teams)
+
+        results = api.cache.search_scoreboard_cache(board, "School")
+        assert [(r["tid"], r["rank"], r["score"]) for r in results] == [
+            ("t2", 1, 500),
+            ("t1", 2, 300),
+        ]
+        # Matching is case-sensitive, although the index is not
+        assert [r["tid"] for r in api.cache.search_scoreboard_cache(board, "Oak")] == [
+            "t1"
+        ]
+        # Patterns too short for the index are rejected
+        with pytest.raises(api.PicoException):
+            api.cache.search_scoreboard_cache(board, "s")
+
+        # Renamed and removed teams are reindexed
+        teams["t1"]["team_name"] = "Crackers"
+        del teams["t3"]
+        board.remove("t3")
+        api.cache.set_scoreboard_teams(list(teams.values()))
+        api.cache.index_scoreboard_teams(board.key, teams)
+        assert [r["tid"] for r in api.cache.search_scoreboard_cache(board, "ack")] == [
+            "t1"
+        ]
+        assert api.cache.search_scoreboard_cache(board, "Hackers") == []
+        assert api.cache.search_scoreboard_cache(board, "oak trees") == []
+        assert not api.cache.get_conn().exists(board.key + ":search:tre")
+
+        # Deleting the board deletes its index
+        api.cache.delete_scoreboard(board.key)
+        assert not api.cache.get_conn().keys(board.key + "*")
+
+
+def test_scoreboard_score_encoding():
+    """Test the tie-break ordering and decoding of stored scores."""
+    encode = api.cache.encode_scoreboard_score
+    # Higher scores rank first, then earlier last solves
+    assert encode(500, 200) > encode(300, 100)
+    assert encode(300, 100) > encode(300, 200)
+    assert encode(1, 2 ** 32 - 1) > encode(0, 0)
+    for score, last_solve_time in [(1, 0), (300, 100), (10 ** 6, 2 ** 32 - 1)]:
+        assert (
+            api.cache.decode_scoreboard_score(encode(score, last_solve_time)) == score
+        )
+    # Teams without points are stored without a tie-break
+    assert encode(0, 100) == 0
+    assert api.cache.decode_scoreboard_score(encode(0, 100)) == 0
+
+
+def test_scoreboard_team_pruning(mongo_proc, redis_proc):  # noqa
+    """Test that teams on no scoreboard lose their display metadata."""
+    clear_db()
+    api.cache.clear()
+    with app().app_context():
+        get_conn().teams.insert_one(
+            {"tid": "t2", "size": 1, "eligibilities": ["other_board"]}
+        )
+        board = api.cache.get_scoreboard_cache(scoreboard_id="prune_test")
+        other = api.cache.get_scoreboard_cache(scoreboard_id="other_board")
+        teams = {
+            tid: {"tid": tid, "team_name": tid, "affiliation": ""}
+            for tid in ("t1", "t2", "t3")
+        }
+        api.cache.set_scoreboard_teams(list(teams.values()))
+        api.stats._replace_scoreboard(
+            board.key, {"t1": 300, "t2": 200, "t3": 100}, teams
+        )
+        api.stats._replace_scoreboard(other.key, {"t2": 200}, teams)
+
+        # t2 is still listed on another scoreboard, t3 on none
+        api.stats._replace_scoreboard(board.key, {"t1": 300}, teams)
+        conn = api.cache.get_conn()
+        assert conn.hexists(api.cache.SCOREBOARD_TEAMS_KEY, "t2")
+        assert not conn.hexists(api.cache.SCOREBOARD_TEAMS_KEY, "t3")
+
+        # Deleting a scoreboard prunes its teams too
+        api.stats._prune_scoreboard_teams(api.cache.delete_scoreboard(board.key))
+        assert not conn.hexists(api.cache.SCOREBOARD_TEAMS_KEY, "t1")
+        assert conn.hexists(api.cache.SCOREBOARD_TEAMS_KEY, "t2")
+
+
+def test_clear_cache_marks_groups_dirty(mongo_proc, redis_proc):  # noqa
+    """Test that flushing the cache schedules every group board's rebuild."""
+    clear_db()
+    api.cache.clear()
+    with app().app_context():
+        get_conn().groups.insert_one({"gid": "g1", "name": "Class", "members": []})
+        api.stats.clear_cache()
+        assert api.cache.get_conn().smembers(api.stats.DIRTY_GROUPS_KEY) == {b"g1"}
+
+
+def test_score_event_ranks(mongo_proc, redis_proc):  # noqa
+    """Test that score events are only ranked on boards listing the team."""
+    api.cache.clear()
+    with app().app_context():
+        board = api.cache.get_scoreboard_cache(scoreboard_id="events_test")
+        board.add(
+            {
+                "t1": api.cache.encode_scoreboard_score(300, 100),
+                "t2": api.cache.encode_scoreboard_score(500, 100),
+            }
+        )
+        score = api.cache.encode_scoreboard_score(400, 200)
+        assert api.events._rank_on_scoreboards(
+            "t1", score, ["events_test", "other"]
+        ) == {"events_test": 2}
+        assert api.events._rank_on_scoreboards("t3", score, ["events_test"]) == {}
+
+
+def test_event_stream_limit(mongo_proc, redis_proc):  # noqa
+    """Test that each client may only hold a limited number of streams."""
+    flask_app = app()
+    flask_app.config["EVENT_STREAM_MAX_PER_CLIENT"] = 2
+    with flask_app.app_context():
+        api.cache.get_state_conn().delete(api.events.STREAMS_KEY.format("client"))
+        tokens = [api.events.open_stream("client") for _ in range(2)]
+        with pytest.raises(api.PicoException):
+            api.events.open_stream("client")
+        # Other clients are unaffected
+        api.events.open_stream("other client")
+
+        # A closed stream frees its slot
+        stream = api.events.stream_scoreboard_events("board", "client", tokens[0])
+        next(stream)
+        stream.close()
+        api.events.open_stream("client")
+
+
+def test_event_listener_resubscribes(mongo_proc, redis_proc, monkeypatch):  # noqa
+    """Test that the event listener resubscribes after losing its connection."""
+
+    class Stop(BaseException):
+        pass
+
+    event = {"type": "score", "data": {}}
+    rounds = [[ConnectionError("lost")], [{"data": json.dumps(event)}, Stop()]]
+
+    class PubSub:
+        def subscribe(self, channel):
+            pass
+
+        def listen(self):
+            for item in rounds.pop(0):
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+
+        def close(self):
+            pass
+
+    class Conn:
+        def pubsub(self, **kwargs):
+            return PubSub()
+
+    sleeps = []
+    monkeypatch.setattr(api.events.time, "sleep", sleeps.append)
+    client_queue = queue.Queue()
+    with app().app_context():
+        with pytest.raises(Stop):
+            api.events._relay_events(Conn(), {client_queue})
+    assert sleeps == [api.events.LISTEN_RETRY_DELAY]
+    assert client_queue.get_nowait() == event
+
+
+def test_scoreboard_snapshots(mongo_proc, redis_proc):  # noqa
+    """Test storing and clearing scoreboard snapshots."""
+    api.cache.clear()
+    with app().app_context():
+        board = api.cache.get_scoreboard_cache(scoreboard_id="snapshot_test")
+        board.add({"t1": api.cache.encode_scoreboard_score(300, 100)})
+        api.cache.set_scoreboard_teams(
+            [{"tid": "t1", "team_name": "Hackers", "affiliation": "Oak School"}]
+        )
+        version = api.cache.get_versions([board.key])
+        assert api.stats.snapshot_scoreboard({"scoreboard_id": "snapshot_test"}) == 1
+        assert api.cache.get_versions([board.key]) != version
+
+        body, encoding = api.stats.get_scoreboard_snapshot_page(
+            {"scoreboard_id": "snapshot_test"}, 1
+        )
+        assert encoding is None
+        assert json.loads(body)["scoreboard"][0]["name"] == "Hackers"
+
+        # Pages are only precompressed if large enough
+        conn = api.cache.get_conn()
+        assert not conn.keys("scoreboard_snapshot:*:gzip")
+        config = flask.current_app.config
+        config["COMPRESSION_MIN_SIZE"] = 0
+        api.stats.snapshot_scoreboard({"scoreboard_id": "snapshot_test"})
+        body, encoding = api.stats.get_scoreboard_snapshot_page(
+            {"scoreboard_id": "snapshot_test"}, 1, encoding="gzip"
+        )
+        assert encoding == "gzip"
+        assert json.loads(gzip.decompress(body))["scoreboard"][0]["name"] == "Hackers"
+
+        # or at all, if compression is disabled
+        config["COMPRESSION_ENABLED"] = False
+        api.stats.snapshot_scoreboard({"scoreboard_id": "snapshot_test"})
+        assert not conn.keys("scoreboard_snapshot:*:gzip")
+
+        version = api.cache.get_versions([board.key])
+        api.stats.clear_scoreboard_snapshots()
+        assert api.cache.get_versions([board.key]) != version
+        assert (
+            api.stats.get_scoreboard_snapshot_page(
+                {"scoreboard_id": "snapshot_test"}, 1
+            )
+            is None
+        )
+        assert not api.cache.get_conn().keys("scoreboard_snapshot*")
+
+
+def test_fenced_scoreboard_writes(mongo_proc, redis_proc):  # noqa
+    """Test that a stale stats leader cannot overwrite a scoreboard."""
+    api.cache.clear()
+    with app().app_context():
+        board = api.cache.get_scoreboard_cache(scoreboard_id="fence_test")
+        teams = {"t1": {"tid": "t1", "team_name": "Hackers", "affiliation": ""}}
+        flask.g.fencing_token = 2
+        api.stats._replace_scoreboard(board.key, {"t1": 200}, teams)
+        flask.g.fencing_token = 1
+        api.stats._replace_scoreboard(board.key, {"t1": 100}, teams)
+        assert board.score("t1") == 200
+        flask.g.fencing_token = 3
+        api.stats._replace_scoreboard(board.key, {"t1": 300}, teams)
+        assert board.score("t1") == 300
+
+
+def test_historical_scoreboard(mongo_proc, redis_proc):  # noqa
+    """Test the standings of a scoreboard at a cutoff time."""
+    clear_db()
+    api.cache.clear()
+    db = get_conn()
+    db.problems.insert_many(
+        [
+            {"pid": "p1", "score": 100, "disabled": False},
+            {"pid": "p2", "score": 200, "disabled": False},
+            {"pid": "p3", "score": 50, "disabled": True},
+        ]
+    )
+    db.teams.insert_many(
+        [
+            {
+                "tid": tid,
+                "team_name": "team " + tid,
+                "affiliation": "",
+                "size": 1,
+                "eligibilities": [scoreboard],
+            }
+            for tid, scoreboard in (("a", "board"), ("b", "board"), ("c", "other"))
+        ]
+    )
+    # u4 solved p2 before joining team b
+    db.users.insert_many(
+        [
+            {"uid": uid, "tid": tid}
+            for uid, tid in (("u1", "a"), ("u2", "a"), ("u3", "b"), ("u4", "b"))
+        ]
+        + [{"uid": "u5", "tid": "c"}]
+    )
+    db.submissions.insert_many(
+        [
+            {
+                "uid": uid,
+                "tid": tid,
+                "pid": pid,
+                "correct": correct,
+                "timestamp": datetime.datetime.fromtimestamp(time),
+            }
+            for uid, tid, pid, correct, time in (
+                ("u1", "a", "p1", True, 1000),
+                ("u2", "a", "p1", True, 1100),
+                ("u1", "a", "p2", True, 3000),
+                ("u3", "b", "p1", True, 900),
+                ("u3", "b", "p2", False, 1000),
+                ("u3", "b", "p3", True, 800),
+                ("u4", "old", "p2", True, 1500),
+                ("u5", "c", "p1", True, 100),
+            )
+        ]
+    )
+
+    with app().app_context():
+        board = api.stats.get_historical_scoreboard(2000, scoreboard_id="board")
+        assert [
+            (team["rank"], team["tid"], team["score"], team["last_solve"])
+            for team in board
+        ] == [(1, "b", 300, 1500), (2, "a", 100, 1000)]
+
+        board = api.stats.get_historical_scoreboard(950, scoreboard_id="board")
+        assert [(team["tid"], team["score"]) for team in board] == [("b", 100)]
+
+        # Ties are broken by earliest last solve
+        board = api.stats.get_historical_scoreboard(1200, scoreboard_id="board")
+        assert [team["tid"] for team in board] == ["b", "a"]
+
+        # Teams without solves by then are omitted
+        db.submissions.delete_many({"uid": "u3"})
+        board = api.stats.get_historical_scoreboard(1200, scoreboard_id="board")
+        assert [team["tid"] for team in board] == ["a"]
+
+
+def test_score_progressions_align_requires_max_points(
+    mongo_proc, redis_proc, client  # noqa (fixture)
+):
+    """Test that align is rejected without max_points."""
+    clear_db()
+    res = client.get("/api/v1/scoreboards/any/score_progressions?align=true")
+    assert res.status_code == 400
+    assert res.json["message"] == "align requires max_points"
@@ -1,4 +1,9 @@
 """Tests for the /api/v1/stats endpoints."""
+import gzip
+import json
+import threading
+import time
+
 from pytest_mongo import factories
 from pytest_redis import factories
 from .common import (  # noqa (fixture)
@@ -127,3 +132,278 @@ def test_registration_stats(mongo_proc, redis_proc, client):
     assert res.status_code == 200
     expected_response["groups"] += 1
     assert res.json == expected_response
+
+
+def test_demographics_export(mongo_proc, redis_proc, client):
+    """Test the /stats/demographics/export endpoint."""
+    clear_db()
+    register_test_accounts()
+    client.post(
+        "/api/v1/user/login",
+        json={
+            "username": ADMIN_DEMOGRAPHICS["username"],
+            "password": ADMIN_DEMOGRAPHICS["password"],
+        },
+    )
+
+    res = client.get("/api/v1/stats/demographics")
+    assert res.status_code == 200
+    expected_rows = res.json
+
+    # NDJSON rows should match the non-streaming endpoint
+    res = client.get("/api/v1/stats/demographics/export")
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in res.data.decode("utf-8").splitlines()]
+    assert rows == expected_rows
+
+    # CSV output has a header row followed by one row per user
+    res = client.get("/api/v1/stats/demographics/export?format=csv")
+    assert res.status_code == 200
+    assert res.mimetype == "text/csv"
+    lines = res.data.decode("utf-8").splitlines()
+    assert lines[0] == "usertype,country,gender,zipcode,grade,score"
+    assert len(lines) == len(expected_rows) + 1
+
+    res = client.get("/api/v1/stats/demographics/export?format=xml")
+    assert res.status_code == 400
+
+
+def test_demographics_compression(mongo_proc, redis_proc, client, monkeypatch):
+    """Test that large enough responses are compressed when accepted."""
+    clear_db()
+    register_test_accounts()
+    client.post(
+        "/api/v1/user/login",
+        json={
+            "username": ADMIN_DEMOGRAPHICS["username"],
+            "password": ADMIN_DEMOGRAPHICS["password"],
+        },
+    )
+    monkeypatch.setitem(client.application.config, "COMPRESSION_MIN_SIZE", 0)
+
+    res = client.get("/api/v1/stats/demographics")
+    assert "Content-Encoding" not in res.headers
+    expected_rows = res.json
+
+    res = client.get(
+        "/api/v1/stats/demographics", headers=[("Accept-Encoding", "gzip")]
+    )
+    assert res.status_code == 200
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in res.headers["Vary"]
+    assert json.loads(gzip.decompress(res.data)) == expected_rows
+
+    # Streamed exports are sent as-is
+    res = client.get(
+        "/api/v1/stats/demographics/export", headers=[("Accept-Encoding", "gzip")]
+    )
+    assert "Content-Encoding" not in res.headers
+
+
+def test_registration_stats_coalescing(mongo_proc, redis_proc, client, monkeypatch):
+    """Test that identical concurrent requests share one computation."""
+    clear_db()
+    api.cache.clear()
+    register_test_accounts()
+
+    calls = []
+    get_registration_count = api.stats.get_registration_count
+
+    def slow_registration_count():
+        calls.append(1)
+        time.sleep(0.5)
+        return get_registration_count()
+
+    monkeypatch.setattr(api.stats, "get_registration_count", slow_registration_count)
+    responses = []
+
+    def request_stats():
+        responses.append(
+            client.application.test_client().get("/api/v1/stats/registration")
+        )
+
+    threads = [threading.Thread(target=request_stats) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert [res.status_code for res in responses] == [200] * 5
+    assert all(res.data == responses[0].data for res in responses)
+
+    client.post(
+        "/api/v1/user/login",
+        json={
+            "username": ADMIN_DEMOGRAPHICS["username"],
+            "password": ADMIN_DEMOGRAPHICS["password"],
+        },
+    )
+    res = client.get("/api/v1/stats/coalescing")
+    assert res.status_code == 200
+    assert res.json["v1_api.stats_registration_status"] == {
+        "requests": 5,
+        "computed": 1,
+        "ratio": 5,
+    }
+
+
+def test_actions_export(mongo_proc, redis_proc, client):
+    """Test the /stats/actions/export endpoint."""
+    clear_db()
+    register_test_accounts()
+    client.post(
+        "/api/v1/user/login",
+        json={
+            "username": ADMIN_DEMOGRAPHICS["username"],
+            "password": ADMIN_DEMOGRAPHICS["password"],
+        },
+    )
+
+    # Logged actions are exported with the names of their users and teams
+    res = client.get("/api/v1/stats/actions/export")
+    assert res.status_code == 200
+    rows = [json.loads(line) for line in res.data.decode("utf-8").splitlines()]
+    logins = [row for row in rows if row["event"] == "api.user.login"]
+    assert logins[-1]["username"] == ADMIN_DEMOGRAPHICS["username"]
+    assert logins[-1]["team_name"] == ADMIN_DEMOGRAPHICS["username"]
+    assert logins[-1]["api_endpoint"] == "/api/v1/user/login"
+    assert logins[-1]["success"] is True
+
+    # Only identifiers are stored
+    record = get_conn().statistics.find_one({"event": "api.user.login"})
+    assert "user" not in record
+    assert "user_agent_hash" in record["request"]
+
+
+def test_performance_metrics(mongo_proc, redis_proc, client):
+    """Test the per-endpoint performance metrics."""
+    clear_db()
+    api.cache.clear()
+    register_test_accounts()
+    client.application.config["METRICS_FLUSH_INTERVAL"] = 0
+    client.application.config["METRICS_SERVER_TIMING"] = True
+
+    res = client.get("/api/v1/stats/registration")
+    assert res.status_code == 200
+    assert "mongo;dur=" in res.headers["Server-Timing"]
+
+    client.post(
+        "/api/v1/user/login",
+        json={
+            "username": ADMIN_DEMOGRAPHICS["username"],
+            "password": ADMIN_DEMOGRAPHICS["password"],
+        },
+    )
+    res = client.get("/api/v1/stats/performance?minutes=10")
+    assert res.status_code == 200
+    registration = res.json["v1_api.stats_registration_status"]
+    assert registration["request_duration_ms"]["count"] == 1
+    assert registration["mongo_commands"]["mean"] > 0
+
+    res = client.get("/api/v1/stats/metrics")
+    assert res.status_code == 200
+    assert res.mimetype == "text/plain"
+    assert (
+        'picoctf_request_duration_ms_count{endpoint="v1_api.stats_registration_status"}'
+        " 1"
+    ) in res.data.decode("utf-8")
+
+    # Metrics can be scraped with a token instead of a session
+    client.get("/api/v1/user/logout")
+    res = client.get("/api/v1/stats/metrics")
+    assert res.status_code == 401
+    client.application.config["METRICS_TOKEN"] = "scraper"
+    res = client.get(
+        "/api/v1/stats/metrics", headers=[("Authorization", "Bearer scraper")]
+    )
+    assert res.status_code == 200
+    client.application.config["METRICS_SERVER_TIMING"] = False
+    client.application.config["METRICS_TOKEN"] = None
+
+
+def test_prometheus_metrics_precision(mongo_proc, redis_proc, client):
+    """Test that large counts and sums are exported without rounding."""
+    api.cache.clear()
+    bound = str(api.metrics.METRICS["request_duration_ms"][0])
+    with client.application.app_context():
+        api.cache.get_conn().hset(
+            api.metrics.TOTALS_KEY,
+            mapping={
+                "request_duration_ms|v1_api.test|" + bound: 12345678,
+                "request_duration_ms|v1_api.test|sum": 123456789.125,
+            },
+        )
+        text = api.metrics.get_prometheus_metrics()
+    prefix = 'picoctf_request_duration_ms_{}{{endpoint="v1_api.test"'
+    assert (prefix.format("bucket") + ',le="{}"}} 12345678'.format(bound)) in text
+    assert (prefix.format("sum") + "} 123456789.125") in text
+    assert (prefix.format("count") + "} 12345678") in text
+
+
+def test_slow_queries(mongo_proc, redis_proc, client):
+    """Test that slow queries are aggregated by their query shape."""
+    clear_db()
+    api.cache.clear()
+    register_test_accounts()
+    with client.application.app_context():
+        for uid, duration in (("a", 150), ("b", 250)):
+            shape = api.metrics.query_shape(
+                "find", {"find": "users", "filter": {"uid": uid}, "lsid": {"id": uid}},
+            )
+            api.metrics.record_slow_query(shape, duration, "api/user.py:1 in get_user")
+
+    client.post(
+        "/api/v1/user/login",
+        json={
+            "username": ADMIN_DEMOGRAPHICS["username"],
+            "password": ADMIN_DEMOGRAPHICS["password"],
+        },
+    )
+    res = client.get("/api/v1/stats/slow_queries")
+    assert res.status_code == 200
+    assert len(res.json) == 1
+    assert res.json[0]["shape"] == {"find": "users", "filter": {"uid": "?"}}
+    assert res.json[0]["caller"] == "api/user.py:1 in get_user"
+    assert res.json[0]["count"] == 2
+    assert res.json[0]["total_duration_ms"] == 400
+
+
+def test_downsample_score_progression():
+    """Test Largest-Triangle-Three-Buckets downsampling."""
+    progression = [{"score": 10 * i, "time": 100 * i} for i in range(100)]
+    # A spike which should survive downsampling
+    progression[50]["score"] = 5000
+
+    assert api.stats.downsample_score_progression(progression, 100) == progression
+    sampled = api.stats.downsample_score_progression(progression, 10)
+    assert len(sampled) == 10
+    assert sampled[0] == progression[0]
+    assert sampled[-1] == progression[-1]
+    assert progression[50] in sampled
+    assert sampled == sorted(sampled, key=lambda point: point["time"])
+
+    assert api.stats.downsample_score_progression(progression, 2) == [
+        progression[0],
+        progression[-1],
+    ]
+    assert api.stats.downsample_score_progression(progression, 1) == [progression[-1]]
+
+
+def test_align_score_progressions():
+    """Test sampling score progressions on a shared time grid."""
+    progressions = [
+        [{"score": 100, "time": 0}, {"score": 300, "time": 100}],
+        [{"score": 50, "time": 40}],
+        [],
+    ]
+    aligned = api.stats.align_score_progressions(progressions, 5)
+    assert [[point["time"] for point in progression] for progression in aligned] == [
+        [0, 25, 50, 75, 100]
+    ] * 3
+    assert [[point["score"] for point in progression] for progression in aligned] == [
+        [100, 100, 100, 100, 300],
+        [0, 0, 50, 50, 50],
+        [0, 0, 0, 0, 0],
+    ]
+    assert api.stats.align_score_progressions([[], []], 5) == [[], []]
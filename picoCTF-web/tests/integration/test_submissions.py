@@ -1,4 +1,6 @@
 """Tests for the /api/v1/submissions endpoints."""
+from datetime import datetime
+
 from pytest_mongo import factories
 from pytest_redis import factories
 from .common import (  # noqa (fixture)
@@ -22,7 +24,7 @@ from .common import (  # noqa (fixture)
 import api
 
 
-def test_submission(mongo_proc, redis_proc, client):  # noqa (fixture)
+def test_submission(mongo_proc, redis_proc, client, monkeypatch):  # noqa (fixture)
     """Test the POST /submissions endpoint."""
     clear_db()
     register_test_accounts()
@@ -71,6 +73,10 @@ def test_submission(mongo_proc, redis_proc, client):  # noqa (fixture)
         flags[pid] = get_problem_key(pid, STUDENT_DEMOGRAPHICS["username"])
     correct_key = flags[unlocked_pids[0]]
 
+    # Store the (empty) score timeline before solving
+    res = client.get("/api/v1/team/score_progression")
+    assert res.json == []
+
     res = client.post(
         "/api/v1/submissions",
         json={"pid": unlocked_pids[0], "key": correct_key, "method": "testing"},
@@ -80,6 +86,34 @@ def test_submission(mongo_proc, redis_proc, client):  # noqa (fixture)
     assert res.json["correct"] is True
     assert res.json["message"] == "That is correct!"
 
+    # The solve is appended to the stored score timeline
+    tid = db.users.find_one({"username": STUDENT_DEMOGRAPHICS["username"]})["tid"]
+    res = client.get("/api/v1/team/score_progression")
+    assert len(res.json) == 1
+    assert res.json[0]["score"] == api.problem.get_problem(unlocked_pids[0])["score"]
+    assert res.json == api.stats.rebuild_score_timeline(tid)
+
+    # Appending a solve which a rebuild already counted does not duplicate it
+    api.stats.append_score_timeline(
+        tid, unlocked_pids[0], res.json[0]["score"], datetime.utcnow()
+    )
+    assert api.stats.get_score_timeline(tid) == res.json
+
+    # A rebuild which raced with a solve is not stored
+    api.stats.invalidate_score_timeline(tid)
+    calculate = api.stats._calculate_score_progression
+
+    def racing_calculate(**kwargs):
+        progression = calculate(**kwargs)
+        api.stats.append_score_timeline(tid, "racing pid", 10, datetime.utcnow())
+        return progression
+
+    monkeypatch.setattr(api.stats, "_calculate_score_progression", racing_calculate)
+    api.stats.rebuild_score_timeline(tid)
+    assert not api.cache.get_conn().exists(api.stats.SCORE_TIMELINE_KEY.format(tid))
+    monkeypatch.undo()
+    assert api.stats.get_score_timeline(tid) == res.json
+
     # Test incorrect & previously solved by user
     res = client.post(
         "/api/v1/submissions",
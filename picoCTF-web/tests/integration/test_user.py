@@ -114,6 +114,10 @@ def test_login_rate_limit(mongo_proc, redis_proc, client):  # noqa (fixture)
         )
     assert res.status_code == 429
     assert match(regex, res.json["message"]) is not None
+    assert res.headers["RateLimit-Limit"] == "20"
+    assert res.headers["RateLimit-Remaining"] == "0"
+    assert 0 < int(res.headers["RateLimit-Reset"]) <= 15
+    assert res.headers["Retry-After"] == res.headers["RateLimit-Reset"]
 
     # Repeated attempts to login with an incorrect password, wrong bypass
     for _ in range(21):
@@ -151,6 +151,7 @@ const BatchRegistrationPanel = React.createClass({
     e.preventDefault();
     const formData = new FormData();
     formData.append("csv", this.refs.fileUpload.getInputDOMNode().files[0]);
+    formData.append("background", "true");
     const params = {
       method: "POST",
       url: `/api/v1/groups/${this.props.gid}/batch_registration`,
@@ -160,72 +161,99 @@ const BatchRegistrationPanel = React.createClass({
       processData: false
     };
     $.ajax(params)
+      .done(data => this.pollBatchRegistration(data.job_id))
+      .fail(jqXHR => this.handleBatchRegistrationFailure(jqXHR));
+  },
+
+  pollBatchRegistration(jobId) {
+    $.ajax({
+      method: "GET",
+      url: `/api/v1/groups/${this.props.gid}/batch_registration/${jobId}`,
+      cache: false
+    })
       .done(data => {
-        gtag('event', 'BatchRegistration', {
-          'event_category': 'Group',
-          'event_label': 'Success'
-        });
-        let csv_content = "data:text/csv;charset=utf-8," + atob(data.as_csv);
-        let encoded_uri = encodeURI(csv_content);
+        if (data.status === "running") {
+          const response_html =
+            '<div class="panel panel-info batch-registration-response"><div class="panel-heading"><h4>Creating accounts...</h4>' +
+            `<p>Prepared ${data.completed} of ${data.total} student accounts.</p>` +
+            "</div></div>";
+          $(".batch-registration-response").remove();
+          $("#batch-registration-panel").append(response_html);
+          setTimeout(() => this.pollBatchRegistration(jobId), 2000);
+        } else {
+          this.handleBatchRegistrationSuccess(data);
+        }
+      })
+      .fail(jqXHR => this.handleBatchRegistrationFailure(jqXHR));
+  },
+
+  handleBatchRegistrationSuccess(data) {
+    gtag('event', 'BatchRegistration', {
+      'event_category': 'Group',
+      'event_label': 'Success'
+    });
+    let csv_content = "data:text/csv;charset=utf-8," + atob(data.as_csv);
+    let encoded_uri = encodeURI(csv_content);
+
+    let response_html =
+      '<div class="panel panel-success batch-registration-response"><div class="panel-heading"><h4>Accounts successfully created!</h4>' +
+      "<p>You have been prompted to download an updated CSV containing usernames and passwords for your students' accounts.</p>" +
+      "<p>Make sure to save this file, as it will not available after leaving this page.</p>" +
+      '<a class="btn btn-default" id="batch-credentials-download" href="' + encoded_uri + '" download="registered_accounts.csv">Redownload Account Credentials</a>' +
+      "</div></div>"
+    $(".batch-registration-response").remove();
+    $("#batch-registration-panel").append(response_html).promise()
+      .then(function() {
+        // Automatically attempt to download account credentials
+        $("#batch-credentials-download")[0].click()
+      });
+    this.props.refresh();
+  },
 
+  handleBatchRegistrationFailure(jqXHR) {
+    gtag('event', 'BatchRegistration', {
+      'event_category': 'Group',
+      'event_label': 'Failure'
+    });
+    $(".batch-registration-response").remove();
+    if (jqXHR.responseJSON !== undefined) {
+      // If the error response comes from Flask
+      if (typeof jqXHR.responseJSON.message === "object") {
+        // If the error is an object of validation errors
+        const errors = jqXHR.responseJSON.message;
         let response_html =
-          '<div class="panel panel-success batch-registration-response"><div class="panel-heading"><h4>Accounts successfully created!</h4>' +
-          "<p>You have been prompted to download an updated CSV containing usernames and passwords for your students' accounts.</p>" +
-          "<p>Make sure to save this file, as it will not available after leaving this page.</p>" +
-          '<a class="btn btn-default" id="batch-credentials-download" href="' + encoded_uri + '" download="registered_accounts.csv">Redownload Account Credentials</a>' +
-          "</div></div>"
-        $(".batch-registration-response").remove();
-        $("#batch-registration-panel").append(response_html).promise()
-          .then(function() {
-            // Automatically attempt to download account credentials
-            $("#batch-credentials-download")[0].click()
-          });
-        this.props.refresh();
-      })
-      .fail(jqXHR => {
-        gtag('event', 'BatchRegistration', {
-          'event_category': 'Group',
-          'event_label': 'Failure'
-        });
-        if (jqXHR.responseJSON !== undefined) {
-          // If the error response comes from Flask
-          if (typeof jqXHR.responseJSON.message === "object") {
-            // If the error is an object of validation errors
-            const errors = jqXHR.responseJSON.message;
-            let response_html =
-              '<div class="panel panel-danger batch-registration-response"><div class="panel-heading"><h4>Errors found in CSV.</h4>' +
-              "<p>Please resolve the issues below and resubmit:</p>";
-            for (let row_num in errors) {
-              const row = errors[row_num];
-              response_html += `<p><strong>Row ${parseInt(row_num) +
-                1}:</strong></p><ul>`;
-              for (let field in row) {
-                const err_messages = row[field];
-                for (let err_message of err_messages) {
-                  if (field === "_schema") {
-                    response_html += `<li>${_.escape(err_message)}</li>`;
-                  } else {
-                    response_html += `<li>${_.escape(field)}: ${_.escape(
-                      err_message
-                    )}</li>`;
-                  }
-                }
+          '<div class="panel panel-danger batch-registration-response"><div class="panel-heading"><h4>Errors found in CSV.</h4>' +
+          "<p>Please resolve the issues below and resubmit:</p>";
+        for (let row_num in errors) {
+          const row = errors[row_num];
+          response_html += `<p><strong>Row ${parseInt(row_num) +
+            1}:</strong></p><ul>`;
+          for (let field in row) {
+            const err_messages = row[field];
+            for (let err_message of err_messages) {
+              if (field === "_schema") {
+                response_html += `<li>${_.escape(err_message)}</li>`;
+              } else {
+                response_html += `<li>${_.escape(field)}: ${_.escape(
+                  err_message
+                )}</li>`;
               }
-              response_html += "</ul>";
             }
-            $(".batch-registration-response").remove();
-            $("#batch-registration-panel").append(response_html);
-          } else {
-            // Otherwise, assume a normal error message
-            apiNotify({ status: 0, message: jqXHR.responseJSON.message });
-            return;
           }
-        } else {
-          // If the response contains only a status code (e.g. from nginx)
-          apiNotify({ status: 0, message: jqXHR.statusText });
-          return;
+          response_html += "</ul>";
         }
-      });
+        $(".batch-registration-response").remove();
+        $("#batch-registration-panel").append(response_html);
+      } else {
+        // Otherwise, assume a normal error message
+        apiNotify({ status: 0, message: jqXHR.responseJSON.message });
+        return;
+      }
+    } else {
+      // If the response contains only a status code (e.g. from nginx)
+      apiNotify({ status: 0, message: jqXHR.statusText });
+      return;
+    }
   },
 
   render() {
@@ -103,7 +103,12 @@ const ExceptionTab = React.createClass({
         commonTrace
       ) {
         const exception = _.first(exceptions);
-        exception.count = exceptions.length;
+        // Repeated exceptions are stored once, with their count
+        exception.count = _.reduce(
+          exceptions,
+          (count, exception) => count + (exception.count || 1),
+          0
+        );
         return exception;
       });
 
@@ -119,7 +119,7 @@ const render_scoreboard_page = function(board_key, search, page) {
     scoreboard_endpoint += 'scoreboards/' + board_key.scoreboard_id + '/scoreboard';
   }
   scoreboard_endpoint += '?page=' + page;
-  if (search !== "") {
+  if (searchValue.length >= MIN_SEARCH_LENGTH) {
     scoreboard_endpoint += '&search=' + searchValue;
   }
 
@@ -139,6 +139,9 @@ const render_scoreboard_page = function(board_key, search, page) {
   );
 };
 
+// Shorter searches are rejected by the API, as they cannot use its index
+const MIN_SEARCH_LENGTH = 3;
+
 const attachSearchListeners = () => {
     // Attach search field listener
   $("form[role=search]").on("submit", function (e) {
@@ -156,7 +159,11 @@ const attachSearchListeners = () => {
         board_key = {'group_id': active_tab.gid};
       }
       let searchValue = $("#search").val();
-      render_scoreboard(board_key, searchValue);
+      if (searchValue === "") {
+        render_scoreboard(board_key);
+      } else if (searchValue.length >= MIN_SEARCH_LENGTH) {
+        render_scoreboard(board_key, searchValue);
+      }
     }, 250);
   });
 };